@@ -0,0 +1,116 @@
+"""
+Multi-rate channel alignment for the MSR Control application.
+
+Channels from different EtherLab tasks are sampled at different rates and carry
+their own server-side timestamps. This module resamples a selection of channels
+from the in-memory history onto one shared timebase, so that cross-channel math
+and plots line up without any merging on the client.
+"""
+import numpy as np
+
+from .history import get_history
+
+# Supported resampling methods
+ALIGNMENT_METHODS = ('zoh', 'linear')
+
+# Upper bound on the number of points in an aligned timebase
+DEFAULT_MAX_POINTS = 2000
+
+
+def _sorted_samples(times, values):
+    """Return the samples ordered by time (server time may step back on reconnect)."""
+    if times.size > 1 and np.any(np.diff(times) < 0):
+        order = np.argsort(times, kind='stable')
+        return times[order], values[order]
+    return times, values
+
+
+def resample(times, values, timebase, method='zoh'):
+    """
+    Resample one channel onto a timebase.
+
+    Args:
+        times: Sorted sample times of the channel
+        values: Sample values of the channel
+        timebase: Target times to resample onto
+        method: 'zoh' (zero-order hold) or 'linear' interpolation
+
+    Returns:
+        numpy.ndarray: Values at the timebase, NaN where the channel has no data
+    """
+    if method not in ALIGNMENT_METHODS:
+        raise ValueError(f"Unknown alignment method: {method}")
+
+    if times.size == 0:
+        return np.full(timebase.shape, np.nan)
+
+    if method == 'linear':
+        return np.interp(timebase, times, values, left=np.nan, right=np.nan)
+
+    # Zero-order hold: take the last sample at or before each target time
+    indices = np.searchsorted(times, timebase, side='right') - 1
+    aligned = values[np.clip(indices, 0, None)]
+    aligned[indices < 0] = np.nan
+    return aligned
+
+
+def align_channels(channels, period=None, method='zoh', window=None,
+                   max_points=DEFAULT_MAX_POINTS):
+    """
+    Resample channels from the history onto a common timebase.
+
+    The timebase covers the interval in which all requested channels have data.
+    If no period is given, the median sample interval of the fastest channel is
+    used, and the period is widened if needed to stay within ``max_points``.
+
+    Args:
+        channels: Iterable of channel names
+        period: Timebase period in seconds (derived from the data if None)
+        method: 'zoh' or 'linear'
+        window: Only align the last ``window`` seconds if given
+        max_points: Maximum number of points in the timebase
+
+    Returns:
+        dict: 'timestamps' array, 'channels' mapping of name to aligned values,
+        and the 'period' and 'method' actually used
+    """
+    if method not in ALIGNMENT_METHODS:
+        raise ValueError(f"Unknown alignment method: {method}")
+
+    series = {}
+    for channel in channels:
+        history = get_history(channel)
+        if history is None or len(history) == 0:
+            raise ValueError(f"No samples available for channel: {channel}")
+        series[channel] = _sorted_samples(*history.latest())
+
+    if not series:
+        raise ValueError("No channels requested")
+
+    # Overlapping interval covered by every channel
+    start = max(times[0] for times, _ in series.values())
+    end = min(times[-1] for times, _ in series.values())
+    if window is not None:
+        start = max(start, end - float(window))
+
+    if period is None:
+        intervals = [np.median(np.diff(times)) for times, _ in series.values() if times.size > 1]
+        intervals = [interval for interval in intervals if interval > 0]
+        period = min(intervals) if intervals else 0.0
+    period = float(period)
+
+    if end <= start or period <= 0:
+        timebase = np.array([end], dtype=np.float64)
+    else:
+        period = max(period, (end - start) / max(max_points - 1, 1))
+        timebase = start + period * np.arange(int((end - start) / period) + 1)
+
+    return {
+        'timestamps': timebase,
+        'channels': {
+            channel: resample(times, values, timebase, method)
+            for channel, (times, values) in series.items()
+        },
+        'period': period,
+        'method': method,
+    }
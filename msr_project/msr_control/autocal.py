@@ -0,0 +1,289 @@
+"""
+Least-squares auto-calibration for the MSR Control application.
+
+A calibrator holds the channel steady at a known physical value and captures a
+reference point. The raw samples arriving during the hold window are averaged
+by the streaming pipeline as they pass through ``process_data``, so capturing a
+point needs no extra pass over the history. Once enough points are captured,
+gain and offset (or a polynomial) are fitted by least squares and applied
+through ``update_calibration``.
+"""
+import asyncio
+import math
+import time
+
+import numpy as np
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# Highest polynomial degree that can be fitted
+MAX_DEGREE = 3
+
+# Default hold window for a reference point, in seconds
+DEFAULT_HOLD_DURATION = 2.0
+
+
+class HoldWindowAccumulator:
+    """
+    Running mean and spread of the raw samples seen during a hold window.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.total_squares += value * value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    @property
+    def std(self):
+        if self.count < 2:
+            return 0.0
+        variance = (self.total_squares - self.total * self.total / self.count) / (self.count - 1)
+        return math.sqrt(max(variance, 0.0))
+
+
+# Auto-calibration sessions keyed by (server id, user name). A server has at
+# most one session at a time; only its owner can capture, fit or apply
+autocal_sessions = {}
+
+# Accumulators of the hold windows being captured, keyed by server id
+_active_windows = {}
+
+# Seconds without activity after which another user may take over a session
+SESSION_TIMEOUT = 900.0
+
+
+def observe_raw_value(raw_value, server_id):
+    """
+    Feed a raw sample from the streaming pipeline into the open hold window.
+
+    Args:
+        raw_value: Raw value parsed from the EtherLab data
+        server_id: The server the value was received from
+    """
+    window = _active_windows.get(server_id)
+    if window is not None:
+        window.add(raw_value)
+
+
+def _server_session(server_id):
+    """Return the session on a server as (user, session), or (None, None)."""
+    for (session_server, user), session in autocal_sessions.items():
+        if session_server == server_id:
+            return user, session
+    return None, None
+
+
+def get_session(user, server_id):
+    """
+    Return the user's session on a server.
+
+    Raises:
+        ValueError: If the user has no session on the server
+    """
+    session = autocal_sessions.get((server_id, user))
+    if session is None:
+        owner, _ = _server_session(server_id)
+        if owner is not None:
+            raise ValueError(f"{server_id} is being calibrated by {owner}")
+        raise ValueError("No auto-calibration session is active")
+    session['updated'] = time.time()
+    return session
+
+
+def start_session(user, server_id, degree=1):
+    """
+    Start a new auto-calibration session, discarding the user's previous points.
+
+    Args:
+        user: Name of the calibrating user
+        server_id: The EtherLab server to calibrate
+        degree: Polynomial degree to fit (1 fits gain and offset)
+
+    Returns:
+        dict: The session state
+
+    Raises:
+        ValueError: If another user's session on the server is active
+    """
+    degree = int(degree)
+    if not 1 <= degree <= MAX_DEGREE:
+        raise ValueError(f"Degree must be between 1 and {MAX_DEGREE}")
+
+    owner, session = _server_session(server_id)
+    if owner is not None and owner != user:
+        if server_id in _active_windows or time.time() - session['updated'] < SESSION_TIMEOUT:
+            raise ValueError(f"{server_id} is being calibrated by {owner}")
+        logger.info(f"Auto-calibration of {server_id} by {owner} expired")
+        del autocal_sessions[(server_id, owner)]
+    elif owner == user and server_id in _active_windows:
+        raise ValueError("A reference point is being captured")
+
+    now = time.time()
+    autocal_sessions[(server_id, user)] = {
+        'user': user,
+        'server': server_id,
+        'degree': degree,
+        'started': now,
+        'updated': now,
+        'points': []
+    }
+    logger.info(f"Auto-calibration of {server_id} started by {user} (degree {degree})")
+    return session_summary(user, server_id)
+
+
+def cancel_session(user, server_id):
+    """Cancel the user's auto-calibration session on a server."""
+    session = autocal_sessions.get((server_id, user))
+    if session is not None and server_id in _active_windows:
+        raise ValueError("A reference point is being captured")
+    autocal_sessions.pop((server_id, user), None)
+
+
+def session_summary(user, server_id):
+    """
+    Return a JSON-serializable view of the user's session on a server.
+
+    If the user has none, 'held_by' names the user calibrating the server, if any.
+    """
+    session = autocal_sessions.get((server_id, user))
+    if session is None:
+        owner, _ = _server_session(server_id)
+        return {'active': False, 'user': None, 'server': server_id, 'held_by': owner, 'points': []}
+    return {
+        'active': True,
+        'user': user,
+        'server': server_id,
+        'degree': session['degree'],
+        'points': list(session['points'])
+    }
+
+
+async def capture_point(user, server_id, reference, duration=DEFAULT_HOLD_DURATION):
+    """
+    Capture a reference point by averaging raw samples over a hold window.
+
+    Args:
+        user: Name of the calibrating user
+        server_id: The EtherLab server being calibrated
+        reference: Known physical value applied during the hold
+        duration: Length of the hold window in seconds
+
+    Returns:
+        dict: The captured point with the raw mean, spread and sample count
+    """
+    session = get_session(user, server_id)
+    if server_id in _active_windows:
+        raise ValueError("A reference point is already being captured")
+
+    reference = float(reference)
+    duration = float(duration)
+    if not 0 < duration <= 60:
+        raise ValueError("Hold duration must be between 0 and 60 seconds")
+
+    window = _active_windows[server_id] = HoldWindowAccumulator()
+    try:
+        await asyncio.sleep(duration)
+    finally:
+        del _active_windows[server_id]
+
+    if window.count == 0:
+        raise ValueError("No samples were received during the hold window")
+
+    point = {
+        'reference': reference,
+        'raw_mean': window.mean,
+        'raw_std': window.std,
+        'samples': window.count
+    }
+    session['points'].append(point)
+    session['updated'] = time.time()
+    logger.info(f"Auto-calibration point captured: reference={reference}, raw={window.mean:.4f} ({window.count} samples)")
+    return point
+
+
+def fit_calibration(user, server_id):
+    """
+    Fit the calibration to the captured reference points of the user's session.
+
+    Solves the least-squares problem for the polynomial mapping raw means to
+    reference values. For degree 1 the result is expressed as gain and offset
+    of the existing ``(raw + offset) * gain`` calibration.
+
+    Args:
+        user: Name of the calibrating user
+        server_id: The EtherLab server being calibrated
+
+    Returns:
+        dict: 'settings' to pass to update_calibration, 'coefficients'
+        (highest power first), per-point 'residuals' and their 'rms'/'max'
+    """
+    session = get_session(user, server_id)
+    degree = session['degree']
+    points = session['points']
+    if len(points) < degree + 1:
+        raise ValueError(f"At least {degree + 1} reference points are needed for degree {degree}")
+
+    raw = np.array([point['raw_mean'] for point in points], dtype=np.float64)
+    reference = np.array([point['reference'] for point in points], dtype=np.float64)
+
+    design = np.vander(raw, degree + 1)
+    coefficients, _, rank, _ = np.linalg.lstsq(design, reference, rcond=None)
+    if rank < degree + 1:
+        raise ValueError("Reference points do not determine the fit; use distinct values")
+
+    residuals = reference - design @ coefficients
+
+    if degree == 1:
+        gain, intercept = coefficients
+        if gain == 0:
+            raise ValueError("Fitted gain is zero")
+        calibration = {'gain': float(gain), 'offset': float(intercept / gain), 'polynomial': None}
+    else:
+        calibration = {'polynomial': coefficients.tolist()}
+
+    return {
+        'settings': calibration,
+        'coefficients': coefficients.tolist(),
+        'residuals': residuals.tolist(),
+        'rms': float(np.sqrt(np.mean(residuals ** 2))),
+        'max': float(np.max(np.abs(residuals)))
+    }
+
+
+async def apply_calibration(user, server_id):
+    """
+    Fit the captured points and apply the result through update_calibration.
+
+    Args:
+        user: Name of the calibrating user
+        server_id: The EtherLab server being calibrated
+
+    Returns:
+        dict: The fit report with the applied calibration 'settings'
+    """
+    from .msr_protocol import update_calibration
+
+    report = fit_calibration(user, server_id)
+    result = await update_calibration(report['settings'], server_id)
+    if 'error' in result:
+        raise ValueError(result['error'])
+
+    logger.info(f"Auto-calibration applied: {report['settings']} (rms residual {report['rms']:.4g})")
+    autocal_sessions.pop((server_id, user), None)
+    report['applied'] = dict(result)
+    return report
@@ -0,0 +1,78 @@
+"""
+Binary WebSocket frames carrying samples.
+
+Clients that connect with ``?format=binary`` receive their samples in this
+format instead of JSON; all other messages stay JSON text. A frame holds one
+or more samples as columns that a browser can read in place through typed
+arrays (all little-endian):
+
+    offset  size  content
+    0       4     magic b'MSRB'
+    4       2     format version (1)
+    6       2     bit mask of the value columns present, in FIELDS order
+    8       4     number of samples N
+    12      4     length L of the channel name table in bytes
+    16      8*N   timestamp column, float64
+    ...     8*N   one float64 column per value field present (NaN if a
+                  sample lacks the field)
+    ...     2*N   channel column, uint16 index into the name table
+    ...     L     channel name table, a UTF-8 JSON array of strings
+
+The columns start on 8-byte boundaries. Fields that are not numbers, such as
+connection_state or calibration_data, are not included; clients read them
+with get_status.
+"""
+import json
+import struct
+from array import array
+
+MAGIC = b'MSRB'
+VERSION = 1
+
+# Value fields in column order; bit i of the mask stands for FIELDS[i]
+FIELDS = ('filtered_value', 'calibrated_value', 'raw_value')
+
+HEADER = struct.Struct('<4sHHII')
+
+NAN = float('nan')
+
+
+def encode_samples(samples):
+    """
+    Encode samples as one binary frame.
+
+    Args:
+        samples: List of filtered data dictionaries, oldest first
+
+    Returns:
+        bytes: The frame
+    """
+    count = len(samples)
+    names = {}
+    channels = array('H', [names.setdefault(sample.get('channel'), len(names)) for sample in samples])
+    timestamps = array('d', [_number(sample.get('timestamp')) for sample in samples])
+
+    mask = 0
+    columns = []
+    for bit, field in enumerate(FIELDS):
+        if any(field in sample for sample in samples):
+            mask |= 1 << bit
+            columns.append(array('d', [_number(sample.get(field)) for sample in samples]))
+
+    name_table = json.dumps([name if name is not None else '' for name in names]).encode()
+    if array('H', [1]).tobytes() != b'\x01\x00':
+        # Columns are little-endian on the wire
+        for column in (channels, timestamps, *columns):
+            column.byteswap()
+
+    return b''.join([
+        HEADER.pack(MAGIC, VERSION, mask, count, len(name_table)),
+        timestamps.tobytes(),
+        *(column.tobytes() for column in columns),
+        channels.tobytes(),
+        name_table
+    ])
+
+
+def _number(value):
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else NAN
@@ -0,0 +1,522 @@
+"""
+Channel discovery and wildcard channel subscriptions.
+
+The channel list of each EtherLab server is read when the connection comes up
+(and again when the server announces a reload) and indexed in a compressed
+prefix trie of path segments: chains of single-child segments share one edge,
+so ``/Taskinfo/0/ExecTime`` is one edge unless other channels branch off it.
+Queries walk only the branches a pattern can match, so their cost follows the
+number of matches rather than the number of channels.
+
+Patterns are channel paths in which a segment may be ``*`` (any one segment),
+contain shell wildcards (``Motor*``) or be ``**`` (any number of segments).
+A pattern ending in ``/`` matches everything below that path.
+
+WebSocket clients subscribe with patterns that name at least one segment and
+match at most MAX_PATTERN_CHANNELS channels. The server is subscribed to the
+union of their expansions, and the expansions are recomputed whenever the
+channel list is read again; clients are told when theirs changed. The
+server then sends the values of those channels as ``<F c="index" d="...">``
+children of its ``<data>`` elements; each is decoded by the channel's type
+and sent to the channel's own group, which only the clients whose patterns
+match the channel join.
+"""
+import base64
+import binascii
+import hashlib
+import re
+import struct
+import time
+from fnmatch import fnmatchcase
+from functools import lru_cache
+
+from channels.layers import get_channel_layer
+
+from .framing import parse_attributes
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# Tag the server announces a changed channel list with
+RELOAD_TAG = 'reload'
+
+# Largest number of channel paths returned by one query
+MAX_QUERY_RESULTS = 1000
+
+# Largest number of channels one subscription pattern may match; a pattern
+# matching more after a reload is cut off at this many channels
+MAX_PATTERN_CHANNELS = 256
+
+# Largest number of subscription patterns per client
+MAX_CLIENT_PATTERNS = 32
+
+# Characters that make a pattern segment a wildcard
+WILDCARD_CHARACTERS = frozenset('*?[')
+
+# struct format of one element of each MSR channel type (little-endian)
+CHANNEL_TYPES = {
+    'TDBL': 'd',
+    'TFLT': 'f',
+    'TSGL': 'f',
+    'TCHAR': 'b',
+    'TUCHAR': 'B',
+    'TSHORT': 'h',
+    'TUSHORT': 'H',
+    'TINT': 'i',
+    'TUINT': 'I',
+    'TLINT': 'q',
+    'TULINT': 'Q',
+    'TBOOL': '?'
+}
+
+# Value fields of a data element, one per subscribed channel
+FIELD_PATTERN = re.compile(rb'<F\b[^>]*>')
+
+
+class _LimitReached(Exception):
+    """Stops a trie walk once enough matches were found."""
+
+
+class RadixNode:
+    """Node of the compressed channel trie."""
+
+    __slots__ = ('edges', 'path')
+
+    def __init__(self):
+        self.edges = {}  # first segment of the edge -> (segments of the edge, child node)
+        self.path = None  # Full channel path if a channel ends here
+
+
+def split_path(path):
+    """Split a channel path or pattern into its segments."""
+    return tuple(segment for segment in path.split('/') if segment)
+
+
+def normalize_pattern(pattern):
+    """
+    Validate a channel pattern and return its segments.
+
+    Args:
+        pattern: Channel path or pattern, e.g. '/Line1/Motor/*/Current'
+
+    Returns:
+        tuple: The pattern's segments
+
+    Raises:
+        ValueError: If the pattern is not an absolute path
+    """
+    if not isinstance(pattern, str) or not pattern.startswith('/'):
+        raise ValueError(f"Channel patterns must be absolute paths: {pattern!r}")
+    segments = split_path(pattern)
+    if pattern.endswith('/'):
+        segments += ('**',)
+    return segments
+
+
+class ChannelIndex:
+    """
+    Channels of one server indexed by path and in a compressed prefix trie.
+    """
+
+    def __init__(self):
+        self.channels = {}  # path -> attributes as reported by the server
+        self.paths_by_index = {}  # server index -> path
+        self.root = RadixNode()
+        self.loaded_at = None
+
+    def load(self, entries):
+        """
+        Replace the index with a freshly read channel list.
+
+        Args:
+            entries: One attribute dictionary per channel, each with a 'path'
+        """
+        self.channels = {}
+        self.paths_by_index = {}
+        self.root = RadixNode()
+        for attributes in entries:
+            path = attributes.get('path')
+            if path and path not in self.channels:
+                self.channels[path] = attributes
+                if 'index' in attributes:
+                    self.paths_by_index[attributes['index']] = path
+                self._insert(split_path(path), path)
+        self.loaded_at = time.time()
+
+    def _insert(self, segments, path):
+        node = self.root
+        while segments:
+            edge = node.edges.get(segments[0])
+            if edge is None:
+                child = RadixNode()
+                node.edges[segments[0]] = (segments, child)
+                node = child
+                break
+
+            label, child = edge
+            common = 0
+            while common < min(len(label), len(segments)) and label[common] == segments[common]:
+                common += 1
+
+            if common < len(label):
+                # Split the edge where the new path branches off
+                middle = RadixNode()
+                middle.edges[label[common]] = (label[common:], child)
+                node.edges[segments[0]] = (label[:common], middle)
+                child = middle
+
+            node = child
+            segments = segments[common:]
+        node.path = path
+
+    def get(self, path):
+        """Return the attributes of a channel, or None if unknown."""
+        return self.channels.get(path)
+
+    def match(self, pattern, limit=None):
+        """
+        Return the channel paths matching a pattern.
+
+        Args:
+            pattern: Channel path or pattern (see the module docstring)
+            limit: Stop after this many matches
+
+        Returns:
+            list: Matching channel paths
+        """
+        segments = normalize_pattern(pattern)
+        matches = {}
+        try:
+            self._match_node(self.root, segments, 0, matches, limit)
+        except _LimitReached:
+            pass
+        return list(matches)
+
+    def _add(self, path, matches, limit):
+        matches[path] = None
+        if limit is not None and len(matches) >= limit:
+            raise _LimitReached
+
+    def _collect(self, node, matches, limit):
+        """Add every channel at or below a node."""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.path is not None:
+                self._add(node.path, matches, limit)
+            stack.extend(child for _, child in node.edges.values())
+
+    def _match_node(self, node, pattern, position, matches, limit):
+        if position == len(pattern):
+            if node.path is not None:
+                self._add(node.path, matches, limit)
+            return
+
+        segment = pattern[position]
+        if segment == '**':
+            if position == len(pattern) - 1:
+                self._collect(node, matches, limit)
+                return
+            # Match no segment here, or consume segments along every edge
+            self._match_node(node, pattern, position + 1, matches, limit)
+            for label, child in node.edges.values():
+                self._match_edge(label, 1, child, pattern, position, matches, limit)
+            return
+
+        if WILDCARD_CHARACTERS.isdisjoint(segment):
+            edge = node.edges.get(segment)
+            if edge is not None:
+                self._match_edge(edge[0], 1, edge[1], pattern, position + 1, matches, limit)
+            return
+
+        for label, child in node.edges.values():
+            if fnmatchcase(label[0], segment):
+                self._match_edge(label, 1, child, pattern, position + 1, matches, limit)
+
+    def _match_edge(self, label, offset, child, pattern, position, matches, limit):
+        """Match the pattern against the rest of an edge, from segment ``offset``."""
+        if offset == len(label):
+            self._match_node(child, pattern, position, matches, limit)
+            return
+        if position == len(pattern):
+            return
+
+        segment = pattern[position]
+        if segment == '**':
+            if position == len(pattern) - 1:
+                self._collect(child, matches, limit)
+                return
+            self._match_edge(label, offset, child, pattern, position + 1, matches, limit)
+            self._match_edge(label, offset + 1, child, pattern, position, matches, limit)
+        elif segment == label[offset] or (not WILDCARD_CHARACTERS.isdisjoint(segment)
+                                          and fnmatchcase(label[offset], segment)):
+            self._match_edge(label, offset + 1, child, pattern, position + 1, matches, limit)
+
+    def expand(self, patterns):
+        """
+        Expand patterns into the server indices of the matching channels.
+
+        Args:
+            patterns: Iterable of channel patterns
+
+        Returns:
+            set: Server indices of all matching channels
+        """
+        indices = set()
+        for pattern in patterns:
+            for path in self.match(pattern, MAX_PATTERN_CHANNELS):
+                index = self.channels[path].get('index')
+                if index is not None:
+                    indices.add(index)
+        return indices
+
+
+@lru_cache(maxsize=4096)
+def channel_group_name(server_group, path):
+    """
+    Return the channel layer group of the subscribers of a channel.
+
+    Group names cannot contain slashes, so the path is hashed.
+
+    Args:
+        server_group: The server's WebSocket group
+        path: Channel path
+
+    Returns:
+        str: The group name
+    """
+    return f"{server_group}.channel.{hashlib.sha1(path.encode()).hexdigest()[:20]}"
+
+
+def format_indices(indices):
+    """Format channel indices for the channels attribute of an MSR command."""
+    return ','.join(sorted(
+        indices,
+        key=lambda index: (not index.isdigit(), int(index) if index.isdigit() else 0, index)
+    ))
+
+
+def decode_value(attributes, data):
+    """
+    Decode the newest value of a channel from the d attribute of a field.
+
+    Args:
+        attributes: The channel's attributes, with its type in 'typ'
+        data: The field's d attribute, Base64 coded binary values
+
+    Returns:
+        float: The last element of the field, or None if it cannot be decoded
+    """
+    element = CHANNEL_TYPES.get(attributes.get('typ', 'TDBL'))
+    if element is None:
+        return None
+    try:
+        raw = base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        # Servers not asked for Base64 send the values as text
+        try:
+            return float(data.rsplit(',', 1)[-1])
+        except ValueError:
+            return None
+
+    size = struct.calcsize('<' + element)
+    if len(raw) < size:
+        return None
+    return float(struct.unpack_from('<' + element, raw, len(raw) - len(raw) % size - size)[0])
+
+
+def decode_fields(index, message):
+    """
+    Decode the per-channel values of a data element.
+
+    Args:
+        index: The server's ChannelIndex
+        message: A complete ``<data>`` element as bytes
+
+    Returns:
+        list: (path, server index, value) per field of a known channel, in
+            document order
+    """
+    values = []
+    for match in FIELD_PATTERN.finditer(message):
+        field = parse_attributes(match.group(0))
+        path = index.paths_by_index.get(field.get('c'))
+        if path is None or 'd' not in field:
+            continue
+        value = decode_value(index.channels[path], field['d'])
+        if value is not None:
+            values.append((path, field['c'], value))
+    return values
+
+
+def query_channels(server_id, pattern, limit=MAX_QUERY_RESULTS):
+    """
+    Find the channels of a server matching a pattern.
+
+    Args:
+        server_id: The server whose channels are searched
+        pattern: Channel path or pattern
+        limit: Maximum number of channels returned, capped at MAX_QUERY_RESULTS
+
+    Returns:
+        dict: 'server', 'pattern', 'loaded_at' and the matching 'channels'
+            (attributes per channel)
+    """
+    from .msr_protocol import get_server
+
+    index = get_server(server_id)['channel_index']
+    limit = max(1, min(int(limit), MAX_QUERY_RESULTS))
+    return {
+        'server': server_id,
+        'pattern': pattern,
+        'loaded_at': index.loaded_at,
+        'channels': [index.channels[path] for path in index.match(pattern, limit)]
+    }
+
+
+async def load_channel_index(server_id):
+    """
+    Read a server's channel list into its index and re-expand the subscriptions.
+
+    Runs on every new connection and whenever the server announces a reload.
+
+    Args:
+        server_id: The server whose channels are read
+    """
+    from .msr_protocol import get_parameter_client, get_server
+    from .parameters import ParameterError
+
+    server = get_server(server_id)
+    try:
+        entries = await get_parameter_client(server_id).list_channels()
+    except ParameterError as e:
+        logger.error(f"Failed to read the channel list of {server_id}: {e}")
+        return
+
+    previous = {
+        pattern: server['channel_index'].match(pattern, MAX_PATTERN_CHANNELS)
+        for pattern in server['channel_patterns']
+    }
+    server['channel_index'].load(entries)
+    logger.info(f"Indexed {len(entries)} channels of {server_id}")
+
+    # The server forgets its subscriptions on a new connection or a reload
+    server['subscribed_channels'] = set()
+    await sync_channel_subscriptions(server_id)
+
+    # Tell clients whose patterns now match other channels
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    updates = {}
+    for pattern, consumers in server['channel_patterns'].items():
+        paths = server['channel_index'].match(pattern, MAX_PATTERN_CHANNELS)
+        if paths != previous[pattern]:
+            for consumer in consumers:
+                updates.setdefault(consumer, {})[pattern] = paths
+
+    for consumer, patterns in updates.items():
+        await channel_layer.send(consumer, {
+            'type': 'channels_expanded',
+            'server': server_id,
+            'patterns': patterns
+        })
+
+
+async def sync_channel_subscriptions(server_id):
+    """
+    Subscribe the server to the channels matched by the clients' patterns.
+
+    Sends one subscribe command for newly matched channels and one unsubscribe
+    command for channels no pattern matches any more. Nothing is sent while
+    disconnected; the next connection subscribes to everything again.
+
+    Args:
+        server_id: The server whose subscriptions are updated
+    """
+    from .msr_protocol import get_server, send_command
+
+    server = get_server(server_id)
+    if server['socket'] is None:
+        return
+
+    wanted = server['channel_index'].expand(server['channel_patterns'])
+    subscribed = server['subscribed_channels']
+    added = wanted - subscribed
+    removed = subscribed - wanted
+
+    commands = b''
+    if added:
+        commands += f'<xsad channels="{format_indices(added)}" coding="Base64"/>\n'.encode()
+    if removed:
+        commands += f'<xsod channels="{format_indices(removed)}"/>\n'.encode()
+    if commands and await send_command(server_id, commands):
+        server['subscribed_channels'] = wanted
+        logger.debug(f"Channel subscriptions of {server_id}: +{len(added)} -{len(removed)}")
+
+
+async def subscribe_channels(server_id, consumer, patterns):
+    """
+    Add a client's channel patterns.
+
+    Args:
+        server_id: The server the client watches
+        consumer: The client's channel layer name
+        patterns: List of channel patterns
+
+    Returns:
+        dict: pattern -> matching channel paths
+
+    Raises:
+        ValueError: If a pattern is invalid, names no segment, matches more
+            than MAX_PATTERN_CHANNELS channels, or the client would have
+            more than MAX_CLIENT_PATTERNS patterns
+    """
+    from .msr_protocol import get_server
+
+    server = get_server(server_id)
+    index = server['channel_index']
+    for pattern in patterns:
+        segments = normalize_pattern(pattern)
+        if all(not WILDCARD_CHARACTERS.isdisjoint(segment) for segment in segments):
+            raise ValueError(f"Channel pattern {pattern!r} must name at least one path segment")
+        if len(index.match(pattern, MAX_PATTERN_CHANNELS + 1)) > MAX_PATTERN_CHANNELS:
+            raise ValueError(f"Channel pattern {pattern!r} matches more than {MAX_PATTERN_CHANNELS} channels")
+
+    current = {pattern for pattern, consumers in server['channel_patterns'].items() if consumer in consumers}
+    if len(current.union(patterns)) > MAX_CLIENT_PATTERNS:
+        raise ValueError(f"At most {MAX_CLIENT_PATTERNS} channel patterns can be subscribed")
+
+    for pattern in patterns:
+        server['channel_patterns'].setdefault(pattern, set()).add(consumer)
+    await sync_channel_subscriptions(server_id)
+
+    return {pattern: index.match(pattern, MAX_PATTERN_CHANNELS) for pattern in patterns}
+
+
+async def unsubscribe_channels(server_id, consumer, patterns=None):
+    """
+    Remove a client's channel patterns.
+
+    Args:
+        server_id: The server the client watches
+        consumer: The client's channel layer name
+        patterns: Patterns to remove (all of the client's patterns if None)
+    """
+    from .msr_protocol import get_server
+
+    server = get_server(server_id)
+    channel_patterns = server['channel_patterns']
+    for pattern in list(channel_patterns if patterns is None else patterns):
+        consumers = channel_patterns.get(pattern)
+        if consumers is None:
+            continue
+        consumers.discard(consumer)
+        if not consumers:
+            del channel_patterns[pattern]
+    await sync_channel_subscriptions(server_id)
@@ -0,0 +1,479 @@
+"""
+Service-free channel layer for multi-process deployments on one host.
+
+``UnixSocketChannelLayer`` lets the ASGI worker processes on one machine reach
+each other without Redis or any other external service. Every process binds a
+Unix datagram socket in a private directory (see utils/runtime_dir.py):
+whoever can write to it can send messages to any consumer, so the directory
+must be accessible only to the user running the service. Channels created by
+``new_channel()`` carry the id of the process that owns them, so ``send()``
+can route them directly; ``group_send()`` delivers to local group members and
+forwards the message once to every other process, which delivers it to its
+own members.
+
+Messages for the same peer are serialized when they are sent and written as
+one datagram per event loop iteration of the loop the socket is read on;
+messages sent from other loops (e.g. through async_to_sync) are written at
+once, as those loops may be gone before the next iteration. A datagram a
+peer cannot take yet (its receive buffer is full) waits in a per-peer backlog
+of at most ``max_pending_datagrams`` and is written when the peer's socket
+becomes writable; messages are only dropped when that backlog overflows or
+the peer has exited. Per-channel queues are bounded by the usual ``capacity``
+and ``channel_capacity`` options. Messages cross process boundaries as JSON, so
+they must contain only JSON-serializable values, and delivered messages are
+shared between local receivers and must be treated as read-only.
+"""
+import asyncio
+import atexit
+import collections
+import json
+import os
+import random
+import socket
+import string
+import time
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+from .utils.runtime_dir import ensure_private_directory, get_runtime_dir
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger, get_rate_limited_logger
+    logger = get_logger()
+    # Per-sample and repeating messages, logged at most once per interval
+    limited_logger = get_rate_limited_logger()
+except ImportError:
+    import logging
+    logger = limited_logger = logging.getLogger(__name__)
+
+# Receive buffer requested for each socket (capped by net.core.rmem_max)
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """
+    Channel layer connecting the processes on one host over Unix datagram sockets.
+    """
+
+    extensions = ("groups", "flush")
+
+    def __init__(
+        self,
+        socket_dir=None,
+        expiry=60,
+        capacity=100,
+        channel_capacity=None,
+        max_datagram_size=65536,
+        max_pending_datagrams=1024,
+        peer_refresh_interval=1.0,
+        **kwargs,
+    ):
+        super().__init__(
+            expiry=expiry,
+            capacity=capacity,
+            channel_capacity=channel_capacity,
+            **kwargs,
+        )
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.socket_dir = os.fspath(socket_dir or os.path.join(get_runtime_dir(), 'channels'))
+        self.max_datagram_size = max_datagram_size
+        self.max_pending_datagrams = max_pending_datagrams
+        self.peer_refresh_interval = peer_refresh_interval
+
+        self.node_id = "{}-{}".format(
+            os.getpid(),
+            "".join(random.choice(string.ascii_letters) for i in range(6)),
+        )
+        self.socket_path = os.path.join(self.socket_dir, f"{self.node_id}.sock")
+
+        self.channels = {}
+        self.groups = {}
+
+        self._socket = None
+        self._loop = None  # loop the socket is read on
+        self._outbox = {}  # peer path -> serialized entries
+        self._flush_handle = None
+        # peer path -> (socket connected to the peer, deque of (datagram, message count))
+        self._backlogs = {}
+        self._peers = []
+        self._peers_refreshed = 0.0
+
+        self.stats = {
+            'messages_sent': 0,
+            'messages_received': 0,
+            'datagrams_sent': 0,
+            'datagrams_received': 0,
+            'datagrams_backlogged': 0,
+            'dropped': 0,
+        }
+        # channel -> messages dropped because its queue was full
+        self.channel_drops = {}
+
+    # Socket management
+
+    def _ensure_socket(self):
+        """
+        Bind this process's socket and read from it on the running loop.
+
+        The socket is read on the first loop that uses the layer, and moved
+        to the running loop if that loop has been closed (e.g. a temporary
+        async_to_sync loop).
+        """
+        if self._socket is None:
+            ensure_private_directory(self.socket_dir)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+            except OSError:
+                pass
+            sock.bind(self.socket_path)
+            self._socket = sock
+            atexit.register(self._unlink_socket)
+
+        if self._loop is None or self._loop.is_closed():
+            # A flush scheduled on a closed loop never runs
+            self._flush_handle = None
+            self._loop = asyncio.get_running_loop()
+            self._loop.add_reader(self._socket.fileno(), self._on_readable)
+            # Backlogs were being written by the closed loop
+            for path in list(self._backlogs):
+                self._loop.add_writer(self._backlogs[path][0].fileno(), self._on_writable, path)
+            if self._outbox:
+                self._flush()
+
+    def _unlink_socket(self):
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    def _get_peers(self):
+        """Return the socket paths of the other processes, refreshed periodically."""
+        now = time.monotonic()
+        if now - self._peers_refreshed > self.peer_refresh_interval:
+            self._peers = [
+                os.path.join(self.socket_dir, name)
+                for name in os.listdir(self.socket_dir)
+                if name.endswith('.sock') and name != f"{self.node_id}.sock"
+            ]
+            self._peers_refreshed = now
+        return self._peers
+
+    def _node_path(self, channel):
+        """Return the socket path of the process owning a specific channel, or None if local."""
+        if "!" not in channel:
+            return None
+        node_id = channel[:channel.find("!")].rsplit(".", 1)[-1]
+        if node_id == self.node_id:
+            return None
+        return os.path.join(self.socket_dir, f"{node_id}.sock")
+
+    # Local delivery
+
+    def _get_queue(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def _deliver(self, channel, message):
+        """Queue a message for a local channel, raising ChannelFull at capacity."""
+        try:
+            self._get_queue(channel).put_nowait((time.time() + self.expiry, message))
+        except asyncio.QueueFull:
+            self.stats['dropped'] += 1
+            self.channel_drops[channel] = self.channel_drops.get(channel, 0) + 1
+            raise ChannelFull(channel)
+
+    def _deliver_group(self, group, message):
+        """Queue a message for every local member of a group, skipping full channels."""
+        for channel in self.groups.get(group, ()):
+            try:
+                self._deliver(channel, message)
+            except ChannelFull:
+                pass
+
+    def _on_readable(self):
+        """Read and dispatch every datagram waiting on the socket."""
+        while True:
+            try:
+                data = self._socket.recv(self.max_datagram_size)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                limited_logger.error("Channel layer socket error: %s", e)
+                return
+
+            self.stats['datagrams_received'] += 1
+            try:
+                entries = json.loads(data)
+            except ValueError:
+                self.stats['dropped'] += 1
+                continue
+
+            for kind, target, message in entries:
+                self.stats['messages_received'] += 1
+                if kind == 'g':
+                    self._deliver_group(target, message)
+                else:
+                    try:
+                        self._deliver(target, message)
+                    except ChannelFull:
+                        pass
+
+    # Batched remote delivery
+
+    @staticmethod
+    def _encode_entry(kind, target, message):
+        """
+        Serialize an entry for other processes.
+
+        Raises:
+            TypeError: If the message is not JSON-serializable
+        """
+        return json.dumps([kind, target, message], separators=(',', ':')).encode()
+
+    def _enqueue_remote(self, path, entry):
+        """Add a serialized entry to the batch for a peer and schedule a flush."""
+        if asyncio.get_running_loop() is not self._loop:
+            # This loop (e.g. of async_to_sync, in another thread) may be
+            # closed before a scheduled flush runs; send the entry at once,
+            # and leave it to the socket's loop if the peer is behind
+            data = b'[' + entry + b']'
+            if path not in self._backlogs and len(data) <= self.max_datagram_size:
+                try:
+                    self._socket.sendto(data, path)
+                    self.stats['datagrams_sent'] += 1
+                    self.stats['messages_sent'] += 1
+                    return
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except (ConnectionRefusedError, FileNotFoundError):
+                    self._peer_gone(path, 1)
+                    return
+            self._loop.call_soon_threadsafe(self._send_entries, path, [entry])
+            return
+        self._outbox.setdefault(path, []).append(entry)
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        """Send the batched entries, one datagram per peer where they fit."""
+        self._flush_handle = None
+        outbox, self._outbox = self._outbox, {}
+        for path, entries in outbox.items():
+            self._send_entries(path, entries)
+
+    def _send_entries(self, path, entries):
+        data = b'[' + b','.join(entries) + b']'
+        if len(data) > self.max_datagram_size:
+            if len(entries) == 1:
+                limited_logger.warning("Dropping channel layer message of %d bytes (limit %d)",
+                                       len(data), self.max_datagram_size)
+                self.stats['dropped'] += 1
+                return
+            middle = len(entries) // 2
+            self._send_entries(path, entries[:middle])
+            self._send_entries(path, entries[middle:])
+            return
+
+        if path in self._backlogs:
+            # Keep the order behind the datagrams already waiting
+            self._add_to_backlog(path, data, len(entries))
+            return
+
+        try:
+            self._socket.sendto(data, path)
+            self.stats['datagrams_sent'] += 1
+            self.stats['messages_sent'] += len(entries)
+        except (BlockingIOError, InterruptedError):
+            # The peer's receive buffer is full; wait until it can take more
+            try:
+                self._start_backlog(path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                self._peer_gone(path, len(entries))
+                return
+            self._add_to_backlog(path, data, len(entries))
+        except (ConnectionRefusedError, FileNotFoundError):
+            self._peer_gone(path, len(entries))
+
+    def _start_backlog(self, path):
+        """
+        Open a socket connected to a peer and wait for it to become writable.
+
+        Only a connected datagram socket reports when the peer's receive
+        buffer has room again; the shared unconnected socket is always
+        writable.
+
+        Raises:
+            ConnectionRefusedError: If the peer has exited
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            raise
+        self._backlogs[path] = (sock, collections.deque())
+        self._loop.add_writer(sock.fileno(), self._on_writable, path)
+
+    def _add_to_backlog(self, path, data, count):
+        """Queue a datagram for a peer that is behind, dropping it if the backlog is full."""
+        pending = self._backlogs[path][1]
+        if len(pending) >= self.max_pending_datagrams:
+            limited_logger.warning("Channel layer peer %s is not keeping up, dropping messages", path)
+            self.stats['dropped'] += count
+            return
+        pending.append((data, count))
+        self.stats['datagrams_backlogged'] += 1
+
+    def _on_writable(self, path):
+        """Write a peer's backlog until it is empty or the peer is full again."""
+        sock, pending = self._backlogs[path]
+        while pending:
+            data, count = pending[0]
+            try:
+                sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                return
+            except (ConnectionRefusedError, FileNotFoundError):
+                self._peer_gone(path, 0)
+                return
+            pending.popleft()
+            self.stats['datagrams_sent'] += 1
+            self.stats['messages_sent'] += count
+        self._close_backlog(path)
+
+    def _close_backlog(self, path):
+        """Stop waiting for a peer and return its undelivered message count."""
+        sock, pending = self._backlogs.pop(path)
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.remove_writer(sock.fileno())
+        sock.close()
+        return sum(count for _, count in pending)
+
+    def _peer_gone(self, path, count):
+        """Drop the messages for a peer that has exited and remove its stale socket."""
+        if path in self._backlogs:
+            count += self._close_backlog(path)
+        self.stats['dropped'] += count
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self._peers_refreshed = 0.0
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        """
+        Send a message onto a (general or specific) channel.
+        """
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+
+        self._ensure_socket()
+        path = self._node_path(channel)
+        if path is None:
+            self._deliver(channel, message)
+        else:
+            self._enqueue_remote(path, self._encode_entry('c', channel, message))
+
+    async def receive(self, channel):
+        """
+        Receive the first unexpired message that arrives on the channel.
+        """
+        self.require_valid_channel_name(channel)
+        self._ensure_socket()
+
+        queue = self._get_queue(channel)
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.time():
+                    return message
+        finally:
+            if queue.empty():
+                self.channels.pop(channel, None)
+
+    async def new_channel(self, prefix="specific."):
+        """
+        Returns a new channel name owned by this process.
+        """
+        self._ensure_socket()
+        return "{}{}!{}".format(
+            prefix,
+            self.node_id,
+            "".join(random.choice(string.ascii_letters) for i in range(12)),
+        )
+
+    async def flush(self):
+        self.channels = {}
+        self.groups = {}
+        self._outbox = {}
+        for path in list(self._backlogs):
+            self._close_backlog(path)
+
+    async def close(self):
+        if self._socket is not None:
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.remove_reader(self._socket.fileno())
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            for path in list(self._backlogs):
+                self.stats['dropped'] += self._close_backlog(path)
+            self._loop = None
+            self._socket.close()
+            self._socket = None
+            self._unlink_socket()
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        """
+        Adds a channel owned by this process to a group.
+        """
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self._ensure_socket()
+        self.groups.setdefault(group, {})[channel] = time.time()
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        group_channels = self.groups.get(group)
+        if group_channels:
+            group_channels.pop(channel, None)
+            if not group_channels:
+                self.groups.pop(group, None)
+
+    async def group_send(self, group, message):
+        """
+        Send a message to every member of a group in all processes on the host.
+        """
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        self._ensure_socket()
+
+        peers = self._get_peers()
+        entry = self._encode_entry('g', group, message) if peers else None
+        self._deliver_group(group, message)
+        for path in peers:
+            self._enqueue_remote(path, entry)
+
+    async def group_send_local(self, group, message):
+        """
+        Send a message to the members of a group in this process only.
+
+        Used when every process receives the same data independently, e.g.
+        frames relayed from the shared-memory ring.
+        """
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        self._deliver_group(group, message)
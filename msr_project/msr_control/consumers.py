@@ -5,20 +5,206 @@ This module handles WebSocket connections for real-time data streaming
 and bidirectional communication with the frontend.
 """
 import json
+import math
 import asyncio
+import contextvars
+import time
 import traceback
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
 from django.conf import settings
 
+from . import instrumentation, load_shedding, snapshot, system_sampler
+from .binary_frames import encode_samples
+from .channel_index import channel_group_name
+from .metrics import register_consumer, unregister_consumer
+from .msr_protocol import DEFAULT_SERVER, servers
+from .ratelimit import check_rate_limit, create_connection_bucket, throttle_stats
+from .tasks import uses_shared_ingest
+from .ws_auth import user_group_name
+
 # Try to import the logger, but don't fail if it's not available yet
 try:
-    from .utils.logger import get_logger
+    from .utils.logger import get_logger, get_rate_limited_logger
     logger = get_logger()
+    # Per-sample and repeating messages, logged at most once per interval
+    limited_logger = get_rate_limited_logger()
 except ImportError:
     import logging
-    logger = logging.getLogger(__name__)
+    logger = limited_logger = logging.getLogger(__name__)
+
+# Default command execution settings
+DEFAULT_COMMAND_SETTINGS = {
+    'max_concurrent': 4,  # commands running at once per client
+    'max_pending': 32  # commands running or waiting per client
+}
+
+# action -> handler method, message fields passed to it, roles allowed
+# (None for everyone), the error shown to other roles and whether the command
+# needs this process's own EtherLab connection ('connection'); those are
+# refused in workers of the shared-memory ingest mode
+COMMAND_HANDLERS = {
+    'get_status': {
+        'handler': 'handle_status_request',
+        'fields': (),
+        'roles': None
+    },
+    'align': {
+        'handler': 'handle_alignment_request',
+        'fields': ('parameters',),
+        'roles': None
+    },
+    'spectrum': {
+        'handler': 'handle_spectrum_request',
+        'fields': ('parameters',),
+        'roles': None
+    },
+    'calibrate': {
+        'handler': 'handle_calibration',
+        'fields': ('parameters',),
+        'roles': ('calibrator', 'admin'),
+        'permission_error': 'Calibration requires Calibrator or Admin role.'
+    },
+    'autocal': {
+        'handler': 'handle_autocal',
+        'fields': ('command', 'parameters'),
+        'roles': ('calibrator', 'admin'),
+        'permission_error': 'Auto-calibration requires Calibrator or Admin role.'
+    },
+    'find_channels': {
+        'handler': 'handle_channel_query',
+        'fields': ('parameters',),
+        'roles': None,
+        'connection': True
+    },
+    'subscribe_channels': {
+        'handler': 'handle_channel_subscription',
+        'fields': ('parameters',),
+        'roles': None,
+        'connection': True
+    },
+    'unsubscribe_channels': {
+        'handler': 'handle_channel_unsubscription',
+        'fields': ('parameters',),
+        'roles': None,
+        'connection': True
+    },
+    'get_parameters': {
+        'handler': 'handle_parameter_query',
+        'fields': ('parameters',),
+        'roles': ('calibrator', 'admin'),
+        'permission_error': 'Browsing parameters requires Calibrator or Admin role.',
+        'connection': True
+    },
+    'set_latency_budget': {
+        'handler': 'handle_latency_budget',
+        'fields': ('parameters',),
+        'roles': None
+    },
+    'set_point_budget': {
+        'handler': 'handle_point_budget',
+        'fields': ('parameters',),
+        'roles': None
+    },
+    'admin_action': {
+        'handler': 'handle_admin_action',
+        'fields': ('command', 'parameters'),
+        'roles': ('admin',),
+        'permission_error': 'This action requires Admin role.'
+    },
+}
+
+# Default batching of broadcast samples; clients declare their latency
+# budget with ?latency_ms= on connect or the set_latency_budget action
+DEFAULT_BATCHING_SETTINGS = {
+    'default_latency_ms': 0,  # 0 sends every sample as its own message
+    'max_latency_ms': 1000,
+    'max_batch': 1000  # samples per message before flushing early
+}
+
+# Default limits of the point budget clients declare with set_point_budget:
+# the number of points a chart shows per channel across a time window
+DEFAULT_POINT_BUDGET_SETTINGS = {
+    'max_points': 10000,
+    'max_window_s': 3600
+}
+
+# Default values of missing message fields
+FIELD_DEFAULTS = {
+    'command': str,
+    'parameters': dict
+}
+
+# Sent once when a client starts being throttled; precomputed to keep rejection cheap
+THROTTLED_RESPONSE = json.dumps({
+    'type': 'error',
+    'error': 'Rate limit exceeded; messages are being dropped'
+})
+
+# request_id of the command being handled, echoed in its responses
+current_request_id = contextvars.ContextVar('current_request_id', default=None)
+
+
+def get_batching_settings():
+    """Return the batching settings with overrides from MSR_WS_BATCHING applied."""
+    batching_settings = DEFAULT_BATCHING_SETTINGS.copy()
+    batching_settings.update(getattr(settings, 'MSR_WS_BATCHING', {}))
+    return batching_settings
+
+
+def pack_samples(samples):
+    """
+    Pack broadcast samples into one column-oriented message.
+
+    Scalar fields become arrays with one entry per sample (None where a sample
+    lacks the field); dictionary fields such as connection_state are sent once
+    with their latest value.
+
+    Args:
+        samples: List of filtered data dictionaries, oldest first
+
+    Returns:
+        dict: Message with 'count', 'timestamps', 'columns' and 'latest'
+    """
+    columns = {}
+    latest = {}
+    for index, sample in enumerate(samples):
+        for key, value in sample.items():
+            if isinstance(value, dict):
+                latest[key] = value
+                continue
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = [None] * index
+            column.append(value)
+        for column in columns.values():
+            if len(column) <= index:
+                column.append(None)
+
+    return {
+        'type': 'data_batch',
+        'count': len(samples),
+        'timestamps': columns.pop('timestamp', [None] * len(samples)),
+        'columns': columns,
+        'latest': latest
+    }
+
+
+def get_point_budget_settings():
+    """Return the point budget limits with overrides from MSR_WS_POINT_BUDGET applied."""
+    point_budget_settings = DEFAULT_POINT_BUDGET_SETTINGS.copy()
+    point_budget_settings.update(getattr(settings, 'MSR_WS_POINT_BUDGET', {}))
+    return point_budget_settings
+
+
+def get_command_settings():
+    """Return the command settings with overrides from MSR_WS_COMMANDS applied."""
+    command_settings = DEFAULT_COMMAND_SETTINGS.copy()
+    command_settings.update(getattr(settings, 'MSR_WS_COMMANDS', {}))
+    return command_settings
+
 
 class MSRConsumer(AsyncWebsocketConsumer):
     """
@@ -35,8 +221,39 @@ class MSRConsumer(AsyncWebsocketConsumer):
         This method is called when a client attempts to establish a WebSocket connection.
         It performs authentication checks and sets up the connection.
         """
+        # Commands run as background tasks, limited per client
+        self.command_tasks = set()
+        self.command_slots = asyncio.Semaphore(get_command_settings()['max_concurrent'])
+
+        # Channel patterns the client subscribed to -> matching channel paths;
+        # samples of subscribed channels are only sent for these paths
+        self.channel_patterns = {}
+        self.channel_paths = set()
+
+        # Broadcast samples are batched within the client's latency budget
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.pending_samples = []
+        self.flush_task = None
+        # Shortest sample time between samples of a channel, from the client's
+        # point budget (0 sends every sample), and the sample time of the last
+        # sample sent per channel; when each channel was last sent while
+        # load shedding lowers the operator rate
+        self.sample_interval = 0.0
+        self.last_sample_time = {}
+        self.last_sent_at = {}
+        # Stage -> mark of the latency summary last sent to this client
+        self.latency_marks = {}
+        self.set_latency_budget(query.get('latency_ms', [None])[0])
+        # ?format=binary sends samples as binary frames (see binary_frames.py)
+        self.binary_samples = query.get('format', [None])[0] == 'binary'
+
+        # The EtherLab server this client watches (ws/msr_data/<server>/)
+        self.server_id = self.scope['url_route']['kwargs'].get('server', DEFAULT_SERVER)
+        self.server = servers.get(self.server_id)
+
         self.room_name = "msr_data"
-        self.room_group_name = f"msr_{self.room_name}"
+        # Group used by send_data_to_websocket for this server
+        self.room_group_name = self.server['group'] if self.server is not None else None
         self.user = self.scope["user"]
 
         # Initialize user role
@@ -49,9 +266,19 @@ class MSRConsumer(AsyncWebsocketConsumer):
             await self.close(code=4001)  # Custom close code for authentication failure
             return
 
+        if self.server is None:
+            logger.warning(f"Rejected WebSocket connection for unknown server {self.server_id}")
+            await self.close(code=4004)  # Custom close code for unknown server
+            return
+
         try:
-            # Get user role
-            self.user_role = await self.get_user_role()
+            # Get user role, resolved by the cached auth middleware when available
+            self.user_role = self.scope.get('user_role') or await self.get_user_role()
+
+            # Inbound messages are rate limited per connection and per role
+            self.rate_bucket = create_connection_bucket(self.user_role)
+            self.throttled = False
+            self.throttled_count = 0
 
             # Join the WebSocket group
             await self.channel_layer.group_add(
@@ -59,8 +286,16 @@ class MSRConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
 
+            # Join the user's group for role changes and revoked sessions
+            self.user_group_name = user_group_name(self.user.pk)
+            await self.channel_layer.group_add(
+                self.user_group_name,
+                self.channel_name
+            )
+
             # Accept the connection
             await self.accept()
+            register_consumer(self.channel_name, self.user_role, self.server_id)
 
             logger.info(f"WebSocket connection established for user {self.user.username} with role {self.user_role}")
 
@@ -68,7 +303,9 @@ class MSRConsumer(AsyncWebsocketConsumer):
             await self.send(text_data=json.dumps({
                 'type': 'connection_established',
                 'user': self.user.username,
-                'role': self.user_role
+                'role': self.user_role,
+                'server': self.server_id,
+                'load_level': load_shedding.describe()
             }))
 
         except Exception as e:
@@ -87,12 +324,33 @@ class MSRConsumer(AsyncWebsocketConsumer):
         Args:
             close_code: The code indicating why the connection was closed
         """
+        unregister_consumer(self.channel_name)
+
+        # Cancel the client's commands still in progress
+        for task in list(getattr(self, 'command_tasks', ())):
+            task.cancel()
+        if getattr(self, 'flush_task', None) is not None:
+            self.flush_task.cancel()
+
         try:
+            # Drop the client's channel subscriptions
+            if getattr(self, 'channel_patterns', None):
+                from .channel_index import unsubscribe_channels
+                await unsubscribe_channels(self.server_id, self.channel_name)
+                self.channel_patterns = {}
+                await self.update_channel_paths()
+
             # Leave the WebSocket group
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
+            if getattr(self, 'room_group_name', None):
+                await self.channel_layer.group_discard(
+                    self.room_group_name,
+                    self.channel_name
+                )
+            if hasattr(self, 'user_group_name'):
+                await self.channel_layer.group_discard(
+                    self.user_group_name,
+                    self.channel_name
+                )
 
             # Log the disconnection
             if hasattr(self, 'user') and self.user != AnonymousUser():
@@ -107,11 +365,27 @@ class MSRConsumer(AsyncWebsocketConsumer):
         """
         Handle incoming messages from WebSocket clients.
 
-        This method processes commands and actions from clients based on their roles.
+        Commands are looked up in COMMAND_HANDLERS, checked against the user's
+        role and run as background tasks, so a slow command does not hold up
+        the client's other messages. Responses echo the message's optional
+        'request_id' so clients can pipeline commands.
 
         Args:
             text_data: The JSON text data received from the client
         """
+        # Check the rate limits before spending any work on the message
+        limit = check_rate_limit(self.rate_bucket, self.user_role)
+        if limit is not None:
+            self.throttled_count += 1
+            if not self.throttled:
+                # Report the start of each throttled period only once
+                self.throttled = True
+                throttle_stats['throttled_clients'] += 1
+                logger.warning(f"Throttling user {self.user.username}: {limit} rate limit exceeded")
+                await self.send(text_data=THROTTLED_RESPONSE)
+            return
+        self.throttled = False
+
         try:
             # Parse the JSON data
             try:
@@ -126,53 +400,53 @@ class MSRConsumer(AsyncWebsocketConsumer):
 
             # Log the received action
             action = data.get('action')
-            logger.debug(f"Received action '{action}' from user {self.user.username}")
-
-            # Process based on user role
-            if action:
-                # Check permissions based on role
-                if action == 'calibrate':
-                    if not (self.user_role in ['calibrator', 'admin']):
-                        logger.warning(f"Permission denied: User {self.user.username} with role {self.user_role} attempted calibration")
-                        await self.send(text_data=json.dumps({
-                            'type': 'error',
-                            'error': 'Permission denied. Calibration requires Calibrator or Admin role.'
-                        }))
-                        return
-
-                    # Process calibration action
-                    await self.handle_calibration(data.get('parameters', {}))
-
-                elif action == 'admin_action':
-                    if self.user_role != 'admin':
-                        logger.warning(f"Permission denied: User {self.user.username} with role {self.user_role} attempted admin action")
-                        await self.send(text_data=json.dumps({
-                            'type': 'error',
-                            'error': 'Permission denied. This action requires Admin role.'
-                        }))
-                        return
-
-                    # Process admin action
-                    command = data.get('command', '')
-                    parameters = data.get('parameters', {})
-                    await self.handle_admin_action(command, parameters)
-
-                elif action == 'get_status':
-                    # Anyone can request status
-                    await self.handle_status_request()
+            request_id = data.get('request_id')
+            logger.debug("Received action '%s' from user %s", action, self.user.username)
 
-                else:
-                    logger.warning(f"Unknown action received: {action}")
-                    await self.send(text_data=json.dumps({
-                        'type': 'error',
-                        'error': f'Unknown action: {action}'
-                    }))
-            else:
+            if not action:
                 logger.warning(f"Received data without action from user {self.user.username}")
-                await self.send(text_data=json.dumps({
+                await self.send_response({
                     'type': 'error',
                     'error': 'No action specified'
-                }))
+                }, request_id)
+                return
+
+            spec = COMMAND_HANDLERS.get(action)
+            if spec is None:
+                logger.warning(f"Unknown action received: {action}")
+                await self.send_response({
+                    'type': 'error',
+                    'error': f'Unknown action: {action}'
+                }, request_id)
+                return
+
+            if spec.get('connection') and uses_shared_ingest():
+                await self.send_response({
+                    'type': 'error',
+                    'error': f'{action} is not available: the EtherLab connection runs in the ingest process'
+                }, request_id)
+                return
+
+            # Check permissions based on role
+            if spec['roles'] is not None and self.user_role not in spec['roles']:
+                logger.warning(f"Permission denied: User {self.user.username} with role {self.user_role} attempted {action}")
+                await self.send_response({
+                    'type': 'error',
+                    'error': f"Permission denied. {spec['permission_error']}"
+                }, request_id)
+                return
+
+            if len(self.command_tasks) >= get_command_settings()['max_pending']:
+                logger.warning(f"Rejected {action} from user {self.user.username}: too many commands in progress")
+                await self.send_response({
+                    'type': 'error',
+                    'error': 'Too many commands in progress'
+                }, request_id)
+                return
+
+            task = asyncio.get_running_loop().create_task(self.run_command(action, spec, data))
+            self.command_tasks.add(task)
+            task.add_done_callback(self.command_tasks.discard)
 
         except Exception as e:
             logger.error(f"Error processing WebSocket message: {str(e)}")
@@ -182,46 +456,303 @@ class MSRConsumer(AsyncWebsocketConsumer):
                 'error': 'Internal server error'
             }))
 
+    async def run_command(self, action, spec, data):
+        """
+        Run a command handler, waiting for one of the client's command slots.
+
+        Args:
+            action: The command's action name
+            spec: The command's entry in COMMAND_HANDLERS
+            data: The parsed message
+        """
+        # Responses sent by the handler pick up the request ID from the context
+        current_request_id.set(data.get('request_id'))
+        handler = getattr(self, spec['handler'])
+        arguments = [data.get(field, FIELD_DEFAULTS[field]()) for field in spec['fields']]
+
+        async with self.command_slots:
+            try:
+                await handler(*arguments)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Error handling {action} for user {self.user.username}")
+                await self.send_response({
+                    'type': 'error',
+                    'error': 'Internal server error'
+                })
+
+    async def send_response(self, payload, request_id=None):
+        """
+        Send a command response, echoing the command's request ID.
+
+        Args:
+            payload: The response dictionary
+            request_id: The request ID; defaults to that of the command being run
+        """
+        if request_id is None:
+            request_id = current_request_id.get()
+        if request_id is not None:
+            payload['request_id'] = request_id
+        await self.send(text_data=json.dumps(payload))
+
     async def send_data(self, event):
         """
         Send data to the WebSocket client.
 
         This method is called when data is broadcast to the WebSocket group.
-        It filters the data based on the user's role before sending.
+        It filters the data based on the user's role before sending. Samples
+        of subscribed channels are only sent if one of the client's channel
+        patterns matches them. Samples of a channel whose timestamp follows
+        the last one sent by less than the client's point budget allows are
+        skipped, so the budget thins out the data evenly however the samples
+        arrive; while load shedding lowers the operator rate, operators get
+        at most one sample per channel and operator_interval.
 
         Args:
             event: The event containing the data to send
         """
         try:
+            started = time.perf_counter()
             data = event.get('data', {})
 
+            # Samples of subscribed channels go to their subscribers' groups;
+            # drop those still queued after unsubscribing
+            if 'channel_index' in data and data.get('channel') not in self.channel_paths:
+                return
+
+            channel = data.get('channel')
+            timestamp = data.get('timestamp')
+            budgeted = self.sample_interval > 0 and isinstance(timestamp, (int, float))
+            if budgeted:
+                last = self.last_sample_time.get(channel)
+                # A timestamp going backwards (e.g. a restarted server) starts over
+                if last is not None and last <= timestamp < last + self.sample_interval:
+                    return
+
+            if self.user_role == 'operator' and load_shedding.level >= load_shedding.REDUCE_OPERATOR_RATE:
+                now = time.monotonic()
+                if now - self.last_sent_at.get(channel, 0.0) < load_shedding.policy['operator_interval']:
+                    load_shedding.stats['operator_skipped'] += 1
+                    return
+                self.last_sent_at[channel] = now
+
+            if budgeted:
+                self.last_sample_time[channel] = timestamp
+
             # Filter data based on user role if needed
-            filtered_data = await self.filter_data_by_role(data)
+            filtered_data = self.filter_data_by_role(data)
 
-            # Send data to WebSocket
-            await self.send(text_data=json.dumps({
-                'type': 'data',
-                'data': filtered_data
-            }))
+            if self.latency_budget <= 0:
+                # Send data to WebSocket
+                if self.binary_samples:
+                    await self.send(bytes_data=encode_samples([filtered_data]))
+                else:
+                    await self.send(text_data=json.dumps({
+                        'type': 'data',
+                        'data': filtered_data
+                    }))
+                instrumentation.record('send', started)
+                if 'received_at' in data:
+                    instrumentation.record_duration('delivery', time.time() - data['received_at'])
+                return
+
+            # Collect samples until the latency budget of the oldest one runs out
+            self.pending_samples.append(filtered_data)
+            if len(self.pending_samples) >= get_batching_settings()['max_batch']:
+                await self.flush_samples()
+            elif self.flush_task is None:
+                self.flush_task = asyncio.get_running_loop().create_task(self.flush_after_budget())
 
         except Exception as e:
-            logger.error(f"Error sending data to WebSocket: {str(e)}")
+            limited_logger.error("Error sending data to WebSocket: %s", e)
             # Don't raise the exception to avoid breaking the WebSocket connection
 
+    def set_latency_budget(self, latency_ms):
+        """
+        Set how long broadcast samples may be held back to batch them.
+
+        Args:
+            latency_ms: Budget in milliseconds, clamped to MSR_WS_BATCHING's
+                max_latency_ms; None uses the default
+
+        Returns:
+            int: The budget in milliseconds that was applied
+        """
+        batching_settings = get_batching_settings()
+        if latency_ms is None:
+            latency_ms = batching_settings['default_latency_ms']
+        try:
+            latency_ms = int(latency_ms)
+        except (TypeError, ValueError):
+            latency_ms = batching_settings['default_latency_ms']
+
+        latency_ms = max(0, min(latency_ms, batching_settings['max_latency_ms']))
+        self.latency_budget = latency_ms / 1000.0
+        return latency_ms
+
+    async def flush_after_budget(self):
+        """Send the pending samples once the latency budget has passed."""
+        try:
+            await asyncio.sleep(self.latency_budget)
+        finally:
+            self.flush_task = None
+        await self.flush_samples()
+
+    async def flush_samples(self):
+        """Send all pending samples as one data_batch message or binary frame."""
+        samples, self.pending_samples = self.pending_samples, []
+        if samples:
+            started = time.perf_counter()
+            if self.binary_samples:
+                await self.send(bytes_data=encode_samples(samples))
+            else:
+                await self.send(text_data=json.dumps(pack_samples(samples)))
+            instrumentation.record('send', started)
+
+            # Batched samples wait for the flush, which counts toward their delivery
+            sent_at = time.time()
+            for sample in samples:
+                if 'received_at' in sample:
+                    instrumentation.record_duration('delivery', sent_at - sample['received_at'])
+
+    async def handle_latency_budget(self, parameters):
+        """
+        Handle a change of the client's latency budget.
+
+        Args:
+            parameters: Dictionary with 'latency_ms'
+        """
+        latency_ms = self.set_latency_budget(parameters.get('latency_ms'))
+        if self.latency_budget <= 0:
+            await self.flush_samples()
+
+        await self.send_response({
+            'type': 'latency_budget',
+            'latency_ms': latency_ms
+        })
+
+    async def load_level(self, event):
+        """
+        Tell the client that the load shedding level changed.
+
+        Args:
+            event: The event with the new 'level', its 'name' and 'since'
+        """
+        await self.send(text_data=json.dumps({
+            'type': 'load_level',
+            'level': event['level'],
+            'name': event['name'],
+            'since': event['since']
+        }))
+
+    def set_point_budget(self, points, window_s):
+        """
+        Limit the samples sent per channel to what the client's chart shows.
+
+        Args:
+            points: Points a chart shows per channel; 0 or None sends every sample
+            window_s: Seconds of data those points span
+
+        Returns:
+            tuple: (points, window_s) as applied, clamped to MSR_WS_POINT_BUDGET
+
+        Raises:
+            ValueError: If points or window_s is not a number
+        """
+        if not points:
+            self.sample_interval = 0.0
+            return 0, None
+
+        point_budget_settings = get_point_budget_settings()
+        points = max(1, min(int(points), point_budget_settings['max_points']))
+        window_s = max(0.0, min(float(window_s), point_budget_settings['max_window_s']))
+        self.sample_interval = window_s / points
+        return points, window_s
+
+    async def handle_point_budget(self, parameters):
+        """
+        Handle a change of the client's point budget.
+
+        Args:
+            parameters: Dictionary with 'points' and 'window_s'
+        """
+        try:
+            points, window_s = self.set_point_budget(parameters.get('points'), parameters.get('window_s', 60))
+        except (TypeError, ValueError):
+            await self.send_response({
+                'type': 'error',
+                'error': 'points and window_s must be numbers'
+            })
+            return
+
+        await self.send_response({
+            'type': 'point_budget',
+            'points': points,
+            'window_s': window_s,
+            'interval_ms': round(self.sample_interval * 1000, 3)
+        })
+
+    async def role_changed(self, event):
+        """
+        Apply a role change made while the client is connected.
+
+        The role is read again from the database rather than taken from the
+        event, so a forged event cannot grant a role.
+
+        Args:
+            event: The event containing the new 'role'
+        """
+        role = await self.load_user_role()
+        if role != event.get('role'):
+            limited_logger.warning("Role change event for user %s does not match the stored role %s",
+                                   self.user.username, role)
+        self.user_role = role
+        self.rate_bucket = create_connection_bucket(self.user_role)
+        register_consumer(self.channel_name, self.user_role, self.server_id)
+        logger.info(f"Role of user {self.user.username} changed to {self.user_role}")
+
+        await self.send(text_data=json.dumps({
+            'type': 'role_changed',
+            'role': self.user_role
+        }))
+
+    async def session_revoked(self, event):
+        """
+        Close the connection when its session was logged out or its user was
+        deactivated or deleted.
+
+        Args:
+            event: The event containing the revoked 'session_key', or None for
+                all sessions of the user
+        """
+        session_key = event.get('session_key')
+        if session_key and session_key != self.scope['session'].session_key:
+            return
+
+        logger.info(f"Closing WebSocket of user {self.user.username}: session revoked")
+        await self.close(code=4001)
+
     async def handle_status_request(self):
         """Handle a request for system status information."""
         try:
             # Import here to avoid circular imports
-            from .msr_protocol import connection_state, connection_settings, calibration_settings
+            from .msr_protocol import server_health
+
+            connection_state = self.server['connection_state']
+            connection_settings = self.server['connection_settings']
+            calibration_settings = self.server['calibration_settings']
 
             # Create a status response with appropriate information for the user's role
             status_data = {
                 'type': 'status',
                 'timestamp': asyncio.get_event_loop().time(),
+                'server': self.server_id,
                 'connection': {
                     'connected': connection_state['connected'],
                     'last_connected': connection_state['last_connected']
-                }
+                },
+                'load_level': load_shedding.describe()
             }
 
             # Add role-specific information
@@ -232,16 +763,262 @@ class MSRConsumer(AsyncWebsocketConsumer):
             if self.user_role == 'admin':
                 status_data['connection']['settings'] = connection_settings
                 status_data['connection']['last_error'] = connection_state['last_error']
+                status_data['rate_limits'] = throttle_stats
+                status_data['servers'] = server_health()
+                status_data['latency'] = instrumentation.latency_summary(self.latency_marks)
+                status_data['system'] = system_sampler.snapshot
+                status_data['load_shedding'] = load_shedding.stats
+                status_data['snapshot'] = snapshot.stats
 
             # Send the status response
-            await self.send(text_data=json.dumps(status_data))
+            await self.send_response(status_data)
 
         except Exception as e:
             logger.error(f"Error handling status request: {str(e)}")
-            await self.send(text_data=json.dumps({
+            await self.send_response({
                 'type': 'error',
                 'error': 'Failed to retrieve status information'
-            }))
+            })
+
+    def resolve_history_channel(self, channel):
+        """
+        Return the history key of a channel of the client's server.
+
+        Args:
+            channel: The server's channel name or the path of one of its channels
+
+        Returns:
+            str: The channel's key in the history
+
+        Raises:
+            ValueError: If the channel does not belong to the client's server
+        """
+        from .msr_protocol import history_channel
+
+        if channel != self.server['channel'] and channel not in self.server['channel_index'].channels:
+            raise ValueError(f"Unknown channel of server {self.server_id}: {channel}")
+        return history_channel(self.server, channel)
+
+    async def handle_alignment_request(self, parameters):
+        """
+        Handle a request for channels resampled onto a common timebase.
+
+        Only channels of the client's server can be aligned.
+
+        Args:
+            parameters: Dictionary with 'channels' and optional 'method',
+                'period' and 'window' (seconds)
+        """
+        from .alignment import align_channels
+
+        try:
+            channels = parameters.get('channels') or []
+            if isinstance(channels, str):
+                channels = [channels]
+            if not isinstance(channels, list) or not all(isinstance(channel, str) for channel in channels):
+                raise ValueError("channels must be a list of channel names")
+            keys = {self.resolve_history_channel(channel): channel for channel in channels}
+
+            aligned = align_channels(
+                list(keys),
+                period=parameters.get('period'),
+                method=parameters.get('method', 'zoh'),
+                window=parameters.get('window'),
+            )
+
+            # NaN is not valid JSON, so gaps are sent as null
+            await self.send_response({
+                'type': 'aligned_data',
+                'method': aligned['method'],
+                'period': aligned['period'],
+                'timestamps': aligned['timestamps'].tolist(),
+                'channels': {
+                    keys[key]: [None if math.isnan(value) else value for value in values.tolist()]
+                    for key, values in aligned['channels'].items()
+                }
+            })
+
+        except (ValueError, TypeError) as e:
+            await self.send_response({
+                'type': 'error',
+                'error': f'Failed to align channels: {e}'
+            })
+
+    async def handle_spectrum_request(self, parameters):
+        """
+        Handle a request for the spectrum of a channel of the client's server.
+
+        Args:
+            parameters: Dictionary with 'channel' and optional 'window' (samples),
+                'window_function' and 'averages'
+        """
+        from .spectrum import get_spectrum
+
+        channel = parameters.get('channel', self.server['channel'])
+
+        try:
+            if not isinstance(channel, str):
+                raise TypeError("channel must be a channel name")
+            spectrum = await get_spectrum(
+                self.resolve_history_channel(channel),
+                window_length=parameters.get('window', 1024),
+                window_function=parameters.get('window_function', 'hann'),
+                averages=parameters.get('averages', 1),
+            )
+
+            await self.send_response({
+                'type': 'spectrum',
+                'channel': channel,
+                'sample_rate': spectrum['sample_rate'],
+                'end_sample': spectrum['end_sample'],
+                'cached': spectrum['cached'],
+                'frequencies': spectrum['frequencies'].tolist(),
+                'amplitudes': spectrum['amplitudes'].tolist()
+            })
+
+        except (ValueError, TypeError) as e:
+            await self.send_response({
+                'type': 'error',
+                'error': f'Failed to compute spectrum: {e}'
+            })
+
+    async def handle_channel_query(self, parameters):
+        """
+        Handle a search of the server's channels.
+
+        Args:
+            parameters: Dictionary with a 'pattern' such as '/Line1/Motor/*/Current'
+                and an optional 'limit'
+        """
+        from .channel_index import MAX_QUERY_RESULTS, query_channels
+
+        try:
+            result = query_channels(
+                self.server_id,
+                parameters.get('pattern', '/'),
+                limit=parameters.get('limit', MAX_QUERY_RESULTS)
+            )
+            await self.send_response(dict(result, type='channels'))
+
+        except (ValueError, TypeError) as e:
+            await self.send_response({
+                'type': 'error',
+                'error': f'Invalid channel query: {e}'
+            })
+
+    async def handle_channel_subscription(self, parameters):
+        """
+        Handle a subscription to the channels matching some patterns.
+
+        The patterns are expanded again whenever the server's channel list
+        changes; the client then receives a 'channels_expanded' message.
+
+        Args:
+            parameters: Dictionary with a list of 'patterns'
+        """
+        from .channel_index import subscribe_channels
+
+        patterns = parameters.get('patterns')
+        if not isinstance(patterns, list) or not patterns:
+            await self.send_response({'type': 'error', 'error': 'patterns must be a non-empty list'})
+            return
+
+        try:
+            expansions = await subscribe_channels(self.server_id, self.channel_name, patterns)
+        except ValueError as e:
+            await self.send_response({'type': 'error', 'error': str(e)})
+            return
+
+        self.channel_patterns.update(expansions)
+        await self.update_channel_paths()
+        await self.send_response({
+            'type': 'channels_subscribed',
+            'server': self.server_id,
+            'patterns': expansions
+        })
+
+    async def handle_channel_unsubscription(self, parameters):
+        """
+        Handle the removal of channel patterns.
+
+        Args:
+            parameters: Dictionary with the 'patterns' to remove (all if missing)
+        """
+        from .channel_index import unsubscribe_channels
+
+        patterns = parameters.get('patterns')
+        if patterns is None:
+            patterns = list(self.channel_patterns)
+        elif not isinstance(patterns, list):
+            await self.send_response({'type': 'error', 'error': 'patterns must be a list'})
+            return
+
+        await unsubscribe_channels(self.server_id, self.channel_name, patterns)
+        for pattern in patterns:
+            self.channel_patterns.pop(pattern, None)
+        await self.update_channel_paths()
+        await self.send_response({
+            'type': 'channels_unsubscribed',
+            'patterns': sorted(self.channel_patterns)
+        })
+
+    async def channels_expanded(self, event):
+        """
+        Tell the client that its channel patterns match other channels.
+
+        Args:
+            event: The event with the 'server' and pattern -> channel paths
+        """
+        for pattern, paths in event['patterns'].items():
+            if pattern in self.channel_patterns:
+                self.channel_patterns[pattern] = paths
+        await self.update_channel_paths()
+        await self.send(text_data=json.dumps({
+            'type': 'channels_expanded',
+            'server': event['server'],
+            'patterns': event['patterns']
+        }))
+
+    async def update_channel_paths(self):
+        """
+        Collect the channel paths matched by the client's patterns.
+
+        The client joins the groups of newly matched channels and leaves the
+        groups of channels no pattern matches any more.
+        """
+        paths = set().union(*self.channel_patterns.values())
+        group = self.server['group']
+        for path in paths - self.channel_paths:
+            await self.channel_layer.group_add(channel_group_name(group, path), self.channel_name)
+        for path in self.channel_paths - paths:
+            await self.channel_layer.group_discard(channel_group_name(group, path), self.channel_name)
+        self.channel_paths = paths
+
+    async def handle_parameter_query(self, parameters):
+        """
+        Handle a query of the server's cached parameter tree.
+
+        Args:
+            parameters: Dictionary with optional 'prefix', 'offset', 'limit' and
+                'browse' (list the entries directly below the prefix)
+        """
+        from .parameter_tree import DEFAULT_PAGE_SIZE, query_parameters
+
+        try:
+            result = query_parameters(
+                self.server_id,
+                prefix=str(parameters.get('prefix', '/')),
+                offset=parameters.get('offset', 0),
+                limit=parameters.get('limit', DEFAULT_PAGE_SIZE),
+                browse=bool(parameters.get('browse', False))
+            )
+            await self.send_response(dict(result, type='parameters'))
+
+        except (ValueError, TypeError) as e:
+            await self.send_response({
+                'type': 'error',
+                'error': f'Invalid parameter query: {e}'
+            })
 
     @database_sync_to_async
     def get_user_role(self):
@@ -258,6 +1035,18 @@ class MSRConsumer(AsyncWebsocketConsumer):
             return 'operator'  # Default role
 
     @database_sync_to_async
+    def load_user_role(self):
+        """
+        Read the current role of the user from the database.
+
+        Returns:
+            str: The user's role, operator if the user has none
+        """
+        from msr_control.models import UserRole
+
+        role = UserRole.objects.filter(user_id=self.user.pk).values_list('role', flat=True).first()
+        return role or 'operator'
+
     def filter_data_by_role(self, data):
         """
         Filter data based on the user's role.
@@ -300,7 +1089,7 @@ class MSRConsumer(AsyncWebsocketConsumer):
             return filtered_data
 
         except Exception as e:
-            logger.error(f"Error filtering data: {str(e)}")
+            limited_logger.error("Error filtering data: %s", e)
             # Return basic data on error to avoid leaking sensitive information
             return {
                 'timestamp': data.get('timestamp'),
@@ -314,18 +1103,70 @@ class MSRConsumer(AsyncWebsocketConsumer):
 
         try:
             # Update calibration settings
-            updated_settings = await update_calibration(parameters)
+            updated_settings = await update_calibration(parameters, self.server_id)
 
             # Send confirmation back to the client
-            await self.send(text_data=json.dumps({
+            await self.send_response({
                 'success': True,
                 'message': 'Calibration settings updated successfully',
                 'settings': updated_settings
-            }))
+            })
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_response({
                 'error': f'Failed to update calibration settings: {str(e)}'
-            }))
+            })
+
+    async def handle_autocal(self, command, parameters):
+        """
+        Handle a step of the auto-calibration workflow.
+
+        Commands are 'start' (optional 'degree'), 'capture' ('reference' and
+        optional 'duration' in seconds), 'fit', 'apply', 'cancel' and 'status'.
+        They act on the user's session on the consumer's server; while another
+        user calibrates the server, 'start' is refused.
+
+        Args:
+            command: The workflow step
+            parameters: Parameters of the step
+        """
+        from . import autocal
+
+        user = self.user.username
+        try:
+            if command == 'start':
+                result = autocal.start_session(user, self.server_id, parameters.get('degree', 1))
+            elif command == 'capture':
+                result = await autocal.capture_point(
+                    user, self.server_id,
+                    parameters.get('reference'),
+                    parameters.get('duration', autocal.DEFAULT_HOLD_DURATION)
+                )
+            elif command == 'fit':
+                result = autocal.fit_calibration(user, self.server_id)
+            elif command == 'apply':
+                result = await autocal.apply_calibration(user, self.server_id)
+            elif command == 'cancel':
+                autocal.cancel_session(user, self.server_id)
+                result = autocal.session_summary(user, self.server_id)
+            elif command == 'status':
+                result = autocal.session_summary(user, self.server_id)
+            else:
+                raise ValueError(f"Unknown auto-calibration command: {command}")
+
+            await self.send_response({
+                'type': 'autocal',
+                'command': command,
+                'success': True,
+                'result': result
+            })
+
+        except (ValueError, TypeError) as e:
+            await self.send_response({
+                'type': 'autocal',
+                'command': command,
+                'success': False,
+                'error': str(e)
+            })
 
     async def handle_admin_action(self, command, parameters):
         """Handle admin actions"""
@@ -334,11 +1175,13 @@ class MSRConsumer(AsyncWebsocketConsumer):
         elif command == 'restart_service':
             await self.restart_service()
         elif command == 'add_user':
-            await self.add_user(parameters)
+            await self.send_response(await self.add_user(parameters))
+        elif command == 'instrumentation':
+            await self.configure_instrumentation(parameters)
         else:
-            await self.send(text_data=json.dumps({
+            await self.send_response({
                 'error': f'Unknown admin command: {command}'
-            }))
+            })
 
     async def update_connection_settings(self, parameters):
         """Update connection settings"""
@@ -346,34 +1189,54 @@ class MSRConsumer(AsyncWebsocketConsumer):
 
         try:
             # Update connection settings
-            updated_settings = await update_connection_settings(parameters)
+            updated_settings = await update_connection_settings(parameters, self.server_id)
 
             # Send confirmation back to the client
-            await self.send(text_data=json.dumps({
+            await self.send_response({
                 'success': True,
                 'message': 'Connection settings updated successfully',
                 'settings': updated_settings
-            }))
+            })
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_response({
                 'error': f'Failed to update connection settings: {str(e)}'
-            }))
+            })
+
+    async def configure_instrumentation(self, parameters):
+        """
+        Switch the pipeline latency instrumentation on or off.
+
+        Args:
+            parameters: Dictionary with optional 'enabled' and 'reset' (clear
+                the histograms)
+        """
+        if 'enabled' in parameters:
+            instrumentation.set_enabled(parameters['enabled'])
+        if parameters.get('reset'):
+            instrumentation.reset()
+        logger.info(f"Latency instrumentation {'enabled' if instrumentation.enabled else 'disabled'} by {self.user.username}")
+
+        await self.send_response({
+            'success': True,
+            'type': 'instrumentation',
+            'enabled': instrumentation.enabled
+        })
 
     async def restart_service(self):
         """Restart the service (simulated)"""
         # In a real application, you would implement actual service restart logic
-        await self.send(text_data=json.dumps({
+        await self.send_response({
             'success': True,
             'message': 'Service restart initiated. This may take a few moments.'
-        }))
+        })
 
         # Simulate a restart by waiting a bit
         await asyncio.sleep(2)
 
-        await self.send(text_data=json.dumps({
+        await self.send_response({
             'success': True,
             'message': 'Service restarted successfully.'
-        }))
+        })
 
     @database_sync_to_async
     def add_user(self, parameters):
@@ -0,0 +1,160 @@
+"""
+Framing of the XML message stream received from an EtherLab server.
+
+The MSR protocol is a stream of top-level XML elements over TCP, e.g.
+``<data time="..."><F c="0" d="1.5"/></data>``, ``<ack id="7"/>`` or
+``<pu index="12"/>``. TCP delivers them in arbitrary chunks, so
+``MessageFramer`` buffers the stream and returns complete elements only.
+"""
+import re
+from xml.sax.saxutils import unescape
+
+# Tag name at the start of an element
+TAG_PATTERN = re.compile(rb'<([A-Za-z_][\w.-]*)')
+
+# Attributes of a start tag
+ATTRIBUTE_PATTERN = re.compile(rb'([A-Za-z_][\w.-]*)="([^"]*)"')
+
+# Entities besides &amp; &lt; &gt; that appear in attribute values
+ENTITIES = {'&quot;': '"', '&apos;': "'"}
+
+
+def parse_attributes(element):
+    """
+    Parse the attributes of an element's start tag.
+
+    Args:
+        element: A complete element as bytes
+
+    Returns:
+        dict: Attribute names and unescaped values as strings
+    """
+    start_tag = element[:element.find(b'>') + 1]
+    return {
+        name.decode(): unescape(value.decode('utf-8', 'replace'), ENTITIES)
+        for name, value in ATTRIBUTE_PATTERN.findall(start_tag)
+    }
+
+
+def child_attributes(element, tag):
+    """
+    Parse the attributes of the child elements with a given tag.
+
+    Args:
+        element: A complete element as bytes
+        tag: Tag name of the children, e.g. 'parameter'
+
+    Returns:
+        list: One attribute dictionary per child, in document order
+    """
+    pattern = re.compile(rb'<' + re.escape(tag.encode()) + rb'\b[^>]*>')
+    return [parse_attributes(match.group(0)) for match in pattern.finditer(element, element.find(b'>') + 1)]
+
+
+def element_tag(element):
+    """Return the tag name of an element, or None for raw (non-XML) data."""
+    match = TAG_PATTERN.match(element)
+    return match.group(1).decode() if match else None
+
+
+class MessageFramer:
+    """
+    Split a byte stream into complete top-level XML elements.
+
+    Processing instructions and comments are skipped. Non-whitespace bytes
+    outside of any element are returned as raw frames, so servers that do not
+    speak XML still produce data.
+
+    Received bytes are appended to a bytearray, and the search for the end of
+    an incomplete element resumes where the previous feed stopped, so framing
+    a large reply received in many small chunks takes linear time.
+    """
+
+    def __init__(self, max_buffer=16 * 1024 * 1024):
+        self.buffer = bytearray()
+        self.max_buffer = max_buffer
+        # Search state of the incomplete element at the start of the buffer:
+        # (offset of its '>' or None, its end tag or None, offset to resume at)
+        self._pending = None
+
+    def feed(self, data):
+        """
+        Add received bytes and return the elements completed by them.
+
+        Args:
+            data: Bytes received from the socket
+
+        Returns:
+            list: Complete elements (and raw frames) as bytes, in stream order
+        """
+        buffer = self.buffer
+        buffer += data
+        messages = []
+        position = 0
+
+        while True:
+            start = buffer.find(b'<', position)
+            if start < 0:
+                raw = buffer[position:].strip()
+                if raw:
+                    messages.append(bytes(raw))
+                position = len(buffer)
+                break
+
+            raw = buffer[position:start].strip()
+            if raw:
+                messages.append(bytes(raw))
+
+            end = self._element_end(buffer, start)
+            if end is None:
+                position = start
+                break
+            if end > start:
+                element = bytes(buffer[start:end])
+                if element[1:2] not in (b'?', b'!'):
+                    messages.append(element)
+            position = end
+
+        if position:
+            del buffer[:position]
+            if self._pending is not None:
+                close, end_tag, resume = self._pending
+                self._pending = (None if close is None else close - position, end_tag, resume - position)
+        if len(buffer) > self.max_buffer:
+            # A runaway element; drop it rather than grow without bound
+            self.buffer = bytearray()
+            self._pending = None
+        return messages
+
+    def _element_end(self, buffer, start):
+        """Return the end offset of the element starting at ``start``, or None if incomplete."""
+        pending, self._pending = self._pending, None
+        if start != 0:
+            pending = None
+
+        if pending is not None and pending[0] is not None:
+            close, end_tag, resume = pending
+        else:
+            close = buffer.find(b'>', pending[2] if pending is not None else start)
+            if close < 0:
+                self._pending = (None, None, len(buffer))
+                return None
+
+            # Processing instructions, comments and self-closing elements
+            if buffer[start + 1:start + 2] in (b'?', b'!') or buffer[close - 1:close] == b'/':
+                return close + 1
+
+            match = TAG_PATTERN.match(buffer, start)
+            if match is None:
+                # Stray '<' or a closing tag without an opening one; skip it
+                return close + 1
+
+            end_tag = b'</' + match.group(1) + b'>'
+            resume = close
+
+        end = buffer.find(end_tag, resume)
+        if end < 0:
+            # The end tag may begin in the bytes received so far
+            self._pending = (close, end_tag, max(close, len(buffer) - len(end_tag) + 1))
+            return None
+        return end + len(end_tag)
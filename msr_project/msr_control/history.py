@@ -0,0 +1,115 @@
+"""
+In-memory sample history for the MSR Control application.
+
+This module keeps a fixed-capacity ring buffer of recent samples for every
+channel seen by the pipeline, so that alignment and other analysis stages can
+work on recent data without asking the EtherLab server again.
+"""
+import numpy as np
+from django.conf import settings
+
+from . import load_shedding
+
+# Default number of samples kept per channel
+DEFAULT_HISTORY_CAPACITY = 4096
+
+
+class SampleRingBuffer:
+    """
+    Fixed-capacity ring buffer of (timestamp, value) samples for one channel.
+
+    Timestamps and values are stored in preallocated float64 arrays, so
+    appending a sample never allocates. ``total`` counts every sample ever
+    written and doubles as the sample number of the next sample.
+    """
+
+    def __init__(self, capacity=DEFAULT_HISTORY_CAPACITY):
+        if capacity <= 0:
+            raise ValueError("History capacity must be positive")
+
+        self.capacity = capacity
+        self.times = np.empty(capacity, dtype=np.float64)
+        self.values = np.empty(capacity, dtype=np.float64)
+        self.total = 0
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def append(self, timestamp, value):
+        """
+        Append a single sample, overwriting the oldest one when full.
+
+        Args:
+            timestamp: Sample time in seconds
+            value: Sample value
+        """
+        index = self.total % self.capacity
+        self.times[index] = timestamp
+        self.values[index] = value
+        self.total += 1
+
+    def latest(self, count=None, end=None):
+        """
+        Return the most recent samples in chronological order.
+
+        Args:
+            count: Maximum number of samples to return (all retained if None)
+            end: Sample number to stop before (the newest sample if None)
+
+        Returns:
+            tuple: (times, values) as new float64 arrays
+        """
+        if end is None or end > self.total:
+            end = self.total
+
+        oldest = max(self.total - self.capacity, 0)
+        start = oldest if count is None else max(end - count, oldest)
+        if start >= end:
+            empty = np.empty(0, dtype=np.float64)
+            return empty, empty.copy()
+
+        # Map the sample numbers onto the ring, handling the wrap-around
+        indices = np.arange(start, end) % self.capacity
+        return self.times[indices], self.values[indices]
+
+
+# Ring buffers keyed by channel name
+channel_history = {}
+
+
+def get_history_capacity():
+    """Return the configured number of samples kept per channel."""
+    return int(getattr(settings, 'MSR_HISTORY_CAPACITY', DEFAULT_HISTORY_CAPACITY))
+
+
+def record_sample(channel, timestamp, value):
+    """
+    Record a processed sample in the history of its channel.
+
+    Nothing is recorded while load shedding pauses the history.
+
+    Args:
+        channel: Channel name
+        timestamp: Server-side sample time in seconds
+        value: Sample value
+    """
+    if load_shedding.level >= load_shedding.PAUSE_HISTORY:
+        load_shedding.stats['history_skipped'] += 1
+        return
+    buffer = channel_history.get(channel)
+    if buffer is None:
+        buffer = channel_history[channel] = SampleRingBuffer(get_history_capacity())
+    buffer.append(timestamp, value)
+
+
+def get_history(channel):
+    """
+    Return the ring buffer for a channel.
+
+    Args:
+        channel: Channel name
+
+    Returns:
+        SampleRingBuffer: The channel's history, or None if it has no samples
+    """
+    return channel_history.get(channel)
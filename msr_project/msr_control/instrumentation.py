@@ -0,0 +1,189 @@
+"""
+Latency instrumentation of the data pipeline.
+
+Each stage of a sample's way from the EtherLab socket to the browser records
+its duration into a fixed-bucket histogram:
+
+    recv       splitting a received chunk into messages
+    parse      extracting the raw value from a message
+    calibrate  calibration and low-pass filtering
+    publish    handing the sample to the channel layer (or shared memory)
+    send       filtering, encoding and sending in one consumer
+    delivery   from receiving the sample to sending it to a client
+
+Recording a duration is a bisect into a constant tuple of bucket bounds and
+an integer increment; no per-sample state is kept. Percentiles are only
+computed when an admin asks for the status. Recording can be switched
+off and on at runtime with the ``instrumentation`` admin command.
+"""
+import bisect
+import time
+
+from django.conf import settings
+
+# Pipeline stages in the order a sample passes through them
+STAGES = ('recv', 'parse', 'calibrate', 'publish', 'send', 'delivery')
+
+# Upper bounds of the histogram buckets in seconds: eight per decade from
+# 1 microsecond to 10 seconds; longer durations land in an overflow bucket
+BUCKET_BOUNDS = tuple(1e-6 * 10 ** (step / 8) for step in range(57))
+
+# Default instrumentation settings
+DEFAULT_INSTRUMENTATION_SETTINGS = {
+    'enabled': True
+}
+
+# Whether stages record their durations; read on every sample
+enabled = DEFAULT_INSTRUMENTATION_SETTINGS['enabled']
+
+
+class Histogram:
+    """
+    Counts of durations per bucket of BUCKET_BOUNDS.
+    """
+
+    __slots__ = ('count', 'counts', 'maximum', 'started', 'total')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.started = time.monotonic()
+
+    def record(self, duration):
+        """Add one duration in seconds."""
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.maximum = max(self.maximum, duration)
+
+    def percentile(self, fraction):
+        """
+        Return the upper bound of the bucket holding a percentile.
+
+        Args:
+            fraction: The percentile as a fraction, e.g. 0.95
+
+        Returns:
+            float: Duration in seconds, or None if nothing was recorded
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if bucket == len(BUCKET_BOUNDS):
+                    return self.maximum
+                return min(BUCKET_BOUNDS[bucket], self.maximum)
+        return self.maximum
+
+    def summary(self, since=None):
+        """
+        Summarize the histogram in milliseconds.
+
+        The histogram itself is not changed, so readers do not affect each
+        other; each reader passes the mark of its previous summary to get the
+        rate since then.
+
+        Args:
+            since: (count, time.monotonic()) of the reader's previous summary;
+                without it, or after a reset, the rate covers the time since
+                the histogram was last reset
+
+        Returns:
+            tuple: The summary, a dict with 'count', 'rate' per second, 'mean',
+                'p50', 'p95', 'p99' and 'max', and the mark to pass next time
+        """
+        now = time.monotonic()
+        count = self.count
+        if since is None or since[0] > count or since[1] < self.started:
+            since = (0, self.started)
+        elapsed = now - since[1]
+        rate = (count - since[0]) / elapsed if elapsed > 0 else 0.0
+
+        def milliseconds(seconds):
+            return None if seconds is None else round(seconds * 1000, 4)
+
+        return {
+            'count': self.count,
+            'rate': round(rate, 2),
+            'mean': milliseconds(self.total / self.count) if self.count else None,
+            'p50': milliseconds(self.percentile(0.50)),
+            'p95': milliseconds(self.percentile(0.95)),
+            'p99': milliseconds(self.percentile(0.99)),
+            'max': milliseconds(self.maximum) if self.count else None
+        }, (count, now)
+
+
+# stage -> Histogram
+histograms = {stage: Histogram() for stage in STAGES}
+
+
+def get_instrumentation_settings():
+    """Return the instrumentation settings with overrides from MSR_INSTRUMENTATION applied."""
+    instrumentation_settings = DEFAULT_INSTRUMENTATION_SETTINGS.copy()
+    instrumentation_settings.update(getattr(settings, 'MSR_INSTRUMENTATION', {}))
+    return instrumentation_settings
+
+
+def record(stage, started):
+    """
+    Record the duration of a stage that began at ``started``.
+
+    Args:
+        stage: One of STAGES
+        started: time.perf_counter() value taken when the stage began
+    """
+    if enabled:
+        histograms[stage].record(time.perf_counter() - started)
+
+
+def record_duration(stage, duration):
+    """Record a duration in seconds measured by the caller."""
+    if enabled:
+        histograms[stage].record(duration)
+
+
+def set_enabled(value):
+    """Switch recording on or off."""
+    global enabled
+    enabled = bool(value)
+
+
+def reset():
+    """Clear all histograms."""
+    for histogram in histograms.values():
+        histogram.reset()
+
+
+def latency_summary(marks=None):
+    """
+    Return the latency percentiles of every stage.
+
+    Args:
+        marks: The reader's dict of stage -> mark of its previous summary,
+            updated in place; rates cover the time since then. Without it,
+            rates cover the time since the histograms were reset.
+
+    Returns:
+        dict: 'enabled' and 'stages', stage -> histogram summary in milliseconds
+    """
+    stages = {}
+    for stage, histogram in histograms.items():
+        stages[stage], mark = histogram.summary(marks.get(stage) if marks is not None else None)
+        if marks is not None:
+            marks[stage] = mark
+    return {
+        'enabled': enabled,
+        'stages': stages
+    }
+
+
+# Apply MSR_INSTRUMENTATION now that the settings helper exists
+enabled = bool(get_instrumentation_settings()['enabled'])
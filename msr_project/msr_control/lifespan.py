@@ -0,0 +1,51 @@
+"""
+ASGI lifespan handling for the MSR Control application.
+
+This module starts the MSR ingest when the ASGI server starts up and stops it
+when the server shuts down, so ingest always runs on the server's own event
+loop whichever ASGI server hosts the application.
+"""
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+
+class IngestLifespanApp:
+    """
+    ASGI application for the ``lifespan`` scope.
+
+    On ``lifespan.startup`` it starts the ingest task on the running loop; on
+    ``lifespan.shutdown`` it stops ingest and drains buffers before reporting
+    completion to the server.
+    """
+
+    async def __call__(self, scope, receive, send):
+        # Import here to avoid touching the app registry at import time
+        from .tasks import start_ingest, stop_ingest
+
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                try:
+                    start_ingest()
+                except Exception as e:
+                    logger.exception("Error starting MSR ingest")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    await stop_ingest()
+                except Exception as e:
+                    logger.exception("Error stopping MSR ingest")
+                    await send({'type': 'lifespan.shutdown.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
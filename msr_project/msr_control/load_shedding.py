@@ -0,0 +1,182 @@
+"""
+Adaptive load shedding driven by the event loop lag.
+
+When the event loop falls behind, the work that follows the reception of a
+sample is cut back one level at a time, least important first:
+
+    0  normal
+    1  operator_rate   operators get at most one sample per operator_interval
+    2  decimation      only every n-th sample is broadcast to any client
+    3  history_paused  samples are no longer recorded in the sample history
+
+Receiving, parsing and calibrating samples from the EtherLab server is never
+shed, so the connection keeps up with the server while clients see fewer
+samples. The level rises by one whenever a lag probe (see
+metrics.monitor_event_loop) exceeds the threshold of the next level and drops
+by one after the lag has stayed below a fraction of the current level's
+threshold for recover_after seconds. Clients are sent a ``load_level``
+message whenever the level changes.
+"""
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# Degradation levels in the order they are entered
+LEVELS = ('normal', 'operator_rate', 'decimation', 'history_paused')
+NORMAL, REDUCE_OPERATOR_RATE, DECIMATE, PAUSE_HISTORY = range(len(LEVELS))
+
+# Default load shedding settings
+DEFAULT_LOAD_SHEDDING_SETTINGS = {
+    'enabled': True,
+    'thresholds': (0.05, 0.1, 0.25),  # lag in seconds entering levels 1, 2 and 3
+    'recover_ratio': 0.5,  # the lag must fall below this fraction of a level's threshold
+    'recover_after': 5.0,  # seconds of low lag before stepping down one level
+    'operator_interval': 0.2,  # seconds between samples sent to operators from level 1
+    'decimation': 4  # broadcast every n-th sample from level 2
+}
+
+# Current degradation level; read on every sample
+level = NORMAL
+
+# Samples not delivered or recorded because of the level
+stats = {
+    'level_changes': 0,
+    'operator_skipped': 0,
+    'decimated': 0,
+    'history_skipped': 0
+}
+
+# When the lag last rose above the recovery limit (None while it is below it)
+_state = {
+    'since': time.time(),
+    'calm_since': None
+}
+
+# server -> samples seen while decimating
+_decimation_counts = {}
+
+
+def get_load_shedding_settings():
+    """Return the load shedding settings with overrides from MSR_LOAD_SHEDDING applied."""
+    load_shedding_settings = DEFAULT_LOAD_SHEDDING_SETTINGS.copy()
+    load_shedding_settings.update(getattr(settings, 'MSR_LOAD_SHEDDING', {}))
+    return load_shedding_settings
+
+
+def describe():
+    """
+    Describe the current level for clients.
+
+    Returns:
+        dict: 'level' (number), 'name' and 'since' (epoch seconds)
+    """
+    return {'level': level, 'name': LEVELS[level], 'since': _state['since']}
+
+
+def next_level(lag, now):
+    """
+    Return the level called for by a lag probe, at most one step from the current one.
+
+    Args:
+        lag: The measured event loop lag in seconds
+        now: time.monotonic() of the probe
+
+    Returns:
+        int: The new level
+    """
+    thresholds = policy['thresholds']
+    if level < len(thresholds) and lag > thresholds[level]:
+        _state['calm_since'] = None
+        return level + 1
+
+    if level > NORMAL and lag < thresholds[level - 1] * policy['recover_ratio']:
+        if _state['calm_since'] is None:
+            _state['calm_since'] = now
+        elif now - _state['calm_since'] >= policy['recover_after']:
+            # The next step down waits for another calm period
+            _state['calm_since'] = now
+            return level - 1
+        return level
+
+    _state['calm_since'] = None
+    return level
+
+
+async def update_level(lag):
+    """
+    Adjust the level after a lag probe.
+
+    Args:
+        lag: The measured event loop lag in seconds
+    """
+    if not policy['enabled']:
+        return
+    new_level = next_level(lag, time.monotonic())
+    if new_level != level:
+        await set_level(new_level, lag)
+
+
+async def set_level(new_level, lag=None):
+    """
+    Switch to a level and tell the clients of this process.
+
+    Args:
+        new_level: One of the level numbers
+        lag: The lag that caused the change, for the log
+    """
+    global level
+    from .msr_protocol import servers
+
+    previous, level = level, new_level
+    _state['since'] = time.time()
+    _decimation_counts.clear()
+    stats['level_changes'] += 1
+
+    lag_text = f" (event loop lag {lag * 1000:.1f} ms)" if lag is not None else ''
+    if new_level > previous:
+        logger.warning(f"Load shedding raised to level {new_level} ({LEVELS[new_level]}){lag_text}")
+    else:
+        logger.info(f"Load shedding lowered to level {new_level} ({LEVELS[new_level]}){lag_text}")
+
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    # Every process sheds by its own lag, so only its own clients are told
+    group_send = getattr(channel_layer, 'group_send_local', channel_layer.group_send)
+    event = dict(describe(), type='load_level')
+    for server in servers.values():
+        try:
+            await group_send(server['group'], event)
+        except Exception:
+            logger.exception("Error announcing load level")
+
+
+def keep_broadcast(server_id):
+    """
+    Decide whether a sample is broadcast while decimating.
+
+    Args:
+        server_id: The server the sample came from
+
+    Returns:
+        bool: True for every n-th sample of the server
+    """
+    count = _decimation_counts.get(server_id, 0) + 1
+    _decimation_counts[server_id] = count
+    if count % policy['decimation']:
+        stats['decimated'] += 1
+        return False
+    return True
+
+
+# Apply MSR_LOAD_SHEDDING now that the settings helper exists
+policy = get_load_shedding_settings()
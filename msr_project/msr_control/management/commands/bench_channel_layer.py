@@ -0,0 +1,167 @@
+"""
+Management command benchmarking channel layer backends.
+
+Measures group_send throughput (delivered messages per second) and delivery
+latency percentiles for the in-memory layer and the Unix socket layer, within
+one process and, for the Unix socket layer, across processes.
+"""
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from msr_control.channel_layer import UnixSocketChannelLayer
+
+GROUP = 'bench'
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+async def _receive_all(layer, channel, count, latencies, timeout):
+    """Receive up to ``count`` messages on a channel, recording latencies."""
+    async def receive():
+        for _ in range(count):
+            message = await layer.receive(channel)
+            latencies.append(time.monotonic() - message['sent'])
+
+    # Stop at the timeout if messages were dropped
+    try:
+        await asyncio.wait_for(receive(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def _produce(layer, messages, payload, batch):
+    for index in range(messages):
+        await layer.group_send(GROUP, {'type': 'bench', 'sent': time.monotonic(), 'payload': payload})
+        if index % batch == batch - 1:
+            await asyncio.sleep(0)
+
+
+async def _run_local(layer, messages, receivers, payload, batch):
+    """Producer and receivers in one process; returns (delivered, elapsed, latencies)."""
+    channels = [await layer.new_channel() for _ in range(receivers)]
+    for channel in channels:
+        await layer.group_add(GROUP, channel)
+
+    latencies = []
+    start = time.monotonic()
+    consumers = [
+        asyncio.ensure_future(_receive_all(layer, channel, messages, latencies, timeout=2))
+        for channel in channels
+    ]
+    await _produce(layer, messages, payload, batch)
+    await asyncio.gather(*consumers)
+    elapsed = time.monotonic() - start
+
+    await layer.flush()
+    await layer.close()
+    return len(latencies), elapsed, latencies
+
+
+def _child_receiver(socket_dir, messages, receivers, ready, results):
+    """Receive benchmark messages in a separate process and report latencies."""
+    import django
+    django.setup()
+
+    async def run():
+        layer = UnixSocketChannelLayer(socket_dir=socket_dir, capacity=messages)
+        channels = [await layer.new_channel() for _ in range(receivers)]
+        for channel in channels:
+            await layer.group_add(GROUP, channel)
+        ready.set()
+
+        latencies = []
+        await asyncio.gather(*[
+            _receive_all(layer, channel, messages, latencies, timeout=5)
+            for channel in channels
+        ])
+        await layer.close()
+        return latencies
+
+    results.put(asyncio.run(run()))
+
+
+async def _run_cross_process(socket_dir, messages, receivers, processes, payload, batch):
+    """Producer in this process, receivers in child processes."""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    readies = [context.Event() for _ in range(processes)]
+    children = [
+        context.Process(target=_child_receiver, args=(socket_dir, messages, receivers, ready, results))
+        for ready in readies
+    ]
+    for child in children:
+        child.start()
+
+    loop = asyncio.get_running_loop()
+    for ready in readies:
+        await loop.run_in_executor(None, ready.wait, 30)
+
+    layer = UnixSocketChannelLayer(socket_dir=socket_dir, peer_refresh_interval=0)
+    start = time.monotonic()
+    await _produce(layer, messages, payload, batch)
+
+    latencies = []
+    for _ in children:
+        latencies.extend(await loop.run_in_executor(None, results.get))
+    elapsed = time.monotonic() - start
+
+    for child in children:
+        child.join()
+    await layer.close()
+    return len(latencies), elapsed, latencies
+
+
+class Command(BaseCommand):
+    help = 'Benchmark group_send throughput and delivery latency of the channel layer backends'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000,
+                            help='Messages sent to the group per scenario')
+        parser.add_argument('--receivers', type=int, default=8,
+                            help='Group members per process')
+        parser.add_argument('--processes', type=int, default=2,
+                            help='Receiver processes in the cross-process scenario')
+        parser.add_argument('--payload', type=int, default=256,
+                            help='Payload size in bytes')
+        parser.add_argument('--batch', type=int, default=1,
+                            help='Messages sent between yields to the event loop')
+
+    def handle(self, *args, **options):
+        from channels.layers import InMemoryChannelLayer
+
+        messages = options['messages']
+        receivers = options['receivers']
+        payload = 'x' * options['payload']
+        batch = options['batch']
+
+        # The sockets of each scenario live in a directory removed at the end
+        with tempfile.TemporaryDirectory(prefix='msr_bench_') as socket_dir:
+            scenarios = [
+                ('in-memory', 'local', lambda: _run_local(
+                    InMemoryChannelLayer(capacity=messages), messages, receivers, payload, batch)),
+                ('unix-socket', 'local', lambda: _run_local(
+                    UnixSocketChannelLayer(socket_dir=os.path.join(socket_dir, 'local'), capacity=messages),
+                    messages, receivers, payload, batch)),
+                ('unix-socket', f"{options['processes']} processes", lambda: _run_cross_process(
+                    os.path.join(socket_dir, 'processes'), messages, receivers, options['processes'], payload, batch)),
+            ]
+
+            self.stdout.write(
+                f"{'backend':<12} {'scenario':<12} {'delivered':>10} {'msg/s':>10} {'p50 ms':>8} {'p99 ms':>8}"
+            )
+            for backend, scenario, run in scenarios:
+                delivered, elapsed, latencies = asyncio.run(run())
+                latencies.sort()
+                self.stdout.write(
+                    f"{backend:<12} {scenario:<12} {delivered:>10} {delivered / elapsed:>10.0f} "
+                    f"{_percentile(latencies, 0.5) * 1000:>8.2f} {_percentile(latencies, 0.99) * 1000:>8.2f}"
+                )
@@ -0,0 +1,79 @@
+"""
+Management command running the MSR ingest as a standalone process.
+
+The process owns the single TCP connection to the EtherLab server, parses and
+processes the data, and publishes every frame into a shared-memory ring. ASGI
+workers started with ``MSR_INGEST_MODE = 'shared_memory'`` read the ring and
+fan the frames out to their own WebSocket clients.
+"""
+import asyncio
+import json
+import signal
+
+from django.core.management.base import BaseCommand
+
+from msr_control import msr_protocol
+from msr_control.metrics import monitor_event_loop
+from msr_control.shm_ring import SharedFrameRing, get_shared_ring_settings
+from msr_control.snapshot import restore_snapshot, run_snapshots, save_final_snapshot
+from msr_control.system_sampler import run_sampler
+from msr_control.tasks import (
+    apply_shared_control,
+    fetch_msr_data,
+    register_shutdown_hook,
+    stop_ingest,
+)
+
+
+class Command(BaseCommand):
+    help = 'Run the EtherLab connection and publish frames to a shared-memory ring for the ASGI workers'
+
+    def add_arguments(self, parser):
+        ring_settings = get_shared_ring_settings()
+        parser.add_argument('--name', default=ring_settings['name'],
+                            help='Shared memory block name')
+        parser.add_argument('--slots', type=int, default=ring_settings['slots'],
+                            help='Number of frame slots in the ring')
+        parser.add_argument('--slot-size', type=int, default=ring_settings['slot_size'],
+                            help='Maximum encoded frame size in bytes')
+
+    def handle(self, *args, **options):
+        ring = SharedFrameRing.create(options['name'], options['slots'], options['slot_size'])
+        self.stdout.write(
+            f"Publishing frames to shared memory ring '{options['name']}' "
+            f"({options['slots']} slots of {options['slot_size']} bytes)"
+        )
+
+        msr_protocol.frame_publisher = lambda data: ring.publish(json.dumps(data).encode())
+        try:
+            asyncio.run(self.run(ring))
+        finally:
+            msr_protocol.frame_publisher = None
+            ring.close()
+
+    async def run(self, ring):
+        """Run ingest until SIGINT or SIGTERM, then shut down cleanly."""
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+
+        # Start warm from the last snapshot of this process's state
+        restore_snapshot()
+        register_shutdown_hook(save_final_snapshot)
+
+        ingest = loop.create_task(fetch_msr_data())
+        control = loop.create_task(apply_shared_control(ring))
+
+        # The frames carry this process's system statistics
+        msr_protocol.spawn_background_task(monitor_event_loop())
+        msr_protocol.spawn_background_task(run_sampler())
+        msr_protocol.spawn_background_task(run_snapshots())
+
+        await stop.wait()
+        self.stdout.write("Stopping MSR ingest")
+
+        control.cancel()
+        ingest.cancel()
+        await asyncio.gather(control, ingest, return_exceptions=True)
+        await stop_ingest()
@@ -0,0 +1,233 @@
+"""
+Process telemetry in the Prometheus text exposition format.
+
+The hot path only increments counters that already exist: the per-server
+``connection_state``, ``counters`` below and the channel layer's own stats.
+A scrape of ``/metrics`` reads those and renders one line per metric, so
+its cost depends on the number of metrics and never on the data rate.
+
+Process and host figures come from the snapshot of the background sampler
+(see system_sampler.py).
+"""
+import asyncio
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import load_shedding
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# Default metrics settings
+DEFAULT_METRICS_SETTINGS = {
+    'enabled': True,
+    'token': None,  # if set, scrapes must send "Authorization: Bearer <token>"
+    'lag_interval': 0.5  # seconds between event loop lag probes
+}
+
+# Counters incremented on the hot path
+counters = {
+    'group_sends': 0,
+    'group_send_errors': 0,
+    'relay_errors': 0  # shared-memory frames a worker could not decode
+}
+
+# Event loop lag in seconds, measured by monitor_event_loop
+loop_lag = {
+    'current': 0.0,
+    'max': 0.0
+}
+
+# channel layer name -> {'role', 'server'} of the consumers in this process
+consumers = {}
+
+# (role, server) -> messages the channel layer dropped for consumers that have
+# disconnected, so the dropped counters never go down
+departed_drops = {}
+
+
+def get_metrics_settings():
+    """Return the metrics settings with overrides from MSR_METRICS applied."""
+    metrics_settings = DEFAULT_METRICS_SETTINGS.copy()
+    metrics_settings.update(getattr(settings, 'MSR_METRICS', {}))
+    return metrics_settings
+
+
+def register_consumer(channel_name, role, server_id):
+    """Count a connected consumer."""
+    consumers[channel_name] = {'role': role, 'server': server_id}
+
+
+def unregister_consumer(channel_name):
+    """Forget a disconnected consumer, keeping its drops in the totals."""
+    consumer = consumers.pop(channel_name, None)
+    channel_layer = get_channel_layer()
+    if channel_layer is not None and hasattr(channel_layer, 'channel_drops'):
+        drops = channel_layer.channel_drops.pop(channel_name, 0)
+        if consumer is not None and drops:
+            key = (consumer['role'], consumer['server'])
+            departed_drops[key] = departed_drops.get(key, 0) + drops
+
+
+async def monitor_event_loop(interval=None):
+    """
+    Measure how late the event loop wakes up a sleeping task.
+
+    Every probe also adjusts the load shedding level (see load_shedding.py).
+
+    Args:
+        interval: Seconds between probes (MSR_METRICS lag_interval if None)
+    """
+    if interval is None:
+        interval = get_metrics_settings()['lag_interval']
+    loop = asyncio.get_running_loop()
+
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        loop_lag['current'] = lag
+        loop_lag['max'] = max(loop_lag['max'], lag)
+        await load_shedding.update_level(lag)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+class MetricsWriter:
+    """Collects metric families and renders them in the text exposition format."""
+
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, metric_type, help_text, samples):
+        """
+        Add a metric family.
+
+        Args:
+            name: Metric name
+            metric_type: 'counter' or 'gauge'
+            help_text: Description of the metric
+            samples: Iterable of (labels dict or None, value); None values are skipped
+        """
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            if value is not None:
+                self.lines.append(f"{name}{_labels(labels)} {value}")
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def render_metrics():
+    """
+    Render all metrics of this process.
+
+    Returns:
+        str: The metrics in the Prometheus text exposition format
+    """
+    from . import system_sampler
+    from .msr_protocol import servers
+    from .ratelimit import throttle_stats
+
+    writer = MetricsWriter()
+    consumer_items = list(consumers.items())
+
+    states = [({'server': server_id}, server['connection_state']) for server_id, server in servers.items()]
+    writer.family('msr_frames_received_total', 'counter', 'Messages received from the EtherLab server',
+                  ((labels, state['frames_received']) for labels, state in states))
+    writer.family('msr_bytes_received_total', 'counter', 'Bytes received from the EtherLab server',
+                  ((labels, state['bytes_received']) for labels, state in states))
+    writer.family('msr_parse_errors_total', 'counter', 'Received messages that could not be processed',
+                  ((labels, state['parse_errors']) for labels, state in states))
+    writer.family('msr_connects_total', 'counter', 'Successful connections to the EtherLab server',
+                  ((labels, state['connects']) for labels, state in states))
+    writer.family('msr_connect_failures_total', 'counter', 'Failed connection attempts to the EtherLab server',
+                  ((labels, state['connect_failures']) for labels, state in states))
+    writer.family('msr_connected', 'gauge', 'Whether the EtherLab server is connected',
+                  ((labels, int(bool(state['connected']))) for labels, state in states))
+
+    writer.family('msr_group_sends_total', 'counter', 'Samples broadcast to WebSocket groups',
+                  [(None, counters['group_sends'])])
+    writer.family('msr_group_send_errors_total', 'counter', 'Broadcasts that failed',
+                  [(None, counters['group_send_errors'])])
+    writer.family('msr_relay_errors_total', 'counter', 'Shared-memory frames skipped because they could not be decoded',
+                  [(None, counters['relay_errors'])])
+
+    by_role = {}
+    for _, consumer in consumer_items:
+        key = (consumer['role'], consumer['server'])
+        by_role[key] = by_role.get(key, 0) + 1
+    writer.family('msr_consumers', 'gauge', 'Connected WebSocket consumers',
+                  (({'role': role, 'server': server_id}, count) for (role, server_id), count in by_role.items()))
+
+    # Queues are aggregated by role and server, so the number of series does
+    # not grow with the number of connections
+    channel_layer = get_channel_layer()
+    queues = getattr(channel_layer, 'channels', {})
+    depths = {}
+    for name, consumer in consumer_items:
+        key = (consumer['role'], consumer['server'])
+        depths.setdefault(key, []).append(queues[name].qsize() if name in queues else 0)
+    writer.family('msr_consumer_queue_depth_max', 'gauge', 'Longest channel layer queue of the consumers',
+                  (({'role': role, 'server': server_id}, max(values)) for (role, server_id), values in depths.items()))
+    writer.family('msr_consumer_queue_depth_sum', 'gauge', 'Messages waiting in the channel layer queues of the consumers',
+                  (({'role': role, 'server': server_id}, sum(values)) for (role, server_id), values in depths.items()))
+
+    # Only layers that count drops per channel (UnixSocketChannelLayer) have them
+    if hasattr(channel_layer, 'channel_drops'):
+        drops = dict(departed_drops)
+        for name, consumer in consumer_items:
+            key = (consumer['role'], consumer['server'])
+            drops[key] = drops.get(key, 0) + channel_layer.channel_drops.get(name, 0)
+        writer.family('msr_consumer_dropped_total', 'counter', 'Messages dropped because a consumer\'s queue was full',
+                      (({'role': role, 'server': server_id}, count) for (role, server_id), count in drops.items()))
+    layer_stats = getattr(channel_layer, 'stats', {})
+    writer.family('msr_channel_layer_dropped_total', 'counter', 'Messages dropped by the channel layer',
+                  [(None, layer_stats.get('dropped'))])
+
+    writer.family('msr_throttled_messages_total', 'counter', 'Inbound WebSocket messages rejected by rate limits',
+                  [(None, throttle_stats['throttled'])])
+
+    writer.family('msr_event_loop_lag_seconds', 'gauge', 'Latest event loop lag',
+                  [(None, loop_lag['current'])])
+    writer.family('msr_event_loop_lag_max_seconds', 'gauge', 'Largest event loop lag seen',
+                  [(None, loop_lag['max'])])
+    writer.family('msr_load_shedding_level', 'gauge', 'Current load shedding level (0 is normal)',
+                  [(None, load_shedding.level)])
+    writer.family('msr_load_shed_total', 'counter', 'Samples not sent or recorded because of load shedding',
+                  [({'action': 'operator_rate'}, load_shedding.stats['operator_skipped']),
+                   ({'action': 'decimation'}, load_shedding.stats['decimated']),
+                   ({'action': 'history'}, load_shedding.stats['history_skipped'])])
+
+    stats = system_sampler.snapshot
+    writer.family('process_cpu_seconds_total', 'counter', 'User and system CPU time of the process',
+                  [(None, stats['cpu_seconds'])])
+    writer.family('process_resident_memory_bytes', 'gauge', 'Resident memory of the process',
+                  [(None, stats['rss_bytes'])])
+    writer.family('process_open_fds', 'gauge', 'Open file descriptors of the process',
+                  [(None, stats['open_fds'])])
+    writer.family('process_threads', 'gauge', 'Threads of the process',
+                  [(None, stats['threads'])])
+    writer.family('msr_thread_pool_queued', 'gauge', 'Calls waiting for a thread of a pool running sync code',
+                  (({'pool': pool}, pool_stats['queued']) for pool, pool_stats in stats['thread_pools'].items()))
+    writer.family('msr_thread_pool_busy', 'gauge', 'Busy threads of a pool running sync code',
+                  (({'pool': pool}, pool_stats['busy']) for pool, pool_stats in stats['thread_pools'].items()))
+    writer.family('node_load1', 'gauge', 'Host load average over one minute',
+                  [(None, stats['load_average'][0] if stats['load_average'] else None)])
+
+    return writer.render()
@@ -2,88 +2,186 @@
 Custom middleware for the MSR Control application.
 
 This module contains middleware classes for security, logging, and other purposes.
+
+Both middlewares support sync and async requests. Under ASGI the whole
+middleware chain then runs on the event loop, and async views such as
+/metrics are called without a hop to a worker thread.
 """
 import time
 import logging
+from urllib.parse import urlsplit
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.functional import empty
 
 logger = logging.getLogger('msr_control.middleware')
 
-class SecurityHeadersMiddleware:
+# Content Security Policy (CSP) directives
+# Adjust this policy based on your application's needs; every script and
+# stylesheet is served by the application itself
+CSP_DIRECTIVES = (
+    "default-src 'self'",
+    "script-src 'self'",
+    "style-src 'self' 'unsafe-inline'",
+    "img-src 'self' data:",
+    "connect-src 'self' ws: wss:",
+    "font-src 'self'",
+    "object-src 'none'",
+    "base-uri 'self'",
+    "form-action 'self'",
+    "frame-ancestors 'none'",
+)
+
+# Security headers added to every response
+SECURITY_HEADERS = {
+    'X-Content-Type-Options': 'nosniff',
+    'X-Frame-Options': 'DENY',
+    'X-XSS-Protection': '1; mode=block',
+    'Referrer-Policy': 'strict-origin-when-cross-origin',
+    'Content-Security-Policy': '; '.join(CSP_DIRECTIVES) + ';',
+}
+
+# Caching headers of responses that must never be stored: authenticated
+# pages and API responses
+NO_STORE_HEADERS = {
+    'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0',
+    'Pragma': 'no-cache',
+    'Expires': '0',
+}
+
+# Caching headers of other pages, e.g. the login page: browsers keep them
+# but ask the server again before every use
+REVALIDATE_HEADERS = {
+    'Cache-Control': 'private, no-cache',
+}
+
+# Paths of API responses
+API_PATH_PREFIXES = ('/msr_control/api/', '/metrics')
+
+
+class AsyncCapableMiddleware:
     """
-    Middleware to add security headers to HTTP responses.
-    
-    This middleware adds various security headers to HTTP responses to improve
-    the security posture of the application.
+    Base of middlewares that run both sync and async.
+
+    Subclasses implement process_response(request, response) and may
+    implement process_request(request), returning per-request state that is
+    passed to process_response.
     """
-    
+
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
-        
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
     def __call__(self, request):
-        # Process the request
-        response = self.get_response(request)
-        
-        # Add security headers
-        response['X-Content-Type-Options'] = 'nosniff'
-        response['X-Frame-Options'] = 'DENY'
-        response['X-XSS-Protection'] = '1; mode=block'
-        response['Referrer-Policy'] = 'strict-origin-when-cross-origin'
-        response['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-        response['Pragma'] = 'no-cache'
-        response['Expires'] = '0'
-        
-        # Add Content Security Policy (CSP) header
-        # Adjust this policy based on your application's needs
-        csp_policy = (
-            "default-src 'self'; "
-            "script-src 'self' https://cdn.jsdelivr.net; "
-            "style-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net; "
-            "img-src 'self' data:; "
-            "connect-src 'self' ws: wss:; "
-            "font-src 'self'; "
-            "object-src 'none'; "
-            "base-uri 'self'; "
-            "form-action 'self'; "
-            "frame-ancestors 'none';"
-        )
-        response['Content-Security-Policy'] = csp_policy
-        
+        if self.is_async:
+            return self.__acall__(request)
+        state = self.process_request(request)
+        return self.process_response(request, self.get_response(request), state)
+
+    async def __acall__(self, request):
+        state = self.process_request(request)
+        return self.process_response(request, await self.get_response(request), state)
+
+    def process_request(self, request):
+        return None
+
+
+class SecurityHeadersMiddleware(AsyncCapableMiddleware):
+    """
+    Middleware to add security headers to HTTP responses.
+
+    This middleware adds various security headers to HTTP responses to improve
+    the security posture of the application. The headers are built once when
+    the middleware is created.
+
+    Authenticated pages and API responses get no-store caching headers;
+    other pages must be revalidated. Responses that set their own
+    Cache-Control keep it. Static files are served before the middleware
+    (see static_files.py) with their own long-lived caching.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.headers = tuple(dict(SECURITY_HEADERS, **{
+            'Content-Security-Policy': content_security_policy()
+        }).items())
+        self.no_store_headers = tuple(NO_STORE_HEADERS.items())
+        self.revalidate_headers = tuple(REVALIDATE_HEADERS.items())
+
+    def process_response(self, request, response, state):
+        headers = response.headers
+        for name, value in self.headers:
+            headers[name] = value
+
+        if 'Cache-Control' not in headers:
+            if request.path.startswith(API_PATH_PREFIXES) or settings.SESSION_COOKIE_NAME in request.COOKIES:
+                cache_headers = self.no_store_headers
+            else:
+                cache_headers = self.revalidate_headers
+            for name, value in cache_headers:
+                headers[name] = value
         return response
 
-class RequestLoggingMiddleware:
+
+def content_security_policy():
+    """
+    Return the Content Security Policy header value.
+
+    A Chart.js URL configured in MSR_CHART_JS_URL on another origin is added
+    to script-src.
+
+    Returns:
+        str: The policy
+    """
+    directives = list(CSP_DIRECTIVES)
+    url = urlsplit(getattr(settings, 'MSR_CHART_JS_URL', None) or '')
+    if url.scheme and url.netloc:
+        directives = [
+            f"{directive} {url.scheme}://{url.netloc}" if directive.startswith('script-src ') else directive
+            for directive in directives
+        ]
+    return '; '.join(directives) + ';'
+
+
+def _username(request):
+    """
+    Return the name of the request's user without loading it.
+
+    The user is only known if something in the request already resolved it
+    (e.g. login_required); otherwise resolving it here would cost a database
+    query, which an async request could not even make on the event loop.
+    """
+    user = getattr(request, 'user', None)
+    user = getattr(user, '_wrapped', user)
+    if user is None or user is empty:
+        return '-'
+    return getattr(user, 'username', None) or 'anonymous'
+
+
+class RequestLoggingMiddleware(AsyncCapableMiddleware):
     """
     Middleware to log HTTP requests and responses.
-    
+
     This middleware logs information about incoming HTTP requests and outgoing
-    responses, including timing information.
+    responses, including timing information. Records are formatted lazily and
+    written by the queue listener thread (see utils/logger.py).
     """
-    
-    def __init__(self, get_response):
-        self.get_response = get_response
-        
-    def __call__(self, request):
+
+    def process_request(self, request):
         # Start timing
-        start_time = time.time()
-        
-        # Get request details
-        method = request.method
-        path = request.path
-        
-        # Process the request
-        response = self.get_response(request)
-        
-        # Calculate request duration
-        duration = time.time() - start_time
-        
-        # Log the request
-        status_code = response.status_code
-        user = request.user.username if hasattr(request.user, 'username') else 'anonymous'
-        
-        logger.info(
-            f"Request: {method} {path} - "
-            f"Status: {status_code} - "
-            f"User: {user} - "
-            f"Duration: {duration:.3f}s"
-        )
-        
+        return time.perf_counter()
+
+    def process_response(self, request, response, start_time):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Request: %s %s - Status: %s - User: %s - Duration: %.3fs",
+                request.method, request.path, response.status_code,
+                _username(request), time.perf_counter() - start_time
+            )
         return response
@@ -5,26 +5,41 @@ This module handles the TCP connection to the EtherLab server, processes the
 incoming data, and sends it to the WebSocket layer for real-time visualization.
 """
 import asyncio
+import copy
 import socket
 import json
+import math
 import random
+import re
 import time
 from channels.layers import get_channel_layer
 from django.conf import settings
 
+from . import instrumentation, load_shedding, system_sampler
+from .metrics import counters
+from .autocal import observe_raw_value
+from .channel_index import RELOAD_TAG, ChannelIndex, channel_group_name, decode_fields, load_channel_index
+from .framing import MessageFramer, element_tag, parse_attributes
+from .history import record_sample
+from .parameter_tree import ParameterTree, handle_parameter_update, load_parameter_tree
+from .parameters import PARAMETER_REPLY_TAGS, ParameterClient
+
 # Try to import the logger, but don't fail if it's not available yet
 try:
-    from .utils.logger import get_logger
+    from .utils.logger import get_logger, get_rate_limited_logger
     logger = get_logger()
+    # Per-sample and repeating messages, logged at most once per interval
+    limited_logger = get_rate_limited_logger()
 except ImportError:
     import logging
-    logger = logging.getLogger(__name__)
+    logger = limited_logger = logging.getLogger(__name__)
 
 # Default calibration settings
 DEFAULT_CALIBRATION_SETTINGS = {
     'offset': 0.0,
     'gain': 1.0,
-    'filter': 0.5
+    'filter': 0.5,
+    'polynomial': None  # Coefficients (highest power first) replacing gain/offset when set
 }
 
 # Default connection settings
@@ -34,9 +49,27 @@ DEFAULT_CONNECTION_SETTINGS = {
     'timeout': 30,
     'retry_attempts': 3,
     'buffer_size': 1024,
-    'reconnect_delay': 5  # seconds to wait before reconnecting
+    'reconnect_delay': 5,  # base of the jittered reconnect backoff in seconds
+    'max_reconnect_delay': 60,
+    'standby': [],  # standby servers to fail over to, as {'host', 'port'}
+    'parameter_timeout': 5,  # seconds to wait for the server to confirm a parameter write
+    'calibration_parameters': {}  # calibration setting -> server parameter path it is written to
 }
 
+# Channel name used for the value stream parsed from the server
+DEFAULT_CHANNEL = 'msr_data'
+
+# Identifier of the server configured by connection_settings; further servers
+# come from the MSR_ETHERLAB_SERVERS setting
+DEFAULT_SERVER = 'default'
+
+# Server identifiers appear in URLs, group and channel names
+SERVER_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,50}$')
+
+# Matches the server-side sample time of an MSR <data> element,
+# e.g. <data level="0" time="1700000000.123456">
+SERVER_TIME_PATTERN = re.compile(rb'<data\b[^>]*\btime="([-+0-9.eE]+)"')
+
 # Global settings (initialized with defaults)
 calibration_settings = DEFAULT_CALIBRATION_SETTINGS.copy()
 connection_settings = DEFAULT_CONNECTION_SETTINGS.copy()
@@ -46,34 +79,204 @@ connection_state = {
     'connected': False,
     'last_connected': None,
     'reconnect_attempts': 0,
-    'last_error': None
+    'last_error': None,
+    'frames_received': 0,
+    'bytes_received': 0,
+    'parse_errors': 0,
+    'connects': 0,
+    'connect_failures': 0,
+    'last_frame_at': None,
+    'state': 'idle',  # connection supervisor state
+    'endpoint': None  # host:port of the active connection
 }
 
-async def connect_to_etherlab():
+# server id -> session state with its own 'connection_settings',
+# 'calibration_settings', 'connection_state', channel and WebSocket group.
+# The default server uses the module-level dictionaries above.
+servers = {}
+
+# Optional callable that takes over frame publishing from the channel layer
+# (set by the standalone ingest process to publish into shared memory)
+frame_publisher = None
+
+# Optional callable notified of settings changes as (section, server id, settings)
+# (set by ASGI workers to forward changes to the standalone ingest process)
+settings_forwarder = None
+
+# Tasks spawned by the protocol layer, tracked so they can be cancelled on shutdown
+background_tasks = set()
+
+def register_server(server_id, connection=None, calibration=None):
     """
-    Establishes a TCP connection to the EtherLab server and processes incoming data.
+    Register an EtherLab server with its own settings, state and group.
+
+    Args:
+        server_id: Identifier used in URLs, group and channel names
+        connection: Connection settings overriding the defaults
+        calibration: Calibration settings overriding the defaults
 
-    This function handles connection establishment, data reception, and error recovery.
-    If the connection fails, it will attempt to reconnect based on the retry settings.
+    Returns:
+        dict: The server's session state
+    """
+    if not SERVER_ID_PATTERN.match(server_id):
+        raise ValueError(f"Invalid server identifier: {server_id}")
+
+    if server_id == DEFAULT_SERVER:
+        server = {
+            'connection_settings': connection_settings,
+            'calibration_settings': calibration_settings,
+            'connection_state': connection_state,
+            'channel': DEFAULT_CHANNEL
+        }
+    else:
+        server = {
+            'connection_settings': DEFAULT_CONNECTION_SETTINGS.copy(),
+            'calibration_settings': DEFAULT_CALIBRATION_SETTINGS.copy(),
+            'connection_state': {key: None for key in connection_state},
+            'channel': f"{DEFAULT_CHANNEL}_{server_id}"
+        }
+        server['connection_state'].update({
+            'connected': False,
+            'reconnect_attempts': 0,
+            'frames_received': 0,
+            'bytes_received': 0,
+            'parse_errors': 0,
+            'connects': 0,
+            'connect_failures': 0,
+            'state': 'idle'
+        })
+
+    server['connection_settings'].update(connection or {})
+    server['calibration_settings'].update(calibration or {})
+    server.update({
+        'id': server_id,
+        'configured_connection': copy.deepcopy(server['connection_settings']),  # as configured, before runtime changes
+        'group': server['channel'],  # WebSocket group of the server's clients
+        'last_value': None,  # Low-pass filter state
+        'channel_values': {},  # channel path -> latest value of other subscribed channels
+        'socket': None,  # Socket of the active connection
+        'subscriptions': {},  # key -> command replayed after every reconnect
+        'supervisor': None,  # ConnectionSupervisor running the connection
+        'parameter_client': None,  # ParameterClient, created on first use
+        'parameter_tree': ParameterTree(),  # Cached parameters, loaded on every connection
+        'channel_index': ChannelIndex(),  # Channel trie, loaded on every connection and reload
+        'channel_patterns': {},  # channel pattern -> channel layer names of subscribed clients
+        'subscribed_channels': set()  # channel indices the server is subscribed to
+    })
+    servers[server_id] = server
+    return server
+
+def load_servers():
+    """Register the default server and those listed in MSR_ETHERLAB_SERVERS."""
+    servers.clear()
+    extra_servers = dict(getattr(settings, 'MSR_ETHERLAB_SERVERS', {}))
+    default_options = dict(extra_servers.pop(DEFAULT_SERVER, {}))
+    register_server(DEFAULT_SERVER, default_options, default_options.pop('calibration', None))
+
+    for server_id, options in extra_servers.items():
+        options = dict(options)
+        calibration = options.pop('calibration', None)
+        register_server(server_id, options, calibration)
+
+def get_server(server_id=None):
     """
-    global connection_state
+    Return the session state of a server.
 
-    host = connection_settings['host']
-    port = connection_settings['port']
-    buffer_size = connection_settings['buffer_size']
-    max_retries = connection_settings['retry_attempts']
-    reconnect_delay = connection_settings['reconnect_delay']
+    Args:
+        server_id: The server identifier (the default server if None)
 
-    logger.info(f"Connecting to EtherLab server at {host}:{port}")
+    Returns:
+        dict: The server's session state
+
+    Raises:
+        KeyError: If no such server is configured
+    """
+    return servers[server_id or DEFAULT_SERVER]
+
+def server_health():
+    """
+    Return the connection health of every server.
+
+    Returns:
+        dict: server id -> address and connection state
+    """
+    return {
+        server_id: dict(
+            server['connection_state'],
+            host=server['connection_settings']['host'],
+            port=server['connection_settings']['port']
+        )
+        for server_id, server in servers.items()
+    }
+
+def get_parameter_client(server_id=DEFAULT_SERVER):
+    """
+    Return the parameter client of a server, creating it on first use.
+
+    Args:
+        server_id: The server identifier
+
+    Returns:
+        ParameterClient: The server's parameter client
+    """
+    server = get_server(server_id)
+    if server['parameter_client'] is None:
+        server['parameter_client'] = ParameterClient(
+            server_id,
+            lambda command: send_command(server_id, command),
+            timeout=server['connection_settings']['parameter_timeout']
+        )
+    return server['parameter_client']
+
+def spawn_background_task(coro):
+    """
+    Run a coroutine as a tracked background task on the running loop.
+
+    Args:
+        coro: The coroutine to run
+
+    Returns:
+        asyncio.Task: The created task
+    """
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def connect_to_etherlab(server_id=DEFAULT_SERVER, host=None, port=None, on_connected=None):
+    """
+    Run one connection session with an EtherLab server.
 
-    # Update connection state
-    connection_state['reconnect_attempts'] += 1
+    Connects, replays the server's active subscriptions and processes
+    incoming data until the connection is closed. Reconnecting, failover to
+    standby servers and the demo data fallback are handled by the connection
+    supervisor (see supervisor.py), so this function does not retry.
+
+    Args:
+        server_id: The server to connect to
+        host: Host to connect to (the server's configured host if None)
+        port: Port to connect to (the server's configured port if None)
+        on_connected: Optional callable invoked once the connection is established
+
+    Raises:
+        ConnectionError: If the connection cannot be established
+    """
+    server = get_server(server_id)
+    connection_settings = server['connection_settings']
+    connection_state = server['connection_state']
+
+    host = host or connection_settings['host']
+    port = port or connection_settings['port']
+    buffer_size = connection_settings['buffer_size']
+
+    logger.info(f"Connecting to EtherLab server {server_id} at {host}:{port}")
 
     # Get the event loop
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
 
     # Create a socket with timeout
     s = None
+    framer = MessageFramer()
 
     try:
         # Create a non-blocking socket
@@ -82,69 +285,113 @@ async def connect_to_etherlab():
 
         # Connect the socket asynchronously with timeout
         try:
-            # Set a timeout for the connection attempt
-            connect_task = loop.sock_connect(s, (host, port))
-            await asyncio.wait_for(connect_task, timeout=connection_settings['timeout'])
+            await asyncio.wait_for(loop.sock_connect(s, (host, port)), timeout=connection_settings['timeout'])
+        except asyncio.TimeoutError:
+            limited_logger.error("Connection timeout after %s seconds", connection_settings['timeout'])
+            raise ConnectionError("Connection timeout")
 
-            # Update connection state on successful connection
-            connection_state['connected'] = True
-            connection_state['last_connected'] = time.time()
-            connection_state['reconnect_attempts'] = 0
-            connection_state['last_error'] = None
+        # Update connection state on successful connection
+        connection_state['connected'] = True
+        connection_state['connects'] += 1
+        connection_state['last_connected'] = time.time()
+        connection_state['last_error'] = None
+        connection_state['endpoint'] = f"{host}:{port}"
+        server['socket'] = s
+
+        logger.info(f"Successfully connected to EtherLab server {server_id} at {host}:{port}")
+        if on_connected is not None:
+            on_connected()
+
+        # Restore the subscriptions of the previous connection
+        for command in list(server['subscriptions'].values()):
+            await loop.sock_sendall(s, command)
+        if server['subscriptions']:
+            logger.info(f"Replayed {len(server['subscriptions'])} subscriptions to {server_id}")
+
+        # Read the parameter tree and channel list while the loop below receives the replies
+        spawn_background_task(load_parameter_tree(server_id))
+        spawn_background_task(load_channel_index(server_id))
+
+        # Process data in a loop
+        while True:
+            try:
+                # Receive data asynchronously with timeout
+                data_task = loop.sock_recv(s, buffer_size)
+                data = await asyncio.wait_for(data_task, timeout=connection_settings['timeout'])
 
-            logger.info(f"Successfully connected to EtherLab server at {host}:{port}")
+                if not data:
+                    logger.warning(f"Received empty data from {server_id}, connection may be closed")
+                    break
 
-            # Process data in a loop
-            while True:
+                received = time.perf_counter()
+                received_at = time.time()
+                connection_state['bytes_received'] += len(data)
+                messages = framer.feed(data)
+                instrumentation.record('recv', received)
+
+                for message in messages:
+                    # Replies to parameter commands are not samples; late
+                    # replies to timed-out requests are dropped
+                    tag = element_tag(message)
+                    if tag in PARAMETER_REPLY_TAGS:
+                        if server['parameter_client'] is not None:
+                            server['parameter_client'].handle_reply(tag, parse_attributes(message), message)
+                        continue
+                    if tag == 'pu':
+                        handle_parameter_update(server_id, parse_attributes(message))
+                        continue
+                    if tag == RELOAD_TAG:
+                        logger.info(f"Server {server_id} reloaded, reading its channels and parameters again")
+                        spawn_background_task(load_parameter_tree(server_id))
+                        spawn_background_task(load_channel_index(server_id))
+                        continue
+
+                    connection_state['frames_received'] += 1
+                    connection_state['last_frame_at'] = received_at
+
+                    # Values of subscribed channels are processed one by one;
+                    # other frames stand for the server's own channel
+                    fields = decode_fields(server['channel_index'], message) if tag == 'data' else []
+                    if not fields:
+                        processed = [await process_data(message, server_id=server_id, received_at=received_at)]
+                    else:
+                        timestamp = extract_server_time(message)
+                        processed = [
+                            await process_data(message, timestamp, path, server_id, raw_value=value,
+                                               channel_index=index, received_at=received_at)
+                            for path, index, value in fields
+                        ]
+
+                    # Send the processed data to WebSocket
+                    published = time.perf_counter()
+                    for processed_data in processed:
+                        await send_data_to_websocket(processed_data)
+                    instrumentation.record('publish', published)
+
+            except asyncio.TimeoutError:
+                limited_logger.warning("Timeout while receiving data from %s", server_id)
+                # Send a heartbeat to check if the connection is still alive
                 try:
-                    # Receive data asynchronously with timeout
-                    data_task = loop.sock_recv(s, buffer_size)
-                    data = await asyncio.wait_for(data_task, timeout=connection_settings['timeout'])
-
-                    if not data:
-                        logger.warning("Received empty data, connection may be closed")
-                        break
-
-                    # Process the data and send it to WebSocket
-                    processed_data = await process_data(data)
-                    await send_data_to_websocket(processed_data)
-
-                except asyncio.TimeoutError:
-                    logger.warning("Timeout while receiving data")
-                    # Send a heartbeat to check if the connection is still alive
-                    try:
-                        s.send(b'\x00')  # Send a null byte as heartbeat
-                    except (BlockingIOError, ConnectionError):
-                        logger.error("Connection lost during heartbeat")
-                        break
-
-                except Exception as e:
-                    logger.error(f"Error while processing data: {str(e)}")
+                    s.send(b'\x00')  # Send a null byte as heartbeat
+                except (BlockingIOError, ConnectionError):
+                    logger.error("Connection lost during heartbeat")
                     break
 
-        except asyncio.TimeoutError:
-            logger.error(f"Connection timeout after {connection_settings['timeout']} seconds")
-            connection_state['last_error'] = "Connection timeout"
-            raise ConnectionError("Connection timeout")
-
     except (ConnectionRefusedError, ConnectionError, OSError) as e:
         # Update connection state on failure
-        connection_state['connected'] = False
         connection_state['last_error'] = str(e)
-
-        logger.error(f"Connection error: {str(e)}")
-
-        # Decide whether to retry or use demo data
-        if connection_state['reconnect_attempts'] <= max_retries:
-            logger.info(f"Reconnecting in {reconnect_delay} seconds (attempt {connection_state['reconnect_attempts']} of {max_retries})")
-            await asyncio.sleep(reconnect_delay)
-            asyncio.create_task(connect_to_etherlab())
-        else:
-            logger.warning(f"Max reconnection attempts reached ({max_retries}), switching to demo data")
-            # For demo purposes, generate random data if connection fails
-            asyncio.create_task(generate_demo_data())
+        if not connection_state['connected']:
+            connection_state['connect_failures'] += 1
+        limited_logger.error("Connection error (%s): %s", server_id, e)
+        raise ConnectionError(str(e)) from e
 
     finally:
+        connection_state['connected'] = False
+        server['socket'] = None
+        server['subscribed_channels'] = set()
+        if server['parameter_client'] is not None:
+            server['parameter_client'].connection_lost()
+
         # Clean up the socket
         if s:
             try:
@@ -153,17 +400,142 @@ async def connect_to_etherlab():
             except Exception as e:
                 logger.error(f"Error closing socket: {str(e)}")
 
-async def process_data(data):
+async def send_command(server_id, command):
+    """
+    Send a command to a connected EtherLab server.
+
+    Args:
+        server_id: The server to send to
+        command: The encoded command as bytes
+
+    Returns:
+        bool: True if the command was sent, False if the server is not connected
+    """
+    sock = get_server(server_id)['socket']
+    if sock is None:
+        return False
+    await asyncio.get_running_loop().sock_sendall(sock, command)
+    return True
+
+async def subscribe(server_id, key, command):
+    """
+    Register a subscription that is sent now and replayed after every reconnect.
+
+    Args:
+        server_id: The server to subscribe on
+        key: Identifier of the subscription, e.g. a channel or parameter path
+        command: The encoded subscription command as bytes
+
+    Returns:
+        bool: True if the command was sent now, False if it waits for the connection
+    """
+    get_server(server_id)['subscriptions'][key] = command
+    return await send_command(server_id, command)
+
+async def unsubscribe(server_id, key, command=None):
+    """
+    Remove a subscription, optionally sending a command that cancels it.
+
+    Args:
+        server_id: The server the subscription is on
+        key: Identifier of the subscription
+        command: Optional encoded command cancelling the subscription
+
+    Returns:
+        bool: True if a cancelling command was sent
+    """
+    get_server(server_id)['subscriptions'].pop(key, None)
+    if command is None:
+        return False
+    return await send_command(server_id, command)
+
+def evaluate_polynomial(coefficients, x):
+    """
+    Evaluate a calibration polynomial using Horner's scheme.
+
+    Args:
+        coefficients: Polynomial coefficients, highest power first
+        x: Value to evaluate the polynomial at
+
+    Returns:
+        float: The polynomial value
+    """
+    result = 0.0
+    for coefficient in coefficients:
+        result = result * x + coefficient
+    return result
+
+def history_channel(server, channel):
+    """
+    Return the history key of a channel of a server.
+
+    The server's own channel is kept under its name; subscribed channels are
+    kept below it (e.g. msr_data_line2/Line1/Motor/Current), as several
+    servers may have channels with the same path.
+
+    Args:
+        server: The server's session state
+        channel: The server's channel name or a channel path
+
+    Returns:
+        str: The channel's key in history.channel_history
+    """
+    return channel if channel == server['channel'] else server['channel'] + channel
+
+def extract_server_time(data):
+    """
+    Extract the server-side sample time from an MSR data frame.
+
+    Args:
+        data: Raw binary data received from the EtherLab server
+
+    Returns:
+        float: The sample time in seconds, or None if the frame carries no time
+    """
+    match = SERVER_TIME_PATTERN.search(data)
+    if match is None:
+        return None
+    try:
+        return float(match.group(1))
+    except ValueError:
+        return None
+
+async def process_data(data, timestamp=None, channel=None, server_id=DEFAULT_SERVER,
+                       raw_value=None, channel_index=None, received_at=None):
     """
     Process the MSR data with calibration settings applied.
 
+    Calibration and filtering apply to the server's channel only; values of
+    other subscribed channels are passed through unchanged.
+
+    The sample is stamped with the time reported by the EtherLab server. Only
+    when neither the caller nor the frame provides one does the local receive
+    time stand in for it.
+
     Args:
         data: Raw binary data received from the EtherLab server
+        timestamp: Server-side sample time in seconds (taken from the frame if None)
+        channel: Name of the channel the data belongs to (the server's channel if None)
+        server_id: The server the data was received from
+        raw_value: Value decoded from the frame for a subscribed channel; if
+            None the frame stands for the server's channel and is averaged
+        channel_index: Server index of a subscribed channel, included in the
+            sample so only its subscribers receive it
+        received_at: Wall-clock time the frame was read from the socket (now if None)
 
     Returns:
         dict: Processed data structure with various levels of detail for different roles
     """
+    server = get_server(server_id)
+    connection_settings = server['connection_settings']
+    calibration_settings = server['calibration_settings']
+    connection_state = server['connection_state']
+    if channel is None:
+        channel = server['channel']
+
     try:
+        started = time.perf_counter()
+
         # For demonstration, convert bytes to a simple numeric value
         # In a real application, you would parse the MSR protocol data properly
         if not data:
@@ -173,58 +545,82 @@ async def process_data(data):
         if not isinstance(data, bytes):
             data = bytes(data)
 
-        # Parse the data (simplified for demonstration)
-        raw_value = sum(data) / len(data)
+        if raw_value is None:
+            # Parse the data (simplified for demonstration)
+            raw_value = sum(data) / len(data)
 
-        # Apply calibration with bounds checking
-        try:
-            offset = float(calibration_settings.get('offset', 0.0))
-            gain = float(calibration_settings.get('gain', 1.0))
-            filter_val = float(calibration_settings.get('filter', 0.5))
+        calibrated = channel == server['channel']
+        if calibrated:
+            # Feed an open auto-calibration hold window
+            observe_raw_value(raw_value, server_id)
 
-            # Ensure gain is not zero to avoid division by zero
-            if gain == 0:
-                gain = 1.0
-                logger.warning("Gain was set to zero, defaulting to 1.0")
+        calibration_started = time.perf_counter()
+        instrumentation.record('parse', started)
 
-            # Ensure filter is between 0 and 1
-            filter_val = max(0.0, min(1.0, filter_val))
+        # Only the server's channel is calibrated and filtered; other
+        # subscribed channels are passed through as the server sent them
+        if calibrated:
+            # Apply calibration with bounds checking
+            try:
+                offset = float(calibration_settings.get('offset', 0.0))
+                gain = float(calibration_settings.get('gain', 1.0))
+                filter_val = float(calibration_settings.get('filter', 0.5))
 
-            # Apply calibration
-            calibrated_value = (raw_value + offset) * gain
+                # Ensure gain is not zero to avoid division by zero
+                if gain == 0:
+                    gain = 1.0
+                    logger.warning("Gain was set to zero, defaulting to 1.0")
+
+                # Ensure filter is between 0 and 1
+                filter_val = max(0.0, min(1.0, filter_val))
 
-        except (ValueError, TypeError) as e:
-            logger.error(f"Calibration error: {str(e)}")
-            # Use default values if calibration fails
-            calibrated_value = raw_value
+                # Apply calibration
+                polynomial = calibration_settings.get('polynomial')
+                if polynomial:
+                    calibrated_value = evaluate_polynomial(polynomial, raw_value)
+                else:
+                    calibrated_value = (raw_value + offset) * gain
 
-        # Apply filtering (simple low-pass filter for demonstration)
-        # Store last value in a class variable for persistence
-        last_value = getattr(process_data, 'last_value', None)
+            except (ValueError, TypeError) as e:
+                logger.error(f"Calibration error: {str(e)}")
+                # Use default values if calibration fails
+                calibrated_value = raw_value
 
-        if last_value is not None:
-            filtered_value = (filter_val * calibrated_value +
-                             (1 - filter_val) * last_value)
+            # Apply filtering (simple low-pass filter for demonstration)
+            last_value = server['last_value']
+            if last_value is not None:
+                filtered_value = (filter_val * calibrated_value +
+                                 (1 - filter_val) * last_value)
+            else:
+                filtered_value = calibrated_value
+
+            # Update the last value
+            server['last_value'] = filtered_value
         else:
-            filtered_value = calibrated_value
+            calibrated_value = filtered_value = raw_value
+            server['channel_values'][channel] = raw_value
+        instrumentation.record('calibrate', calibration_started)
 
-        # Update the last value
-        process_data.last_value = filtered_value
+        # Keep the server's timing; the receive time is only a fallback
+        if received_at is None:
+            received_at = time.time()
+        if timestamp is None:
+            timestamp = extract_server_time(data)
+        if timestamp is None:
+            timestamp = received_at
 
-        # Get current timestamp
-        current_time = time.time()
+        # Keep the calibrated value in the channel history for alignment
+        record_sample(history_channel(server, channel), timestamp, calibrated_value)
 
         # Create a data structure with different levels of detail for different roles
         processed_data = {
-            'timestamp': current_time,
+            'timestamp': timestamp,
+            'received_at': received_at,
+            'server': server_id,
+            'channel': channel,
             'raw_value': raw_value,  # Only visible to calibrators and admins
             'calibrated_value': calibrated_value,  # Visible to all
             'filtered_value': filtered_value,  # Visible to all
-            'calibration_data': {  # Only visible to calibrators and admins
-                'offset': calibration_settings['offset'],
-                'gain': calibration_settings['gain'],
-                'filter': calibration_settings['filter']
-            },
             'connection_state': {  # Connection status information
                 'connected': connection_state['connected'],
                 'last_connected': connection_state['last_connected'],
@@ -236,20 +632,30 @@ async def process_data(data):
                     'port': connection_settings['port'],
                     'buffer_size': connection_settings['buffer_size']
                 },
-                'system_stats': {
-                    'memory_usage': random.randint(10, 90),  # Mock data
-                    'cpu_usage': random.randint(5, 80)  # Mock data
-                }
+                'system_stats': system_sampler.snapshot
             }
         }
 
-        logger.debug(f"Processed data: raw={raw_value:.2f}, calibrated={calibrated_value:.2f}, filtered={filtered_value:.2f}")
+        if calibrated:
+            processed_data['calibration_data'] = {  # Only visible to calibrators and admins
+                'offset': calibration_settings['offset'],
+                'gain': calibration_settings['gain'],
+                'filter': calibration_settings['filter'],
+                'polynomial': calibration_settings['polynomial']
+            }
+        if channel_index is not None:
+            processed_data['channel_index'] = channel_index
+
+        limited_logger.debug("Processed data: raw=%.2f, calibrated=%.2f, filtered=%.2f",
+                             raw_value, calibrated_value, filtered_value)
         return processed_data
 
     except Exception as e:
-        logger.error(f"Error processing data: {str(e)}")
+        limited_logger.error("Error processing data: %s", e)
+        connection_state['parse_errors'] += 1
         return {
             'timestamp': time.time(),
+            'server': server_id,
             'error': str(e),
             'connection_state': {
                 'connected': connection_state['connected'],
@@ -259,38 +665,80 @@ async def process_data(data):
             }
         }
 
-async def send_data_to_websocket(data):
+async def send_data_to_websocket(data, local_only=False):
     """
     Send the processed data to the frontend via WebSockets.
 
+    The data goes to the WebSocket group of the server named by its 'server'
+    field, so clients only receive the server they are watching. Values of
+    subscribed channels go to the channel's group, which only the clients
+    subscribed to the channel join.
+
+    While load shedding decimates (see load_shedding.py), only every n-th
+    sample of a server is sent.
+
     Args:
         data: Processed data dictionary to send to clients
+        local_only: Only deliver to clients of this process, for channel
+            layers that span several processes (see channel_layer.py). Used
+            to relay frames of the ingest process, which already decimated them
     """
     try:
+        if not local_only and load_shedding.level >= load_shedding.DECIMATE and \
+                not load_shedding.keep_broadcast(data.get('server', DEFAULT_SERVER)):
+            return
+
+        if frame_publisher is not None:
+            frame_publisher(data)
+            return
+
         channel_layer = get_channel_layer()
         if channel_layer is None:
             logger.error("Channel layer not available")
             return
 
-        await channel_layer.group_send(
-            "msr_data",  # WebSocket group name
+        group_send = channel_layer.group_send
+        if local_only and hasattr(channel_layer, 'group_send_local'):
+            group_send = channel_layer.group_send_local
+
+        server = servers.get(data.get('server', DEFAULT_SERVER))
+        if server is None:
+            limited_logger.warning("Dropping data from unknown server %s", data.get('server'))
+            return
+
+        group = server['group']  # WebSocket group name
+        if 'channel_index' in data:
+            group = channel_group_name(group, data['channel'])
+
+        await group_send(
+            group,
             {
                 "type": "send_data",  # This triggers the send_data method in the WebSocket consumer
                 "data": data,
             }
         )
-        logger.debug("Data sent to WebSocket")
+        counters['group_sends'] += 1
     except Exception as e:
-        logger.error(f"Error sending data to WebSocket: {str(e)}")
+        counters['group_send_errors'] += 1
+        limited_logger.error("Error sending data to WebSocket: %s", e)
 
-async def generate_demo_data():
+async def generate_demo_data(server_id=DEFAULT_SERVER):
     """
     Generate demo data for testing when no real connection is available.
 
     This function runs in an infinite loop, generating random data points
     that simulate real MSR data from the EtherLab server.
+
+    Args:
+        server_id: The server whose data is simulated
     """
-    logger.info("Starting demo data generation")
+    server = get_server(server_id)
+    connection_settings = server['connection_settings']
+    calibration_settings = server['calibration_settings']
+    connection_state = server['connection_state']
+    channel = server['channel']
+
+    logger.info(f"Starting demo data generation for {server_id}")
 
     # Update connection state to indicate we're using demo data
     connection_state['connected'] = False
@@ -329,6 +777,9 @@ async def generate_demo_data():
             # Use the base value as our raw value
             raw_value = base_value
 
+            # Feed an open auto-calibration hold window
+            observe_raw_value(raw_value, server_id)
+
             # Apply calibration with error handling
             try:
                 offset = float(calibration_settings.get('offset', 0.0))
@@ -343,14 +794,18 @@ async def generate_demo_data():
                 filter_val = max(0.0, min(1.0, filter_val))
 
                 # Apply calibration
-                calibrated_value = (raw_value + offset) * gain
+                polynomial = calibration_settings.get('polynomial')
+                if polynomial:
+                    calibrated_value = evaluate_polynomial(polynomial, raw_value)
+                else:
+                    calibrated_value = (raw_value + offset) * gain
 
             except (ValueError, TypeError) as e:
                 logger.error(f"Demo data calibration error: {str(e)}")
                 calibrated_value = raw_value
 
             # Apply filtering
-            last_value = getattr(generate_demo_data, 'last_value', None)
+            last_value = server['last_value']
             if last_value is not None:
                 filtered_value = (filter_val * calibrated_value +
                                  (1 - filter_val) * last_value)
@@ -358,14 +813,20 @@ async def generate_demo_data():
                 filtered_value = calibrated_value
 
             # Update the last value
-            generate_demo_data.last_value = filtered_value
+            server['last_value'] = filtered_value
 
             # Get current timestamp
             current_time = time.time()
 
+            # Keep the calibrated value in the channel history for alignment
+            record_sample(channel, current_time, calibrated_value)
+
             # Create a data structure with different levels of detail for different roles
             processed_data = {
                 'timestamp': current_time,
+                'received_at': current_time,
+                'server': server_id,
+                'channel': channel,
                 'raw_value': raw_value,
                 'calibrated_value': calibrated_value,
                 'filtered_value': filtered_value,
@@ -373,7 +834,8 @@ async def generate_demo_data():
                 'calibration_data': {
                     'offset': calibration_settings['offset'],
                     'gain': calibration_settings['gain'],
-                    'filter': calibration_settings['filter']
+                    'filter': calibration_settings['filter'],
+                    'polynomial': calibration_settings['polynomial']
                 },
                 'connection_state': {
                     'connected': False,
@@ -387,44 +849,55 @@ async def generate_demo_data():
                         'port': connection_settings['port'],
                         'buffer_size': connection_settings['buffer_size']
                     },
-                    'system_stats': {
-                        'memory_usage': random.randint(10, 90),
-                        'cpu_usage': random.randint(5, 80)
-                    }
+                    'system_stats': system_sampler.snapshot
                 }
             }
 
             # Send the demo data to WebSocket
             await send_data_to_websocket(processed_data)
-            logger.debug(f"Generated demo data: raw={raw_value:.2f}, filtered={filtered_value:.2f}")
+            limited_logger.debug("Generated demo data: raw=%.2f, filtered=%.2f", raw_value, filtered_value)
 
     except asyncio.CancelledError:
         logger.info("Demo data generation cancelled")
     except Exception as e:
+        # The connection supervisor restarts demo data while still disconnected
         logger.error(f"Error in demo data generation: {str(e)}")
-        # Try to restart the demo data generation
-        asyncio.create_task(generate_demo_data())
 
-async def update_calibration(new_settings):
+async def update_calibration(new_settings, server_id=DEFAULT_SERVER):
     """
-    Update the calibration settings.
+    Update the calibration settings of a server.
+
+    All provided settings are validated first and then applied together, so a
+    sample is never processed with a half-updated calibration.
+
+    Settings mapped to server parameters by the 'calibration_parameters'
+    connection setting are written to the connected EtherLab server first, as
+    one pipelined batch. They are only applied locally once the server has
+    confirmed every write; if any write fails, the writes that succeeded are
+    reverted to the current values, so server and local state stay the same.
+    While the server is disconnected such settings cannot be written, so the
+    update is refused with an error instead of being applied locally only.
 
     Args:
         new_settings: Dictionary containing the new calibration settings
+        server_id: The server whose calibration is updated
 
     Returns:
-        dict: Updated calibration settings
+        dict: Updated calibration settings, with the 'parameter_writes' and
+            their latency in milliseconds if any were written to the server
     """
-    global calibration_settings
+    server = get_server(server_id)
+    calibration_settings = server['calibration_settings']
 
-    logger.info(f"Updating calibration settings: {new_settings}")
+    logger.info(f"Updating calibration settings of {server_id}: {new_settings}")
 
     try:
         # Validate the new settings
         if not isinstance(new_settings, dict):
             raise ValueError("Settings must be a dictionary")
 
-        # Update only the provided settings with validation
+        # Stage the provided settings with validation
+        staged_settings = {}
         for key, value in new_settings.items():
             if key not in calibration_settings:
                 logger.warning(f"Unknown calibration setting: {key}")
@@ -432,23 +905,67 @@ async def update_calibration(new_settings):
 
             # Type checking and validation
             if key == 'offset':
-                calibration_settings[key] = float(value)
+                staged_settings[key] = float(value)
             elif key == 'gain':
                 # Ensure gain is not zero
                 gain_value = float(value)
                 if gain_value == 0:
                     logger.warning("Gain cannot be zero, setting to 1.0")
-                    calibration_settings[key] = 1.0
+                    staged_settings[key] = 1.0
                 else:
-                    calibration_settings[key] = gain_value
+                    staged_settings[key] = gain_value
             elif key == 'filter':
                 # Ensure filter is between 0 and 1
                 filter_value = float(value)
-                calibration_settings[key] = max(0.0, min(1.0, filter_value))
+                staged_settings[key] = max(0.0, min(1.0, filter_value))
+            elif key == 'polynomial':
+                # Either cleared or a non-empty list of coefficients
+                if value:
+                    staged_settings[key] = [float(coefficient) for coefficient in value]
+                else:
+                    staged_settings[key] = None
             else:
-                calibration_settings[key] = value
+                staged_settings[key] = value
+
+        # Reject values the pipeline cannot use before anything is written
+        for key, value in staged_settings.items():
+            values = value if isinstance(value, list) else [value]
+            if any(isinstance(number, float) and not math.isfinite(number) for number in values):
+                raise ValueError(f"Calibration setting {key} must be a finite number")
+
+        # Write mapped settings to the server; a worker forwarding its changes
+        # leaves this to the ingest process, which owns the connection
+        parameter_writes = None
+        parameter_paths = {
+            path: staged_settings[key]
+            for key, path in server['connection_settings']['calibration_parameters'].items()
+            if staged_settings.get(key) is not None
+        }
+        if parameter_paths and settings_forwarder is None:
+            if server['socket'] is None:
+                raise ValueError(
+                    f"Server {server_id} is not connected, cannot write parameters {', '.join(parameter_paths)}"
+                )
+            parameter_client = get_parameter_client(server_id)
+            results = await parameter_client.write_many(parameter_paths)
+            errors = [str(result) for result in results if isinstance(result, BaseException)]
+            if errors:
+                await _revert_parameter_writes(parameter_client, server, results)
+                raise ValueError(f"Parameter writes failed: {'; '.join(errors)}")
+            parameter_writes = [
+                {'path': result['path'], 'value': result['value'], 'latency_ms': round(result['latency'] * 1000, 3)}
+                for result in results
+            ]
+
+        # Apply everything at once
+        calibration_settings.update(staged_settings)
+
+        if settings_forwarder is not None:
+            settings_forwarder('calibration', server_id, staged_settings)
 
         logger.info(f"Calibration settings updated: {calibration_settings}")
+        if parameter_writes is not None:
+            return dict(calibration_settings, parameter_writes=parameter_writes)
         return calibration_settings
 
     except Exception as e:
@@ -458,19 +975,46 @@ async def update_calibration(new_settings):
             'current_settings': calibration_settings
         }
 
-async def update_connection_settings(new_settings):
+async def _revert_parameter_writes(parameter_client, server, results):
+    """
+    Write the current calibration back to the parameters of successful writes.
+
+    Args:
+        parameter_client: The server's ParameterClient
+        server: The server's session state
+        results: Results of write_many, exceptions for failed writes
+    """
+    keys = {path: key for key, path in server['connection_settings']['calibration_parameters'].items()}
+    previous = {
+        result['path']: server['calibration_settings'][keys[result['path']]]
+        for result in results
+        if not isinstance(result, BaseException) and result['path'] in keys
+    }
+    previous = {path: value for path, value in previous.items() if value is not None}
+    if not previous:
+        return
+
+    failed = [result for result in await parameter_client.write_many(previous) if isinstance(result, BaseException)]
+    if failed:
+        logger.error(f"Could not revert calibration parameters of {server['id']}: "
+                     f"{'; '.join(str(error) for error in failed)}")
+    else:
+        logger.info(f"Reverted calibration parameters of {server['id']}: {previous}")
+
+async def update_connection_settings(new_settings, server_id=DEFAULT_SERVER):
     """
-    Update the connection settings.
+    Update the connection settings of a server.
 
     Args:
         new_settings: Dictionary containing the new connection settings
+        server_id: The server whose connection settings are updated
 
     Returns:
         dict: Updated connection settings
     """
-    global connection_settings
+    connection_settings = get_server(server_id)['connection_settings']
 
-    logger.info(f"Updating connection settings: {new_settings}")
+    logger.info(f"Updating connection settings of {server_id}: {new_settings}")
 
     try:
         # Validate the new settings
@@ -487,7 +1031,8 @@ async def update_connection_settings(new_settings):
                 continue
 
             # Type checking and validation
-            if key in ['port', 'buffer_size', 'timeout', 'retry_attempts', 'reconnect_delay']:
+            if key in ['port', 'buffer_size', 'timeout', 'retry_attempts', 'reconnect_delay', 'max_reconnect_delay',
+                       'parameter_timeout']:
                 # These should be integers and positive
                 int_value = int(value)
                 if int_value <= 0:
@@ -500,15 +1045,32 @@ async def update_connection_settings(new_settings):
                     logger.warning(f"Invalid host value: {value}")
                     continue
                 connection_settings[key] = value
+            elif key == 'standby':
+                # List of {'host', 'port'} tried in order when the server fails
+                connection_settings[key] = [
+                    {'host': str(entry['host']), 'port': int(entry['port'])}
+                    for entry in value or []
+                ]
+            elif key == 'calibration_parameters':
+                # Calibration setting -> parameter path on the server
+                connection_settings[key] = {str(setting): str(path) for setting, path in (value or {}).items()}
             else:
                 connection_settings[key] = value
 
         logger.info(f"Connection settings updated: {connection_settings}")
 
-        # If host or port changed, we might want to reconnect
-        if (original_settings['host'] != connection_settings['host'] or
-            original_settings['port'] != connection_settings['port']):
-            logger.info("Host or port changed, reconnection may be required")
+        if get_server(server_id)['parameter_client'] is not None:
+            get_server(server_id)['parameter_client'].timeout = connection_settings['parameter_timeout']
+
+        if settings_forwarder is not None:
+            settings_forwarder('connection', server_id, connection_settings.copy())
+
+        # Reconnect to a changed address without disconnecting WebSocket clients
+        if any(original_settings[key] != connection_settings[key] for key in ('host', 'port', 'standby')):
+            supervisor = get_server(server_id)['supervisor']
+            if supervisor is not None:
+                logger.info(f"Address of {server_id} changed, reconnecting")
+                supervisor.request_reconnect()
 
         return connection_settings
 
@@ -518,3 +1080,6 @@ async def update_connection_settings(new_settings):
             'error': str(e),
             'current_settings': connection_settings
         }
+
+# Register the configured servers
+load_servers()
@@ -0,0 +1,297 @@
+"""
+Local cache of the parameter tree of each EtherLab server.
+
+The full parameter list is read once per connection and indexed by path, by
+server index and in a prefix trie of path segments for browsing. After that,
+the cache is kept current by the server's ``<pu index="..."/>`` change
+notifications: only the changed parameter is read again. Browsing and paging
+through the parameters never waits for the server.
+"""
+import asyncio
+import bisect
+import time
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# Page size of parameter queries when the client gives none, and the largest allowed
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Most change notifications remembered while the tree loads; beyond this the
+# whole list is read again once the load completes
+MAX_PENDING_UPDATES = 4096
+
+# Delay before a failed parameter list read is retried, doubling up to the maximum
+LOAD_RETRY_DELAY = 5.0
+MAX_LOAD_RETRY_DELAY = 60.0
+
+
+class TrieNode:
+    """One path segment of the parameter tree."""
+
+    __slots__ = ('children', 'path')
+
+    def __init__(self):
+        self.children = {}  # segment -> TrieNode
+        self.path = None  # Full path if a parameter ends here
+
+
+class ParameterTree:
+    """
+    Parameters of one server indexed by path, by server index and by path prefix.
+    """
+
+    def __init__(self):
+        self.parameters = {}  # path -> attributes as reported by the server
+        self.paths_by_index = {}  # server index -> path
+        self.root = TrieNode()
+        self.loaded_at = None
+        self.pending_updates = set()  # indices changed while the tree was loading
+        self.pending_overflow = False  # more changes than MAX_PENDING_UPDATES while loading
+        self.load_generation = 0  # counts loads started, so a newer one supersedes a retrying one
+        self._sorted_paths = []
+
+    @staticmethod
+    def split_path(path):
+        return [segment for segment in path.split('/') if segment]
+
+    def load(self, entries):
+        """
+        Replace the tree with a freshly read parameter list.
+
+        Args:
+            entries: One attribute dictionary per parameter, each with a 'path'
+        """
+        self.parameters = {}
+        self.paths_by_index = {}
+        self.root = TrieNode()
+        for attributes in entries:
+            self._insert(attributes)
+        self._sorted_paths = sorted(self.parameters)
+        self.loaded_at = time.time()
+
+    def _insert(self, attributes):
+        path = attributes.get('path')
+        if not path:
+            return False
+
+        is_new = path not in self.parameters
+        self.parameters[path] = attributes
+        if 'index' in attributes:
+            self.paths_by_index[attributes['index']] = path
+
+        if is_new:
+            node = self.root
+            for segment in self.split_path(path):
+                node = node.children.setdefault(segment, TrieNode())
+            node.path = path
+        return is_new
+
+    def update(self, attributes):
+        """
+        Update one parameter from a read reply, adding it if it is new.
+
+        Args:
+            attributes: The parameter's attributes, with its 'path'
+        """
+        path = attributes.get('path')
+        if path in self.parameters:
+            attributes = dict(self.parameters[path], **attributes)
+        if self._insert(attributes):
+            bisect.insort(self._sorted_paths, path)
+
+    def get(self, path):
+        """Return the attributes of a parameter, or None if unknown."""
+        return self.parameters.get(path)
+
+    def children(self, path='/'):
+        """
+        List the entries directly below a path, for browsing the tree.
+
+        Args:
+            path: The parent path
+
+        Returns:
+            list: {'name', 'path', 'parameter', 'children'} per entry, where
+                'parameter' holds the attributes if a parameter ends there and
+                'children' is the number of entries below it
+        """
+        node = self.root
+        for segment in self.split_path(path):
+            node = node.children.get(segment)
+            if node is None:
+                return []
+
+        base = path.rstrip('/')
+        return [
+            {
+                'name': name,
+                'path': f"{base}/{name}",
+                'parameter': self.parameters.get(child.path) if child.path else None,
+                'children': len(child.children)
+            }
+            for name, child in sorted(node.children.items())
+        ]
+
+    def page(self, prefix='/', offset=0, limit=DEFAULT_PAGE_SIZE):
+        """
+        Return a page of the parameters at or below a path, in path order.
+
+        Args:
+            prefix: Path whose parameters are returned ('/' for all)
+            offset: Number of matching parameters to skip
+            limit: Maximum number of parameters to return
+
+        Returns:
+            dict: 'total' matching parameters, 'offset' and 'parameters'
+        """
+        base = prefix.rstrip('/')
+        paths = self._sorted_paths
+        if base:
+            # Paths below the prefix sort contiguously after base + '/'
+            start = bisect.bisect_left(paths, base + '/')
+            end = bisect.bisect_left(paths, base + '/\U0010ffff', start)
+            matches = ([base] if base in self.parameters else []) + paths[start:end]
+        else:
+            matches = paths
+
+        return {
+            'total': len(matches),
+            'offset': offset,
+            'parameters': [self.parameters[path] for path in matches[offset:offset + limit]]
+        }
+
+
+async def load_parameter_tree(server_id):
+    """
+    Read a server's parameter list into its tree; run once per connection.
+
+    A failed read is retried with a growing delay for as long as the
+    connection it was started on stays open. Change notifications received
+    meanwhile are dropped, since the next read returns the current values.
+
+    Args:
+        server_id: The server whose parameters are read
+    """
+    from .msr_protocol import get_parameter_client, get_server
+    from .parameters import ParameterError
+
+    server = get_server(server_id)
+    connection = server['socket']
+    tree = server['parameter_tree']
+    tree.loaded_at = None
+    tree.load_generation += 1
+    generation = tree.load_generation
+    retry_delay = LOAD_RETRY_DELAY
+    reread = False
+
+    while True:
+        started = time.monotonic()
+        tree.pending_overflow = False
+        try:
+            entries = await get_parameter_client(server_id).list_parameters()
+        except ParameterError as e:
+            tree.pending_updates = set()
+            if server['socket'] is None or server['socket'] is not connection:
+                logger.error(f"Failed to read the parameter list of {server_id}: {e}")
+                return
+            logger.error(f"Failed to read the parameter list of {server_id}, retrying in {retry_delay:g}s: {e}")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, MAX_LOAD_RETRY_DELAY)
+            if server['socket'] is not connection or tree.load_generation != generation:
+                return
+            continue
+
+        if tree.load_generation != generation:
+            return
+        if tree.pending_overflow and not reread:
+            # Too many changes to replay one by one: read the list again
+            logger.info(f"Parameters of {server_id} changed while loading, reading them again")
+            tree.pending_updates = set()
+            reread = True
+            continue
+        break
+
+    tree.load(entries)
+    logger.info(f"Loaded {len(tree.parameters)} parameters of {server_id} in {time.monotonic() - started:.2f} seconds")
+
+    # Changes announced while the list was being read may be missing from it
+    pending, tree.pending_updates = tree.pending_updates, set()
+    for index in pending:
+        handle_parameter_update(server_id, {'index': index})
+
+
+async def refresh_parameter(server_id, path):
+    """Read one parameter again and update the cached tree."""
+    from .msr_protocol import get_parameter_client, get_server
+    from .parameters import ParameterError
+
+    try:
+        result = await get_parameter_client(server_id).read(path)
+    except ParameterError as e:
+        logger.warning(f"Failed to refresh parameter {path} of {server_id}: {e}")
+        return
+    attributes = dict(result['attributes'], path=path)
+    attributes.pop('id', None)
+    get_server(server_id)['parameter_tree'].update(attributes)
+
+
+def handle_parameter_update(server_id, attributes):
+    """
+    Handle a ``<pu>`` change notification by reading the changed parameter.
+
+    Args:
+        server_id: The server that sent the notification
+        attributes: Attributes of the notification, with the parameter's 'index'
+    """
+    from .msr_protocol import get_server, spawn_background_task
+
+    tree = get_server(server_id)['parameter_tree']
+    index = attributes.get('index')
+    if tree.loaded_at is None:
+        if len(tree.pending_updates) < MAX_PENDING_UPDATES:
+            tree.pending_updates.add(index)
+        else:
+            tree.pending_overflow = True
+        return
+
+    path = tree.paths_by_index.get(index)
+    if path is None:
+        logger.debug(f"Change notification for unknown parameter {index} of {server_id}")
+        return
+    spawn_background_task(refresh_parameter(server_id, path))
+
+
+def query_parameters(server_id, prefix='/', offset=0, limit=DEFAULT_PAGE_SIZE, browse=False):
+    """
+    Query the cached parameters of a server without contacting it.
+
+    Args:
+        server_id: The server whose parameters are queried
+        prefix: Path to list or page through
+        offset: Number of matching parameters to skip
+        limit: Page size, capped at MAX_PAGE_SIZE
+        browse: List the entries directly below the prefix instead of paging
+
+    Returns:
+        dict: 'server', 'prefix', 'loaded_at' and either 'children' or the page
+            ('total', 'offset', 'parameters')
+    """
+    from .msr_protocol import get_server
+
+    tree = get_server(server_id)['parameter_tree']
+    offset = max(0, int(offset))
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+    result = {'server': server_id, 'prefix': prefix, 'loaded_at': tree.loaded_at}
+    if browse:
+        result['children'] = tree.children(prefix)
+    else:
+        result.update(tree.page(prefix, offset, limit))
+    return result
@@ -0,0 +1,259 @@
+"""
+Pipelined parameter reads and writes on the EtherLab server.
+
+``ParameterClient`` sends ``<wp>`` (write parameter) and ``<rp>`` (read
+parameter) commands, each tagged with an ``id``. Commands queued in the same
+event loop iteration are sent together in one write to the socket, and
+several writes to the same parameter collapse into the last one. Replies
+carrying an ``id`` are matched to the waiting futures, so callers can have
+many requests in flight instead of paying one round trip after another.
+Every result reports its latency from queueing to reply.
+"""
+import asyncio
+import itertools
+from xml.sax.saxutils import quoteattr
+
+from .framing import child_attributes
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# Seconds to wait for a reply when the connection settings give no parameter_timeout
+DEFAULT_PARAMETER_TIMEOUT = 5.0
+
+# Tags the server answers commands with: <ack> for writes, <parameter> for
+# reads, <parameters> and <channels> for the parameter and channel lists and
+# <error> for rejected commands
+PARAMETER_REPLY_TAGS = frozenset({'ack', 'parameter', 'parameters', 'channels', 'error'})
+
+
+class ParameterError(Exception):
+    """Raised when the server rejects a parameter command or does not reply."""
+
+
+def format_value(value):
+    """Format a scalar or a sequence of numbers as an MSR parameter value."""
+    if isinstance(value, (list, tuple)):
+        return ','.join(repr(float(item)) for item in value)
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return str(value)
+
+
+class ParameterClient:
+    """
+    Parameter reads and writes for one EtherLab server.
+
+    Args:
+        server_id: The server the client talks to
+        send: Coroutine function sending encoded commands to the server,
+            returning False if the server is not connected
+        timeout: Seconds to wait for each reply
+    """
+
+    def __init__(self, server_id, send, timeout=DEFAULT_PARAMETER_TIMEOUT):
+        self.server_id = server_id
+        self.send = send
+        self.timeout = timeout
+
+        self._ids = itertools.count(1)
+        self._queue = {}  # (command, path) -> queued request, in send order
+        self._pending = {}  # id -> request awaiting its reply
+        self._flush_handle = None
+
+        self.stats = {
+            'writes': 0,
+            'reads': 0,
+            'messages_sent': 0,
+            'coalesced': 0,
+            'timeouts': 0,
+            'errors': 0
+        }
+
+    async def write(self, path, value):
+        """
+        Write a parameter and wait for the server to acknowledge it.
+
+        Args:
+            path: Parameter path, e.g. '/Calibration/Gain'
+            value: New value (number, bool or sequence of numbers)
+
+        Returns:
+            dict: 'path', 'value', the reply 'attributes' and 'latency' in seconds
+
+        Raises:
+            ParameterError: If the write is rejected, times out or the server
+                is not connected
+        """
+        self.stats['writes'] += 1
+        return await self._request('wp', path, format_value(value))
+
+    async def read(self, path):
+        """
+        Read a parameter.
+
+        Args:
+            path: Parameter path
+
+        Returns:
+            dict: 'path', 'value' as reported by the server, the reply
+                'attributes' and 'latency' in seconds
+        """
+        self.stats['reads'] += 1
+        result = await self._request('rp', path, None)
+        result['value'] = result['attributes'].get('value')
+        return result
+
+    async def list_parameters(self):
+        """
+        Read the list of all parameters with their current values.
+
+        Returns:
+            list: One attribute dictionary ('path', 'index', 'value', ...) per parameter
+        """
+        self.stats['reads'] += 1
+        result = await self._request('rp', None, None)
+        return child_attributes(result['element'], 'parameter')
+
+    async def list_channels(self):
+        """
+        Read the list of all channels.
+
+        Returns:
+            list: One attribute dictionary ('path', 'index', ...) per channel
+        """
+        self.stats['reads'] += 1
+        result = await self._request('rk', None, None)
+        return child_attributes(result['element'], 'channel')
+
+    async def write_many(self, values):
+        """
+        Write several parameters in one pipelined batch.
+
+        Args:
+            values: Dictionary of parameter path -> value
+
+        Returns:
+            list: One result per parameter; failed writes are ParameterError
+                instances instead of result dictionaries
+        """
+        return await asyncio.gather(
+            *(self.write(path, value) for path, value in values.items()),
+            return_exceptions=True
+        )
+
+    async def _request(self, command, path, value):
+        loop = asyncio.get_running_loop()
+        key = (command, path)
+
+        request = self._queue.get(key)
+        if request is not None and command == 'wp':
+            # A newer write to a queued parameter replaces the older value
+            request['value'] = value
+            self.stats['coalesced'] += 1
+        elif request is None:
+            request = {
+                'command': command,
+                'path': path,
+                'value': value,
+                'queued_at': loop.time(),
+                'future': loop.create_future()
+            }
+            self._queue[key] = request
+            if self._flush_handle is None:
+                self._flush_handle = loop.call_soon(self._start_flush)
+
+        try:
+            attributes, element = await asyncio.wait_for(asyncio.shield(request['future']), self.timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            self._pending.pop(request.get('id'), None)
+            raise ParameterError(f"No reply for {command} {path} from {self.server_id} within {self.timeout} seconds")
+
+        return {
+            'path': path,
+            'value': request['value'],
+            'attributes': attributes,
+            'element': element,
+            'latency': loop.time() - request['queued_at']
+        }
+
+    def _start_flush(self):
+        from .msr_protocol import spawn_background_task
+
+        self._flush_handle = None
+        spawn_background_task(self.flush())
+
+    async def flush(self):
+        """Send all queued commands in one message."""
+        requests = list(self._queue.values())
+        self._queue.clear()
+        if not requests:
+            return
+
+        commands = []
+        for request in requests:
+            request['id'] = f"p{next(self._ids)}"
+            self._pending[request['id']] = request
+            path = '' if request['path'] is None else f" path={quoteattr(request['path'])}"
+            value = '' if request['value'] is None else f" value={quoteattr(request['value'])}"
+            commands.append(f"<{request['command']}{path}{value} id=\"{request['id']}\"/>")
+
+        try:
+            sent = await self.send(''.join(commands).encode() + b'\n')
+        except OSError as e:
+            sent = False
+            logger.error(f"Failed to send parameter commands to {self.server_id}: {e}")
+
+        if sent:
+            self.stats['messages_sent'] += 1
+            logger.debug(f"Sent {len(requests)} parameter commands to {self.server_id}")
+        else:
+            for request in requests:
+                self._fail(request, ParameterError(f"Server {self.server_id} is not connected"))
+
+    def handle_reply(self, tag, attributes, element=b''):
+        """
+        Resolve the request matching a reply from the server.
+
+        Args:
+            tag: Tag name of the reply element
+            attributes: Attributes of the reply, including its 'id'
+            element: The complete reply element
+
+        Returns:
+            bool: True if the reply belonged to a pending request
+        """
+        request = self._pending.pop(attributes.get('id'), None)
+        if request is None:
+            return False
+
+        if tag == 'error':
+            self.stats['errors'] += 1
+            self._fail(request, ParameterError(
+                f"{self.server_id} rejected {request['command']} {request['path']}: "
+                f"{attributes.get('text', 'unknown error')}"
+            ))
+        elif not request['future'].done():
+            request['future'].set_result((attributes, element))
+        return True
+
+    def connection_lost(self):
+        """Fail every request still waiting for a reply."""
+        pending, self._pending = self._pending, {}
+        for request in pending.values():
+            self._fail(request, ParameterError(f"Connection to {self.server_id} lost"))
+
+    def _fail(self, request, error):
+        self._pending.pop(request.get('id'), None)
+        if not request['future'].done():
+            request['future'].set_exception(error)
+            # Retrieve the exception if every waiter already timed out
+            request['future'].exception()
@@ -0,0 +1,129 @@
+"""
+Token-bucket rate limiting of inbound WebSocket commands.
+
+Every connection gets its own bucket sized for the user's role, and each role
+shares a bucket across all connections of that role in the process. Messages
+are checked against both before they are parsed, so a flooding client is
+rejected for the cost of two arithmetic updates and cannot slow down the data
+stream for everyone else.
+"""
+import time
+
+from django.conf import settings
+
+# Default rate limits: tokens (messages) per second and bucket size (burst)
+DEFAULT_RATE_LIMITS = {
+    'connection': {
+        'operator': {'rate': 5, 'burst': 10},
+        'calibrator': {'rate': 10, 'burst': 20},
+        'admin': {'rate': 20, 'burst': 40}
+    },
+    'role': {
+        'operator': {'rate': 500, 'burst': 1000},
+        'calibrator': {'rate': 500, 'burst': 1000},
+        'admin': {'rate': 500, 'burst': 1000}
+    }
+}
+
+# role -> TokenBucket shared by all connections with that role
+role_buckets = {}
+
+# Counters of rejected messages
+throttle_stats = {
+    'throttled': 0,
+    'throttled_clients': 0,
+    'by_role': {},
+    'by_limit': {'connection': 0, 'role': 0}
+}
+
+
+class TokenBucket:
+    """
+    Bucket holding up to ``burst`` tokens, refilled at ``rate`` tokens per second.
+    """
+
+    __slots__ = ('burst', 'rate', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self, tokens=1):
+        """
+        Take tokens from the bucket.
+
+        Args:
+            tokens: Number of tokens to take
+
+        Returns:
+            bool: True if the tokens were available
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+
+def get_rate_limit_settings():
+    """Return the rate limits with overrides from MSR_WS_RATE_LIMITS applied per scope."""
+    limits = {scope: roles.copy() for scope, roles in DEFAULT_RATE_LIMITS.items()}
+    for scope, roles in getattr(settings, 'MSR_WS_RATE_LIMITS', {}).items():
+        limits.setdefault(scope, {}).update(roles)
+    return limits
+
+
+def _make_bucket(limit):
+    if not limit:
+        return None
+    return TokenBucket(limit['rate'], limit['burst'])
+
+
+def create_connection_bucket(role):
+    """
+    Create the bucket of a new connection.
+
+    Args:
+        role: The user's role
+
+    Returns:
+        TokenBucket: The bucket, or None if the role is not limited
+    """
+    return _make_bucket(get_rate_limit_settings()['connection'].get(role))
+
+
+def get_role_bucket(role):
+    """Return the bucket shared by all connections with a role, or None if unlimited."""
+    if role not in role_buckets:
+        role_buckets[role] = _make_bucket(get_rate_limit_settings()['role'].get(role))
+    return role_buckets[role]
+
+
+def check_rate_limit(connection_bucket, role):
+    """
+    Take a token for one inbound message.
+
+    Args:
+        connection_bucket: The connection's bucket, or None
+        role: The user's role
+
+    Returns:
+        str: None if the message is allowed, otherwise the exhausted limit
+            ('connection' or 'role')
+    """
+    if connection_bucket is not None and not connection_bucket.consume():
+        limit = 'connection'
+    else:
+        role_bucket = get_role_bucket(role)
+        if role_bucket is None or role_bucket.consume():
+            return None
+        limit = 'role'
+
+    throttle_stats['throttled'] += 1
+    throttle_stats['by_limit'][limit] += 1
+    throttle_stats['by_role'][role] = throttle_stats['by_role'].get(role, 0) + 1
+    return limit
@@ -3,4 +3,6 @@ from msr_control import consumers
 
 websocket_urlpatterns = [
     path('ws/msr_data/', consumers.MSRConsumer.as_asgi()),
+    # Data of one EtherLab server from MSR_ETHERLAB_SERVERS
+    path('ws/msr_data/<str:server>/', consumers.MSRConsumer.as_asgi()),
 ]
@@ -0,0 +1,299 @@
+"""
+Shared-memory frame ring for multi-process deployments.
+
+A standalone ingest process (``manage.py run_msr_ingest``) owns the EtherLab
+connection and publishes every processed frame into a ring buffer in
+``multiprocessing.shared_memory``. Each ASGI worker process attaches to the
+ring, reads new frames locally and fans them out to its own WebSocket clients.
+
+Layout of the shared block::
+
+    header   magic, slot count, slot size, write sequence, control version
+    control  length-prefixed JSON with settings requested by the workers,
+             as {section: {server id: settings}}
+    slots    slot_count x (sequence, length, payload)
+
+Frames are numbered by a monotonically increasing sequence counter. A slot is
+invalidated before its payload is overwritten and stamped with its sequence
+afterwards, so a reader that sees the same sequence before and after copying a
+payload knows the copy is intact. Readers that fall more than a full ring
+behind skip ahead and count the frames they missed.
+
+The block is only accessible to the user running the service, and its
+default name is derived from the runtime directory (see
+utils/runtime_dir.py), so deployments on one host do not share a ring.
+Processes refuse a block that belongs to another user. The lock file
+serializing control block writes lives in the runtime directory.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import stat
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+from django.conf import settings
+
+from .utils.runtime_dir import ensure_private_directory, get_runtime_dir
+
+# Default shared ring settings
+DEFAULT_SHARED_RING_SETTINGS = {
+    'name': None,  # None derives the name from the runtime directory
+    'slots': 1024,
+    'slot_size': 16384,
+    'poll_interval': 0.005  # seconds between reads in the ASGI workers
+}
+
+MAGIC = b'MSR1'
+
+# magic, slot_count, slot_size, write_seq, control_version
+HEADER = struct.Struct('<4sIIQQ4x')
+WRITE_SEQ_OFFSET = 12
+CONTROL_VERSION_OFFSET = 20
+
+CONTROL_OFFSET = HEADER.size
+CONTROL_SIZE = 4096
+LENGTH = struct.Struct('<I')
+SEQUENCE = struct.Struct('<Q')
+
+SLOTS_OFFSET = CONTROL_OFFSET + CONTROL_SIZE
+# sequence, payload length
+SLOT_HEADER = struct.Struct('<QI')
+
+
+def get_shared_ring_settings():
+    """Return the shared ring settings with overrides from MSR_SHARED_RING applied."""
+    ring_settings = DEFAULT_SHARED_RING_SETTINGS.copy()
+    ring_settings.update(getattr(settings, 'MSR_SHARED_RING', {}))
+    if not ring_settings['name']:
+        digest = hashlib.sha256(os.path.abspath(get_runtime_dir()).encode()).hexdigest()[:16]
+        ring_settings['name'] = f'msr_frames_{digest}'
+    return ring_settings
+
+
+def _check_owner(shm):
+    """
+    Make sure a shared memory block belongs to this user and only to them.
+
+    Raises:
+        PermissionError: If the block belongs to another user or others can access it
+    """
+    info = os.fstat(shm._fd)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(
+            f"Shared memory block {shm.name} belongs to user {info.st_uid} with mode "
+            f"{stat.S_IMODE(info.st_mode):o}; it must belong to {os.getuid()} with mode 600"
+        )
+
+
+class SharedFrameRing:
+    """
+    Single-writer, multi-reader ring of frames in shared memory.
+
+    Use ``create()`` in the ingest process and ``attach()`` in the readers.
+    """
+
+    def __init__(self, shm, owner):
+        self._shm = shm
+        self._buf = shm.buf
+        self.owner = owner
+
+        magic, self.slot_count, self.slot_size, write_seq, _ = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Shared memory block {shm.name} is not an MSR frame ring")
+
+        self.write_seq = write_seq
+        self.last_seq = write_seq  # Readers start with the next published frame
+        self.dropped = 0
+        self._lock_path = os.path.join(
+            ensure_private_directory(get_runtime_dir()), f'{shm.name.lstrip("/")}.lock'
+        )
+
+    @classmethod
+    def create(cls, name, slot_count, slot_size):
+        """
+        Create the ring, replacing a stale block left by a previous run.
+
+        Args:
+            name: Shared memory block name
+            slot_count: Number of frame slots
+            slot_size: Maximum payload size of a frame in bytes
+
+        Returns:
+            SharedFrameRing: The writable ring
+        """
+        size = SLOTS_OFFSET + slot_count * (SLOT_HEADER.size + slot_size)
+        try:
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        _check_owner(shm)
+        shm.buf[:SLOTS_OFFSET] = bytes(SLOTS_OFFSET)
+        HEADER.pack_into(shm.buf, 0, MAGIC, slot_count, slot_size, 0, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Attach to a ring created by the ingest process.
+
+        Args:
+            name: Shared memory block name
+
+        Returns:
+            SharedFrameRing: The ring, positioned at the newest frame
+
+        Raises:
+            FileNotFoundError: If the ingest process has not created the ring yet
+            PermissionError: If the block belongs to another user or others
+                can access it
+        """
+        shm = shared_memory.SharedMemory(name=name)
+        # Readers must not remove the block when they exit (bpo-39959)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        try:
+            _check_owner(shm)
+        except PermissionError:
+            shm.close()
+            raise
+        return cls(shm, owner=False)
+
+    def close(self):
+        """Detach from the ring, removing it if this process created it."""
+        self._buf = None
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+
+    def is_replaced(self):
+        """
+        Return True if the block was removed or replaced by a restarted writer.
+
+        Compares the block this process has mapped with the one currently
+        registered under the name in /dev/shm (Linux).
+        """
+        try:
+            current = os.stat(os.path.join('/dev/shm', self._shm.name.lstrip('/')))
+        except FileNotFoundError:
+            return True
+        return current.st_ino != os.fstat(self._shm._fd).st_ino
+
+    def _slot_offset(self, seq):
+        return SLOTS_OFFSET + (seq % self.slot_count) * (SLOT_HEADER.size + self.slot_size)
+
+    def publish(self, payload):
+        """
+        Publish a frame payload.
+
+        Args:
+            payload: Encoded frame as bytes
+
+        Returns:
+            int: The frame's sequence number
+        """
+        if len(payload) > self.slot_size:
+            raise ValueError(f"Frame of {len(payload)} bytes exceeds slot size {self.slot_size}")
+
+        seq = self.write_seq + 1
+        offset = self._slot_offset(seq)
+        start = offset + SLOT_HEADER.size
+
+        # Invalidate, write the payload, then stamp the slot and the header
+        SEQUENCE.pack_into(self._buf, offset, 0)
+        self._buf[start:start + len(payload)] = payload
+        LENGTH.pack_into(self._buf, offset + SEQUENCE.size, len(payload))
+        SEQUENCE.pack_into(self._buf, offset, seq)
+        SEQUENCE.pack_into(self._buf, WRITE_SEQ_OFFSET, seq)
+
+        self.write_seq = seq
+        return seq
+
+    def read_new(self):
+        """
+        Read all frames published since the last call.
+
+        Returns:
+            list: Frame payloads as bytes, oldest first
+        """
+        head = SEQUENCE.unpack_from(self._buf, WRITE_SEQ_OFFSET)[0]
+        if head < self.last_seq:
+            # The writer restarted with a fresh ring
+            self.last_seq = 0
+
+        if head - self.last_seq > self.slot_count:
+            self.dropped += head - self.last_seq - self.slot_count
+            self.last_seq = head - self.slot_count
+
+        frames = []
+        for seq in range(self.last_seq + 1, head + 1):
+            offset = self._slot_offset(seq)
+            slot_seq, length = SLOT_HEADER.unpack_from(self._buf, offset)
+            if slot_seq != seq:
+                self.dropped += 1
+                continue
+
+            start = offset + SLOT_HEADER.size
+            payload = bytes(self._buf[start:start + length])
+
+            # Discard the copy if the writer lapped us while copying
+            if SEQUENCE.unpack_from(self._buf, offset)[0] != seq:
+                self.dropped += 1
+                continue
+            frames.append(payload)
+
+        self.last_seq = head
+        return frames
+
+    def control_version(self):
+        """Return the version counter of the control block."""
+        return SEQUENCE.unpack_from(self._buf, CONTROL_VERSION_OFFSET)[0]
+
+    def read_control(self):
+        """
+        Read the settings requested by the workers.
+
+        Returns:
+            tuple: (version, dict of requested settings sections)
+        """
+        while True:
+            version = self.control_version()
+            length = LENGTH.unpack_from(self._buf, CONTROL_OFFSET)[0]
+            start = CONTROL_OFFSET + LENGTH.size
+            payload = bytes(self._buf[start:start + length])
+
+            # An odd or changed version means a write was in progress
+            if version % 2 == 0 and version == self.control_version():
+                return version, json.loads(payload) if payload else {}
+
+    def update_control(self, section, server_id, values):
+        """
+        Merge a server's settings into a section of the control block.
+
+        Any process may call this; writers are serialized with a file lock.
+
+        Args:
+            section: Settings section, e.g. 'calibration' or 'connection'
+            server_id: The EtherLab server the settings apply to
+            values: Dictionary of settings to merge into the section
+        """
+        with open(self._lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            _, control = self.read_control()
+            control.setdefault(section, {}).setdefault(server_id, {}).update(values)
+            payload = json.dumps(control).encode()
+            if len(payload) > CONTROL_SIZE - LENGTH.size:
+                raise ValueError("Control settings exceed the control block size")
+
+            # The version is odd while the block is being written
+            version = self.control_version()
+            SEQUENCE.pack_into(self._buf, CONTROL_VERSION_OFFSET, version + 1)
+            start = CONTROL_OFFSET + LENGTH.size
+            self._buf[start:start + len(payload)] = payload
+            LENGTH.pack_into(self._buf, CONTROL_OFFSET, len(payload))
+            SEQUENCE.pack_into(self._buf, CONTROL_VERSION_OFFSET, version + 2)
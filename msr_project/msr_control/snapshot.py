@@ -0,0 +1,410 @@
+"""
+Snapshots of the runtime state for warm restarts.
+
+Every few seconds the state that would otherwise be lost on a restart is
+written to a local file: the calibration and connection settings and the
+low-pass filter state of every server, the cached parameter trees and the
+newest samples of every channel's history. On startup the file is read
+back, so the first samples after a deploy are calibrated and filtered as
+before and charts and analysis have history at once.
+
+The state is captured on the event loop (copies of dictionaries and of the
+history arrays); encoding and writing run in a worker thread, so ingest
+never waits for the disk. The file is written under a temporary name,
+flushed and renamed over the previous snapshot, so a crash leaves either the
+old or the new snapshot, never a partial one. It is memory-mapped when read,
+and the history columns are copied straight out of the mapping.
+
+Layout of the file (little-endian)::
+
+    header   magic b'MSRS', version, written_at, length of the metadata,
+             CRC-32 of everything after the header
+    metadata UTF-8 JSON: servers, parameter trees and the channel list
+    history  per channel, count float64 timestamps then count float64 values,
+             starting on an 8-byte boundary
+"""
+import asyncio
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+import numpy as np
+from django.conf import settings
+
+from . import history, msr_protocol
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# Default snapshot settings
+DEFAULT_SNAPSHOT_SETTINGS = {
+    'enabled': True,
+    'path': None,  # file of the snapshot; None disables snapshots
+    'interval': 5.0,  # seconds between snapshots
+    'history_samples': 4096,  # newest samples kept per channel
+    'max_history_age': 600.0  # seconds after which history and filter state are not restored
+}
+
+MAGIC = b'MSRS'
+VERSION = 1
+
+# magic, version, written_at, metadata length, CRC-32 of the body
+HEADER = struct.Struct('<4sIdII')
+
+# Outcome of the last snapshot written and the one restored
+stats = {
+    'written': 0,
+    'skipped': 0,
+    'errors': 0,
+    'last_written_at': None,
+    'last_size': 0,
+    'restored_at': None,
+    'restored_channels': 0
+}
+
+# State captured by the last snapshot, to skip writes when nothing changed
+_last_state = None
+
+# Serializes writes; with the capture time of the newest snapshot written, it
+# makes an older snapshot that reaches the lock late (e.g. a periodic one still
+# encoding when ingest stops) skip its write instead of replacing a newer one
+_write_lock = threading.Lock()
+_newest_written_at = 0.0
+
+
+def get_snapshot_settings():
+    """Return the snapshot settings with overrides from MSR_SNAPSHOT applied."""
+    snapshot_settings = DEFAULT_SNAPSHOT_SETTINGS.copy()
+    snapshot_settings.update(getattr(settings, 'MSR_SNAPSHOT', {}))
+    return snapshot_settings
+
+
+def snapshot_path():
+    """Return the snapshot file path, or None if snapshots are disabled."""
+    snapshot_settings = get_snapshot_settings()
+    if not snapshot_settings['enabled'] or not snapshot_settings['path']:
+        return None
+    return os.fspath(snapshot_settings['path'])
+
+
+def capture_state(history_samples):
+    """
+    Copy the runtime state on the event loop.
+
+    Args:
+        history_samples: Newest samples to keep per channel
+
+    Returns:
+        tuple: (metadata dictionary, list of (times, values) arrays)
+    """
+    servers = {}
+    parameters = {}
+    for server_id, server in msr_protocol.servers.items():
+        servers[server_id] = {
+            'calibration_settings': dict(server['calibration_settings']),
+            'connection_settings': dict(server['connection_settings']),
+            'configured_connection': server['configured_connection'],
+            'last_value': server['last_value'],
+            'channel_values': dict(server['channel_values'])
+        }
+        tree = server['parameter_tree']
+        if tree.loaded_at is not None:
+            parameters[server_id] = {
+                'loaded_at': tree.loaded_at,
+                'entries': list(tree.parameters.values())
+            }
+
+    # The total of samples ever recorded shows whether a full buffer changed
+    channels = []
+    columns = []
+    for channel, buffer in list(history.channel_history.items()):
+        times, values = buffer.latest(history_samples)
+        channels.append([channel, len(times), buffer.total])
+        columns.append((times, values))
+
+    metadata = {'servers': servers, 'parameters': parameters, 'channels': channels}
+    return metadata, columns
+
+
+def encode_snapshot(metadata, columns, written_at):
+    """
+    Encode captured state in the snapshot layout.
+
+    Returns:
+        bytes: The file content
+    """
+    meta = json.dumps(metadata, default=str).encode()
+    meta += b' ' * (-(HEADER.size + len(meta)) % 8)
+    body = [meta]
+    for times, values in columns:
+        body.append(np.ascontiguousarray(times, dtype='<f8').tobytes())
+        body.append(np.ascontiguousarray(values, dtype='<f8').tobytes())
+    body = b''.join(body)
+    return HEADER.pack(MAGIC, VERSION, written_at, len(meta), zlib.crc32(body)) + body
+
+
+def write_file(path, content):
+    """
+    Replace a file atomically: write a temporary file, flush it, rename it.
+
+    Args:
+        path: Path of the file
+        content: Bytes to write
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with open(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.unlink(temporary)
+        except OSError:
+            pass
+        raise
+
+    # Make the rename itself durable
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+async def save_snapshot(force=False):
+    """
+    Write a snapshot of the runtime state if it changed since the last one.
+
+    Args:
+        force: Write even if nothing changed
+
+    Returns:
+        bool: True if a snapshot was written
+    """
+    global _last_state
+
+    path = snapshot_path()
+    if path is None:
+        return False
+
+    snapshot_settings = get_snapshot_settings()
+    metadata, columns = capture_state(int(snapshot_settings['history_samples']))
+    if not force and metadata == _last_state:
+        stats['skipped'] += 1
+        return False
+
+    written_at = time.time()
+    try:
+        content = await asyncio.to_thread(_encode_and_write, path, metadata, columns, written_at)
+    except Exception:
+        stats['errors'] += 1
+        logger.exception(f"Error writing snapshot to {path}")
+        return False
+    if content is None:
+        stats['skipped'] += 1
+        return False
+
+    _last_state = metadata
+    stats['written'] += 1
+    stats['last_written_at'] = written_at
+    stats['last_size'] = len(content)
+    return True
+
+
+def _encode_and_write(path, metadata, columns, written_at):
+    global _newest_written_at
+
+    content = encode_snapshot(metadata, columns, written_at)
+    with _write_lock:
+        if written_at < _newest_written_at:
+            return None
+        write_file(path, content)
+        _newest_written_at = written_at
+    return content
+
+
+async def run_snapshots():
+    """Background task writing a snapshot every interval."""
+    if snapshot_path() is None:
+        return
+    interval = float(get_snapshot_settings()['interval'])
+    logger.info(f"Writing runtime snapshots to {snapshot_path()} every {interval:g}s")
+    while True:
+        await asyncio.sleep(interval)
+        await save_snapshot()
+
+
+async def save_final_snapshot():
+    """Shutdown hook writing the state as it is when ingest stops."""
+    await save_snapshot(force=True)
+
+
+def read_snapshot(path):
+    """
+    Read a snapshot file through a memory mapping.
+
+    Args:
+        path: Path of the snapshot
+
+    Returns:
+        tuple: (written_at, metadata, {channel: (times, values)}), or
+        None if there is no valid snapshot
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return _decode(mapped, size)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
+
+
+def _decode(mapped, size):
+    magic, version, written_at, meta_length, crc = HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not an MSR snapshot of this version")
+    body = memoryview(mapped)[HEADER.size:]
+    try:
+        if zlib.crc32(body) != crc:
+            raise ValueError("checksum mismatch")
+        metadata = json.loads(bytes(body[:meta_length]))
+    finally:
+        body.release()
+
+    channels = {}
+    offset = HEADER.size + meta_length
+    for channel, count, _ in metadata.get('channels', ()):
+        if offset + 16 * count > size:
+            raise ValueError("history extends past the end of the file")
+        # Copy the columns out of the mapping before it is closed
+        times = np.frombuffer(mapped, dtype='<f8', count=count, offset=offset).astype(np.float64)
+        values = np.frombuffer(mapped, dtype='<f8', count=count, offset=offset + 8 * count).astype(np.float64)
+        offset += 16 * count
+        channels[channel] = (times, values)
+    return written_at, metadata, channels
+
+
+def _as_json(value):
+    """Return a value as it reads back from the snapshot's JSON metadata."""
+    return json.loads(json.dumps(value, default=str))
+
+
+def _changed_connection_settings(server, state):
+    """
+    Return the connection settings of a snapshot to restore on a server.
+
+    Args:
+        server: The server's session state
+        state: The server's state in the snapshot
+
+    Returns:
+        dict: Settings changed at runtime from a value that is still configured
+    """
+    baseline = state.get('configured_connection')
+    if baseline is None:
+        # Snapshot from before baselines were recorded: keep the configuration
+        return {}
+
+    configured = _as_json(server['configured_connection'])
+    return {
+        key: value
+        for key, value in state.get('connection_settings', {}).items()
+        if key in server['connection_settings'] and key in baseline and key in configured
+        and value != baseline[key] and configured[key] == baseline[key]
+    }
+
+
+def restore_snapshot():
+    """
+    Restore the runtime state from the snapshot, if there is one.
+
+    Settings are only restored for servers that are still configured, and
+    only keys the server still has. Connection settings are only restored
+    where they had been changed at runtime, and only if the configuration
+    still has the value they were changed from: a changed configuration
+    takes precedence over the snapshot. History, the filter state and the
+    latest values of subscribed channels are not restored from snapshots
+    older than max_history_age.
+
+    Returns:
+        bool: True if a snapshot was restored
+    """
+    global _last_state
+
+    path = snapshot_path()
+    if path is None:
+        return False
+
+    started = time.perf_counter()
+    snapshot = read_snapshot(path)
+    if snapshot is None:
+        return False
+    written_at, metadata, channels = snapshot
+    recent = time.time() - written_at <= float(get_snapshot_settings()['max_history_age'])
+
+    for server_id, state in metadata.get('servers', {}).items():
+        server = msr_protocol.servers.get(server_id)
+        if server is None:
+            continue
+        current = server['calibration_settings']
+        current.update({key: value for key, value in state.get('calibration_settings', {}).items() if key in current})
+        server['connection_settings'].update(_changed_connection_settings(server, state))
+        if recent:
+            server['last_value'] = state.get('last_value')
+            # Values filtered since startup are newer than the snapshot
+            for channel, value in state.get('channel_values', {}).items():
+                server['channel_values'].setdefault(channel, value)
+
+    for server_id, state in metadata.get('parameters', {}).items():
+        server = msr_protocol.servers.get(server_id)
+        if server is not None and server['parameter_tree'].loaded_at is None:
+            tree = server['parameter_tree']
+            tree.load(state.get('entries', ()))
+            tree.loaded_at = state.get('loaded_at')
+
+    restored_channels = 0
+    if recent:
+        capacity = history.get_history_capacity()
+        for channel, (times, values) in channels.items():
+            if channel in history.channel_history:
+                continue
+            buffer = history.SampleRingBuffer(capacity)
+            count = min(len(times), capacity)
+            buffer.times[:count] = times[len(times) - count:]
+            buffer.values[:count] = values[len(values) - count:]
+            buffer.total = count
+            history.channel_history[channel] = buffer
+            restored_channels += 1
+
+    _last_state = None
+    stats['restored_at'] = written_at
+    stats['restored_channels'] = restored_channels
+    logger.info(
+        f"Restored snapshot written {time.time() - written_at:.0f}s ago "
+        f"({restored_channels} channels of history) in {time.perf_counter() - started:.3f}s"
+    )
+    return True
@@ -0,0 +1,253 @@
+"""
+On-demand spectrum service for the MSR Control application.
+
+Spectra of vibration channels are computed from the in-memory history in a
+process pool, so that FFTs never stall ingest or fan-out on the event loop. The
+samples are handed to the workers through shared memory, and results are cached
+by (channel, window, end sample) so that many viewers of the same spectrum cost
+a single computation.
+"""
+import asyncio
+import multiprocessing
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from django.conf import settings
+
+from .history import get_history
+from .tasks import register_shutdown_hook
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# Supported window functions
+WINDOW_FUNCTIONS = {
+    'hann': np.hanning,
+    'hamming': np.hamming,
+    'blackman': np.blackman,
+    'rectangular': np.ones,
+}
+
+# Default spectrum settings
+DEFAULT_SPECTRUM_SETTINGS = {
+    'workers': 2,
+    'cache_size': 64,
+    'min_window': 16,
+    'max_averages': 32
+}
+
+# Lazily created process pool
+_executor = None
+
+# Finished results and in-flight computations keyed by spectrum request
+_cache = OrderedDict()
+_pending = {}
+
+
+def get_spectrum_settings():
+    """Return the spectrum settings with overrides from MSR_SPECTRUM applied."""
+    spectrum_settings = DEFAULT_SPECTRUM_SETTINGS.copy()
+    spectrum_settings.update(getattr(settings, 'MSR_SPECTRUM', {}))
+    return spectrum_settings
+
+
+def _get_executor():
+    """Return the process pool, creating it on first use."""
+    global _executor
+
+    if _executor is None:
+        # Spawn rather than fork: the server process runs threads
+        _executor = ProcessPoolExecutor(
+            max_workers=get_spectrum_settings()['workers'],
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _executor
+
+
+def shutdown_spectrum_pool():
+    """Shut down the process pool and drop cached results."""
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    _cache.clear()
+
+
+register_shutdown_hook(shutdown_spectrum_pool)
+
+
+def _attach_shared_memory(name):
+    """
+    Attach to a shared memory block created by the server process.
+
+    The block is not registered with the resource tracker (bpo-39959): the
+    server process owns and removes it. Before Python 3.13, attaching always
+    registers, and unregistering afterwards would remove the server process's
+    own entry from the tracker the spawned workers share with it, so
+    registration is skipped while attaching.
+
+    Args:
+        name: Name of the shared memory block
+
+    Returns:
+        SharedMemory: The attached block
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+def _compute_spectrum(shm_name, count, window_length, window_function, averages, sample_rate):
+    """
+    Compute an averaged amplitude spectrum in a worker process.
+
+    Segments of ``window_length`` samples overlapping by half are taken from
+    the end of the shared buffer, detrended, windowed and transformed; their
+    power spectra are averaged (Welch's method).
+
+    Args:
+        shm_name: Name of the shared memory block holding float64 samples
+        count: Number of samples in the block
+        window_length: Samples per FFT segment
+        window_function: Key into WINDOW_FUNCTIONS
+        averages: Number of segments to average
+        sample_rate: Sample rate in Hz
+
+    Returns:
+        tuple: (frequencies, amplitudes) as numpy arrays
+    """
+    shm = _attach_shared_memory(shm_name)
+    try:
+        samples = np.ndarray((count,), dtype=np.float64, buffer=shm.buf)
+        hop = max(window_length // 2, 1)
+
+        segments = np.lib.stride_tricks.sliding_window_view(samples, window_length)[::hop]
+        segments = segments[-averages:]
+        segments = segments - segments.mean(axis=1, keepdims=True)
+
+        window = WINDOW_FUNCTIONS[window_function](window_length)
+        power = np.abs(np.fft.rfft(segments * window, axis=1)) ** 2
+
+        # Single-sided amplitude spectrum corrected for the window gain
+        amplitudes = 2.0 * np.sqrt(power.mean(axis=0)) / window.sum()
+        amplitudes[0] /= 2.0
+        frequencies = np.fft.rfftfreq(window_length, d=1.0 / sample_rate)
+
+        # Drop the view before closing the block
+        del samples, segments
+        return frequencies, amplitudes
+    finally:
+        shm.close()
+
+
+async def _run_spectrum(times, values, window_length, window_function, averages, end_sample):
+    """Copy the samples into shared memory and compute the spectrum in the pool."""
+    duration = times[-1] - times[0]
+    if duration <= 0:
+        raise ValueError("Cannot determine the sample rate of the channel")
+    sample_rate = (times.size - 1) / duration
+
+    shm = shared_memory.SharedMemory(create=True, size=values.nbytes)
+    try:
+        np.ndarray(values.shape, dtype=np.float64, buffer=shm.buf)[:] = values
+
+        loop = asyncio.get_running_loop()
+        frequencies, amplitudes = await loop.run_in_executor(
+            _get_executor(), _compute_spectrum,
+            shm.name, values.size, window_length, window_function, averages, sample_rate
+        )
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return {
+        'frequencies': frequencies,
+        'amplitudes': amplitudes,
+        'sample_rate': sample_rate,
+        'end_sample': end_sample,
+    }
+
+
+async def get_spectrum(channel, window_length=1024, window_function='hann', averages=1):
+    """
+    Return the averaged amplitude spectrum of a channel's recent samples.
+
+    The end of the analysed range is rounded down to a multiple of half a
+    window, so that concurrent viewers share one cached result.
+
+    Args:
+        channel: Channel name
+        window_length: Samples per FFT segment
+        window_function: One of WINDOW_FUNCTIONS
+        averages: Number of half-overlapping segments to average
+
+    Returns:
+        dict: 'frequencies', 'amplitudes', 'sample_rate', 'end_sample' and
+        'cached' (True if no computation was needed)
+    """
+    spectrum_settings = get_spectrum_settings()
+
+    window_length = int(window_length)
+    averages = int(averages)
+    if window_function not in WINDOW_FUNCTIONS:
+        raise ValueError(f"Unknown window function: {window_function}")
+    if window_length < spectrum_settings['min_window']:
+        raise ValueError(f"Window length must be at least {spectrum_settings['min_window']}")
+    if not 1 <= averages <= spectrum_settings['max_averages']:
+        raise ValueError(f"Averages must be between 1 and {spectrum_settings['max_averages']}")
+
+    history = get_history(channel)
+    if history is None:
+        raise ValueError(f"No samples available for channel: {channel}")
+
+    hop = max(window_length // 2, 1)
+    count = window_length + (averages - 1) * hop
+    if count > history.capacity:
+        raise ValueError(f"Window needs {count} samples, history keeps {history.capacity}")
+
+    end_sample = history.total - history.total % hop
+    if end_sample - count < max(history.total - history.capacity, 0):
+        raise ValueError(f"Not enough samples yet for channel: {channel}")
+
+    key = (channel, window_length, window_function, averages, end_sample)
+
+    result = _cache.get(key)
+    if result is not None:
+        _cache.move_to_end(key)
+        return dict(result, cached=True)
+
+    # Join a computation of the same spectrum that is already running
+    pending = _pending.get(key)
+    if pending is not None:
+        result = await asyncio.shield(pending)
+        return dict(result, cached=True)
+
+    times, values = history.latest(count=count, end=end_sample)
+    task = asyncio.ensure_future(
+        _run_spectrum(times, values, window_length, window_function, averages, end_sample)
+    )
+    _pending[key] = task
+    try:
+        result = await asyncio.shield(task)
+    finally:
+        _pending.pop(key, None)
+
+    _cache[key] = result
+    while len(_cache) > spectrum_settings['cache_size']:
+        _cache.popitem(last=False)
+
+    logger.debug(f"Computed spectrum for {channel} (window={window_length}, averages={averages})")
+    return dict(result, cached=False)
@@ -0,0 +1,248 @@
+/*
+ * Client code shared by the MSR Control pages (dashboard and role views).
+ *
+ * Each page describes itself in a JSON element with the id "msr-config"
+ * (see the msr_config template tag): the user's role and the latency budget
+ * the server may batch samples within. Controls are wired up when the page
+ * contains them, so every page loads the same file from the browser cache.
+ * Samples are received by a Web Worker (stream_worker.js) and drawn by
+ * MSRStreamChart (stream_chart.js).
+ */
+(function () {
+    'use strict';
+
+    const configElement = document.getElementById('msr-config');
+    const config = configElement ? JSON.parse(configElement.textContent) : {};
+
+    // Tell the user when the server sends fewer samples because it is overloaded
+    const loadLevelMessages = {
+        operator_rate: 'The server is busy: operator displays update less often.',
+        decimation: 'The server is busy: only some samples are shown.',
+        history_paused: 'The server is overloaded: only some samples are shown and history is paused.'
+    };
+
+    function byId(id) {
+        return document.getElementById(id);
+    }
+
+    function onClick(id, handler) {
+        const element = byId(id);
+        if (element) {
+            element.addEventListener('click', handler);
+        }
+    }
+
+    // Tab switching functionality
+    document.querySelectorAll('.tab').forEach(tab => {
+        tab.addEventListener('click', function() {
+            // Remove active class from all tabs and content
+            document.querySelectorAll('.tab').forEach(t => t.classList.remove('active'));
+            document.querySelectorAll('.tab-content').forEach(c => c.classList.remove('active'));
+
+            // Add active class to clicked tab and corresponding content
+            this.classList.add('active');
+            byId(this.dataset.tab).classList.add('active');
+        });
+    });
+
+    // Check if the browser supports WebSocket
+    if (!window.WebSocket) {
+        alert("Your browser does not support WebSocket. Please use a modern browser.");
+        return;
+    }
+
+    // WebSocket connection
+    const scheme = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
+
+    function websocketUrl(query) {
+        if (config.latency_ms) {
+            query.latency_ms = config.latency_ms;
+        }
+        const search = new URLSearchParams(query).toString();
+        return scheme + window.location.host + '/ws/msr_data/' + (search ? '?' + search : '');
+    }
+
+    const canvas = byId('myChart');
+    let chart = null;
+
+    function showLoadLevel(loadLevel) {
+        const notice = byId('load-level');
+        if (!notice) {
+            return;
+        }
+        if (!loadLevel || loadLevel.level === 0) {
+            notice.style.display = 'none';
+            return;
+        }
+        notice.textContent = loadLevelMessages[loadLevel.name] || ('Load shedding level ' + loadLevel.level);
+        notice.style.display = 'block';
+    }
+
+    // Handle a message from the server other than samples
+    function handleMessage(response) {
+        if (response.error) {
+            alert(response.error);
+            return;
+        }
+
+        if (response.type === 'load_level' || response.type === 'connection_established') {
+            showLoadLevel(response.type === 'load_level' ? response : response.load_level);
+        }
+    }
+
+    // Samples are received and decoded by a worker (stream_worker.js) when the
+    // browser has workers, so the page only draws them; otherwise here
+    let send;
+    if (window.Worker && config.worker_url && config.worker !== false) {
+        const worker = new Worker(config.worker_url);
+        worker.onmessage = function(e) {
+            const message = e.data;
+            if (message.type === 'samples') {
+                if (chart) {
+                    chart.pushSeries(message.series);
+                }
+            } else if (message.type === 'message') {
+                handleMessage(message.message);
+            }
+        };
+        worker.onerror = function(e) {
+            console.error('Sample worker failed:', e.message);
+        };
+        worker.postMessage({type: 'connect', url: websocketUrl({format: 'binary'})});
+        send = function(message) {
+            worker.postMessage({type: 'send', message: message});
+        };
+    } else {
+        const socket = new WebSocket(websocketUrl({}));
+        let outbox = [];  // Commands waiting for the socket to open
+
+        socket.addEventListener('open', function() {
+            outbox.forEach(text => socket.send(text));
+            outbox = [];
+        });
+
+        socket.onmessage = function(e) {
+            const response = JSON.parse(e.data);
+            if (response.type === 'data_batch') {
+                if (chart) {
+                    chart.pushBatch(response);  // Column-oriented batch of samples
+                }
+            } else if (response.type === 'data') {
+                if (chart) {
+                    chart.push(response.data);  // Update the chart with the new data
+                }
+            } else {
+                handleMessage(response);
+            }
+        };
+
+        send = function(message) {
+            const text = JSON.stringify(message);
+            if (socket.readyState === WebSocket.OPEN) {
+                socket.send(text);
+            } else {
+                outbox.push(text);
+            }
+        };
+    }
+
+    // The server sends each channel at most as many points as the chart can show
+    if (canvas) {
+        chart = new window.MSRStreamChart(canvas, {
+            windowSeconds: config.window_s,
+            onBudgetChange: function(points, windowSeconds) {
+                send({action: 'set_point_budget', parameters: {points: points, window_s: windowSeconds}});
+            }
+        });
+    }
+
+    // Calibration controls (for Calibrators and Admins)
+    onClick('calibrate-btn', function() {
+        // Send calibration data to server
+        send({
+            action: 'calibrate',
+            parameters: {
+                offset: parseFloat(byId('offset').value),
+                gain: parseFloat(byId('gain').value),
+                filter: parseFloat(byId('filter').value)
+            }
+        });
+    });
+
+    onClick('reset-btn', function() {
+        byId('offset').value = 0;
+        byId('gain').value = 1.0;
+        byId('filter').value = 0.5;
+
+        // Send reset command to server
+        send({
+            action: 'calibrate',
+            parameters: {
+                offset: 0,
+                gain: 1.0,
+                filter: 0.5
+            }
+        });
+    });
+
+    // Admin controls
+    onClick('add-user-btn', function() {
+        const username = byId('new-username').value;
+        const password = byId('new-password').value;
+        const role = byId('new-role').value;
+
+        if (!username || !password) {
+            alert('Username and password are required');
+            return;
+        }
+
+        // Send user creation request to server
+        send({
+            action: 'admin_action',
+            command: 'add_user',
+            parameters: {
+                username: username,
+                password: password,
+                role: role
+            }
+        });
+    });
+
+    onClick('save-settings-btn', function() {
+        // Send settings to server
+        send({
+            action: 'admin_action',
+            command: 'update_settings',
+            parameters: {
+                server_address: byId('server-address').value,
+                server_port: parseInt(byId('server-port').value),
+                connection_timeout: parseInt(byId('connection-timeout').value)
+            }
+        });
+    });
+
+    onClick('apply-settings', function() {
+        // Send settings to server
+        send({
+            action: 'admin_action',
+            command: 'update_settings',
+            parameters: {
+                server_address: byId('server-address').value,
+                server_port: parseInt(byId('server-port').value),
+                refresh_rate: parseInt(byId('refresh-rate').value)
+            }
+        });
+    });
+
+    function restartService() {
+        if (confirm('Are you sure you want to restart the service?')) {
+            send({
+                action: 'admin_action',
+                command: 'restart_service'
+            });
+        }
+    }
+
+    onClick('restart-service-btn', restartService);
+    onClick('restart-service', restartService);
+})();
@@ -0,0 +1,281 @@
+/*
+ * Streaming line chart with a fixed memory footprint.
+ *
+ * Every series keeps its samples in a fixed-capacity ring buffer of typed
+ * arrays, and the chart points handed to Chart.js are preallocated objects
+ * refilled from the rings. Samples only update the rings; the chart is
+ * redrawn at most once per animation frame, without animation. Memory depends
+ * on the point budget and the number of series, never on how long the page
+ * has been open.
+ *
+ * The point budget is the number of points a series can show across the
+ * chart's width: one per CSS pixel, up to MAX_POINTS. The page sends it to
+ * the server (see the set_point_budget action), which then sends each
+ * channel at most budget points per time window. Pages that receive samples
+ * through stream_worker.js hand them over with pushSeries.
+ */
+(function () {
+    'use strict';
+
+    // Most points per series, whatever the chart's width
+    const MAX_POINTS = 2000;
+    // Fewest points per series, for very narrow charts
+    const MIN_POINTS = 100;
+    // Most series drawn at once; samples of further series are ignored
+    const MAX_SERIES = 32;
+    // Sample fields drawn as series, with their line style
+    const SERIES_FIELDS = {
+        filtered_value: {label: 'filtered', dash: []},
+        calibrated_value: {label: 'calibrated', dash: [6, 3]},
+        raw_value: {label: 'raw', dash: [2, 2]}
+    };
+    const COLORS = ['rgb(75, 192, 192)', 'rgb(255, 99, 132)', 'rgb(54, 162, 235)',
+                    'rgb(255, 159, 64)', 'rgb(153, 102, 255)', 'rgb(201, 203, 207)'];
+
+    /*
+     * Fixed-capacity ring of (time, value) samples.
+     */
+    class SampleRing {
+        constructor(capacity) {
+            this.capacity = capacity;
+            this.times = new Float64Array(capacity);
+            this.values = new Float64Array(capacity);
+            this.total = 0;  // samples ever pushed
+        }
+
+        get length() {
+            return Math.min(this.total, this.capacity);
+        }
+
+        push(time, value) {
+            const index = this.total % this.capacity;
+            this.times[index] = time;
+            this.values[index] = value;
+            this.total++;
+        }
+
+        // Copy the newest samples into a ring of another capacity
+        resized(capacity) {
+            const ring = new SampleRing(capacity);
+            const count = Math.min(this.length, capacity);
+            for (let n = this.total - count; n < this.total; n++) {
+                const index = n % this.capacity;
+                ring.push(this.times[index], this.values[index]);
+            }
+            return ring;
+        }
+    }
+
+    class StreamChart {
+        /*
+         * canvas: the canvas element to draw on
+         * options.windowSeconds: time span shown (default 60)
+         * options.onBudgetChange: called with (points, windowSeconds) when the
+         *     point budget is first known and whenever it changes
+         */
+        constructor(canvas, options) {
+            options = options || {};
+            this.canvas = canvas;
+            this.windowSeconds = options.windowSeconds || 60;
+            this.onBudgetChange = options.onBudgetChange || function () {};
+            this.series = new Map();  // key -> {ring, points, dataset}
+            this.chart = null;
+            this.frameRequested = false;
+            this.points = this.measureBudget();
+
+            this.onBudgetChange(this.points, this.windowSeconds);
+            let resizeTimer = null;
+            window.addEventListener('resize', () => {
+                clearTimeout(resizeTimer);
+                resizeTimer = setTimeout(() => this.updateBudget(), 250);
+            });
+        }
+
+        measureBudget() {
+            const width = Math.round(this.canvas.clientWidth || this.canvas.width || MAX_POINTS);
+            return Math.max(MIN_POINTS, Math.min(MAX_POINTS, width));
+        }
+
+        updateBudget() {
+            const points = this.measureBudget();
+            if (points === this.points) {
+                return;
+            }
+            this.points = points;
+            for (const series of this.series.values()) {
+                series.ring = series.ring.resized(points);
+                series.points = makePoints(points);
+            }
+            this.onBudgetChange(points, this.windowSeconds);
+            this.requestRender();
+        }
+
+        // Add the fields of one sample
+        push(sample) {
+            if (!sample || typeof sample.timestamp !== 'number') {
+                return;
+            }
+            for (const field in SERIES_FIELDS) {
+                const value = sample[field];
+                if (typeof value === 'number') {
+                    this.pushValue(sample.channel, field, sample.timestamp, value);
+                }
+            }
+            this.requestRender();
+        }
+
+        // Add the samples of a column-oriented data_batch message
+        pushBatch(batch) {
+            const timestamps = batch.timestamps;
+            const channels = batch.columns.channel;
+            for (const field in SERIES_FIELDS) {
+                const column = batch.columns[field];
+                if (!column) {
+                    continue;
+                }
+                for (let i = 0; i < batch.count; i++) {
+                    if (typeof column[i] === 'number' && typeof timestamps[i] === 'number') {
+                        this.pushValue(channels ? channels[i] : undefined, field, timestamps[i], column[i]);
+                    }
+                }
+            }
+            this.requestRender();
+        }
+
+        // Add samples decoded by stream_worker.js: [{channel, field, times, values}]
+        pushSeries(seriesList) {
+            for (const samples of seriesList) {
+                if (!SERIES_FIELDS[samples.field]) {
+                    continue;
+                }
+                for (let i = 0; i < samples.times.length; i++) {
+                    this.pushValue(samples.channel, samples.field, samples.times[i], samples.values[i]);
+                }
+            }
+            this.requestRender();
+        }
+
+        pushValue(channel, field, time, value) {
+            const key = (channel || 'MSR Data') + ' ' + SERIES_FIELDS[field].label;
+            let series = this.series.get(key);
+            if (!series) {
+                if (this.series.size >= MAX_SERIES) {
+                    return;
+                }
+                series = this.addSeries(key, field);
+            }
+            series.ring.push(time, value);
+        }
+
+        addSeries(key, field) {
+            const color = COLORS[this.series.size % COLORS.length];
+            const series = {
+                ring: new SampleRing(this.points),
+                points: makePoints(this.points),
+                dataset: {
+                    label: key,
+                    data: [],
+                    borderColor: color,
+                    backgroundColor: color,
+                    borderDash: SERIES_FIELDS[field].dash,
+                    borderWidth: 1.5,
+                    pointRadius: 0,
+                    fill: false
+                }
+            };
+            this.series.set(key, series);
+            if (this.chart) {
+                this.chart.data.datasets.push(series.dataset);
+            }
+            return series;
+        }
+
+        requestRender() {
+            if (!this.frameRequested) {
+                this.frameRequested = true;
+                window.requestAnimationFrame(() => this.render());
+            }
+        }
+
+        render() {
+            this.frameRequested = false;
+            if (!this.chart && !this.createChart()) {
+                return;
+            }
+
+            // Refill the preallocated points of every series from its ring
+            let newest = -Infinity;
+            for (const series of this.series.values()) {
+                const ring = series.ring;
+                if (ring.total) {
+                    newest = Math.max(newest, ring.times[(ring.total - 1) % ring.capacity]);
+                }
+            }
+            if (newest === -Infinity) {
+                return;
+            }
+            const oldest = newest - this.windowSeconds;
+            for (const series of this.series.values()) {
+                const ring = series.ring;
+                const data = series.dataset.data;
+                let count = 0;
+                for (let n = ring.total - ring.length; n < ring.total; n++) {
+                    const index = n % ring.capacity;
+                    if (ring.times[index] < oldest) {
+                        continue;
+                    }
+                    const point = series.points[count];
+                    point.x = ring.times[index];
+                    point.y = ring.values[index];
+                    data[count++] = point;
+                }
+                data.length = count;
+            }
+
+            const x = this.chart.options.scales.x;
+            x.min = oldest;
+            x.max = newest;
+            this.chart.update('none');
+        }
+
+        createChart() {
+            if (typeof window.Chart === 'undefined') {
+                return false;  // Chart.js not loaded (yet); samples stay in the rings
+            }
+            this.chart = new window.Chart(this.canvas.getContext('2d'), {
+                type: 'line',
+                data: {
+                    datasets: Array.from(this.series.values(), series => series.dataset)
+                },
+                options: {
+                    animation: false,
+                    parsing: false,
+                    normalized: true,
+                    spanGaps: true,
+                    responsive: true,
+                    maintainAspectRatio: false,
+                    scales: {
+                        x: {
+                            type: 'linear',
+                            ticks: {
+                                maxRotation: 0,
+                                callback: value => new Date(value * 1000).toLocaleTimeString()
+                            }
+                        }
+                    }
+                }
+            });
+            return true;
+        }
+    }
+
+    function makePoints(count) {
+        const points = new Array(count);
+        for (let i = 0; i < count; i++) {
+            points[i] = {x: 0, y: 0};
+        }
+        return points;
+    }
+
+    window.MSRStreamChart = StreamChart;
+})();
@@ -0,0 +1,303 @@
+/*
+ * Web Worker receiving the sample stream of a page.
+ *
+ * The worker owns the page's WebSocket. It asks the server for binary sample
+ * frames (see binary_frames.py), decodes them and JSON messages off the main
+ * thread, and reduces every series to the page's point budget: per time
+ * bucket of two budget intervals, only the lowest and the highest sample are
+ * kept, so spikes stay visible. Once per animation frame the reduced samples
+ * are posted to the page as typed arrays whose buffers are transferred, not
+ * copied. The page draws them and stays responsive however fast samples
+ * arrive.
+ *
+ * Messages from the page:
+ *     {type: 'connect', url}     open the WebSocket
+ *     {type: 'send', message}    send a command; queued until the socket is open
+ * Messages to the page:
+ *     {type: 'samples', series: [{channel, field, times, values}]}
+ *     {type: 'message', message} any other message from the server
+ *     {type: 'socket', state}    'open' or 'closed'
+ */
+'use strict';
+
+// Sample fields forwarded as series; bit i of a binary frame's mask is FIELDS[i]
+const FIELDS = ['filtered_value', 'calibrated_value', 'raw_value'];
+// Most samples a series holds between two frames, e.g. while the page is hidden
+const MAX_PENDING = 65536;
+// Binary frame header: magic 'MSRB', version, field mask, count, name table length
+const MAGIC = 0x4252534d;  // 'MSRB' read as a little-endian uint32
+const HEADER_SIZE = 16;
+const LITTLE_ENDIAN = new Uint8Array(new Uint16Array([1]).buffer)[0] === 1;
+
+const nextFrame = typeof self.requestAnimationFrame === 'function'
+    ? callback => self.requestAnimationFrame(callback)
+    : callback => setTimeout(callback, 16);
+
+const textDecoder = new TextDecoder();
+
+let socket = null;
+let outbox = [];            // commands waiting for the socket to open
+let bucketSeconds = 0;      // width of a reduction bucket; 0 keeps every sample
+let frameRequested = false;
+const series = new Map();   // channel + field -> SeriesBuffer
+
+/*
+ * Samples of one series waiting for the next frame.
+ */
+class SeriesBuffer {
+    constructor(channel, field) {
+        this.channel = channel;
+        this.field = field;
+        this.times = new Float64Array(256);
+        this.values = new Float64Array(256);
+        this.length = 0;
+        this.bucketEnd = -Infinity;  // end time of the open bucket
+        this.bucketOpened = 0;       // when the open bucket got its first sample
+        this.minTime = 0;
+        this.minValue = Infinity;
+        this.maxTime = 0;
+        this.maxValue = -Infinity;
+    }
+
+    add(time, value) {
+        if (bucketSeconds <= 0) {
+            this.append(time, value);
+            return;
+        }
+        if (time >= this.bucketEnd) {
+            this.closeBucket();
+            this.bucketEnd = (Math.floor(time / bucketSeconds) + 1) * bucketSeconds;
+            this.bucketOpened = performance.now();
+        }
+        if (value < this.minValue) {
+            this.minTime = time;
+            this.minValue = value;
+        }
+        if (value > this.maxValue) {
+            this.maxTime = time;
+            this.maxValue = value;
+        }
+    }
+
+    // Move the extremes of the open bucket to the pending samples, in time order
+    closeBucket() {
+        if (this.minValue === Infinity) {
+            return;
+        }
+        if (this.minTime === this.maxTime) {
+            this.append(this.minTime, this.minValue);
+        } else if (this.minTime < this.maxTime) {
+            this.append(this.minTime, this.minValue);
+            this.append(this.maxTime, this.maxValue);
+        } else {
+            this.append(this.maxTime, this.maxValue);
+            this.append(this.minTime, this.minValue);
+        }
+        this.minValue = Infinity;
+        this.maxValue = -Infinity;
+        this.bucketEnd = -Infinity;
+    }
+
+    append(time, value) {
+        if (this.length === this.times.length) {
+            if (this.length < MAX_PENDING) {
+                this.times = grow(this.times);
+                this.values = grow(this.values);
+            } else {
+                this.halve();
+            }
+        }
+        this.times[this.length] = time;
+        this.values[this.length] = value;
+        this.length++;
+    }
+
+    // Drop every second pending sample
+    halve() {
+        let kept = 0;
+        for (let i = 0; i < this.length; i += 2) {
+            this.times[kept] = this.times[i];
+            this.values[kept] = this.values[i];
+            kept++;
+        }
+        this.length = kept;
+    }
+
+    // Take the pending samples as new arrays, closing a bucket open for too long
+    take(now) {
+        if (this.bucketEnd !== -Infinity && now - this.bucketOpened >= bucketSeconds * 1000) {
+            this.closeBucket();
+        }
+        if (!this.length) {
+            return null;
+        }
+        const taken = {
+            channel: this.channel,
+            field: this.field,
+            times: this.times.slice(0, this.length),
+            values: this.values.slice(0, this.length)
+        };
+        this.length = 0;
+        return taken;
+    }
+}
+
+function grow(array) {
+    const grown = new Float64Array(Math.min(array.length * 2, MAX_PENDING));
+    grown.set(array);
+    return grown;
+}
+
+function addSample(channel, field, time, value) {
+    if (typeof time !== 'number' || typeof value !== 'number' || value !== value) {
+        return;
+    }
+    const key = channel + '\u0000' + field;
+    let buffer = series.get(key);
+    if (!buffer) {
+        buffer = new SeriesBuffer(channel, field);
+        series.set(key, buffer);
+    }
+    buffer.add(time, value);
+    requestFrame();
+}
+
+function requestFrame() {
+    if (!frameRequested) {
+        frameRequested = true;
+        nextFrame(postSamples);
+    }
+}
+
+// Post the samples reduced since the last frame, transferring their buffers
+function postSamples() {
+    frameRequested = false;
+    const now = performance.now();
+    const posted = [];
+    const transfer = [];
+    let open = false;
+    for (const buffer of series.values()) {
+        const taken = buffer.take(now);
+        if (taken) {
+            posted.push(taken);
+            transfer.push(taken.times.buffer, taken.values.buffer);
+        }
+        open = open || buffer.bucketEnd !== -Infinity;
+    }
+    if (posted.length) {
+        self.postMessage({type: 'samples', series: posted}, transfer);
+    }
+    if (open) {
+        requestFrame();  // Open buckets are closed once they are old enough
+    }
+}
+
+function readFloat64(view, offset, count) {
+    if (LITTLE_ENDIAN) {
+        return new Float64Array(view.buffer, offset, count);
+    }
+    const column = new Float64Array(count);
+    for (let i = 0; i < count; i++) {
+        column[i] = view.getFloat64(offset + i * 8, true);
+    }
+    return column;
+}
+
+function decodeFrame(buffer) {
+    const view = new DataView(buffer);
+    if (buffer.byteLength < HEADER_SIZE || view.getUint32(0, true) !== MAGIC) {
+        return;
+    }
+    const mask = view.getUint16(6, true);
+    const count = view.getUint32(8, true);
+    const nameLength = view.getUint32(12, true);
+
+    let offset = HEADER_SIZE;
+    const times = readFloat64(view, offset, count);
+    offset += count * 8;
+    const columns = [];
+    FIELDS.forEach((field, bit) => {
+        if (mask & (1 << bit)) {
+            columns.push([field, readFloat64(view, offset, count)]);
+            offset += count * 8;
+        }
+    });
+    const channelOffset = offset;
+    offset += count * 2;
+    const names = JSON.parse(textDecoder.decode(new Uint8Array(buffer, offset, nameLength)));
+
+    for (let i = 0; i < count; i++) {
+        const channel = names[view.getUint16(channelOffset + i * 2, true)] || undefined;
+        for (const [field, column] of columns) {
+            addSample(channel, field, times[i], column[i]);
+        }
+    }
+}
+
+function handleText(text) {
+    const message = JSON.parse(text);
+    if (message.type === 'data' && message.data) {
+        const sample = message.data;
+        for (const field of FIELDS) {
+            addSample(sample.channel, field, sample.timestamp, sample[field]);
+        }
+    } else if (message.type === 'data_batch') {
+        const channels = message.columns.channel;
+        for (const field of FIELDS) {
+            const column = message.columns[field];
+            if (!column) {
+                continue;
+            }
+            for (let i = 0; i < message.count; i++) {
+                addSample(channels ? channels[i] : undefined, field, message.timestamps[i], column[i]);
+            }
+        }
+    } else {
+        self.postMessage({type: 'message', message: message});
+    }
+}
+
+function connect(url) {
+    socket = new WebSocket(url);
+    socket.binaryType = 'arraybuffer';
+    socket.onopen = function () {
+        self.postMessage({type: 'socket', state: 'open'});
+        for (const text of outbox) {
+            socket.send(text);
+        }
+        outbox = [];
+    };
+    socket.onclose = function () {
+        self.postMessage({type: 'socket', state: 'closed'});
+    };
+    socket.onmessage = function (e) {
+        if (typeof e.data === 'string') {
+            handleText(e.data);
+        } else {
+            decodeFrame(e.data);
+        }
+    };
+}
+
+function send(message) {
+    // The point budget also sets how far the samples are reduced here
+    if (message.action === 'set_point_budget') {
+        const budget = message.parameters || {};
+        bucketSeconds = budget.points > 0 ? 2 * budget.window_s / budget.points : 0;
+    }
+    const text = JSON.stringify(message);
+    if (socket && socket.readyState === WebSocket.OPEN) {
+        socket.send(text);
+    } else {
+        outbox.push(text);
+    }
+}
+
+self.onmessage = function (e) {
+    const command = e.data;
+    if (command.type === 'connect') {
+        connect(command.url);
+    } else if (command.type === 'send') {
+        send(command.message);
+    }
+};
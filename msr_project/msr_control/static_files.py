@@ -0,0 +1,216 @@
+"""
+Static file storage and serving for the MSR Control application.
+
+``collectstatic`` stores every file under a name containing a hash of its
+content (Django's manifest storage) and writes gzip (and, if the brotli
+package is installed, brotli) compressed copies next to text files.
+
+Under ASGI, StaticFilesApp serves STATIC_URL before Django sees the request.
+Hashed names never change content, so they are served with a one-year
+immutable Cache-Control; other names must be revalidated with their ETag.
+The compressed copy the browser accepts is sent, and files are kept in
+memory after the first request, so serving them costs no disk reads and no
+worker threads.
+"""
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import (
+    ManifestStaticFilesStorage,
+    staticfiles_storage,
+)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# File extensions worth compressing
+COMPRESSIBLE_EXTENSIONS = frozenset({'.js', '.mjs', '.css', '.html', '.json', '.svg', '.txt', '.map', '.xml'})
+
+# Files smaller than this are not compressed
+MIN_COMPRESS_SIZE = 256
+
+# Content encodings in order of preference -> suffix of the compressed copy
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+IMMUTABLE_CACHE_CONTROL = b'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = b'public, max-age=0, must-revalidate'
+
+
+def compress_file(path):
+    """
+    Write compressed copies of a file where they are smaller than the file.
+
+    Args:
+        path: Absolute path of the file
+
+    Returns:
+        list: Paths of the written copies
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    written = []
+    variants = [('.gz', lambda content: gzip.compress(content, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', lambda content: brotli.compress(content, quality=11)))
+    for suffix, compress in variants:
+        compressed = compress(data)
+        if len(compressed) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+            written.append(path + suffix)
+    return written
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Manifest storage that also writes compressed copies of text files.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+
+        names = set(self.hashed_files) | set(self.hashed_files.values())
+        compressed = 0
+        for name in names:
+            if os.path.splitext(name)[1] not in COMPRESSIBLE_EXTENSIONS or not self.exists(name):
+                continue
+            if self.size(name) >= MIN_COMPRESS_SIZE:
+                compressed += len(compress_file(self.path(name)))
+        logger.info(f"Wrote {compressed} compressed static files")
+
+
+class StaticFile:
+    """
+    A static file held in memory with its compressed copies.
+    """
+
+    __slots__ = ('content_type', 'etag', 'immutable', 'variants')
+
+    def __init__(self, path, immutable):
+        with open(path, 'rb') as f:
+            content = f.read()
+        self.variants = {'identity': content}
+        for encoding, suffix in ENCODINGS:
+            if os.path.exists(path + suffix):
+                with open(path + suffix, 'rb') as f:
+                    self.variants[encoding] = f.read()
+
+        content_type, _ = mimetypes.guess_type(path)
+        content_type = content_type or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+            content_type += '; charset=utf-8'
+        self.content_type = content_type.encode()
+        self.etag = hashlib.md5(content, usedforsecurity=False).hexdigest()[:16]
+        self.immutable = immutable
+
+    def choose(self, accept_encoding):
+        """
+        Pick the variant for an Accept-Encoding header.
+
+        Returns:
+            tuple: (encoding, content)
+        """
+        accepted = set()
+        for token in accept_encoding.split(','):
+            coding, _, params = token.strip().partition(';')
+            if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                accepted.add(coding.strip().lower())
+        for encoding, _ in ENCODINGS:
+            if encoding in self.variants and (encoding in accepted or '*' in accepted):
+                return encoding, self.variants[encoding]
+        return 'identity', self.variants['identity']
+
+
+class StaticFilesApp:
+    """
+    ASGI application serving STATIC_URL and passing everything else on.
+
+    Args:
+        application: The ASGI application for all other requests
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.prefix = '/' + settings.STATIC_URL.strip('/') + '/'
+        self.files = {}  # name -> StaticFile of the files served so far
+        self.hashed_names = set(getattr(staticfiles_storage, 'hashed_files', {}).values())
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.prefix):
+            return await self.application(scope, receive, send)
+
+        name = posixpath.normpath(scope['path'][len(self.prefix):]).lstrip('/')
+        if name.startswith('..'):
+            return await self.application(scope, receive, send)
+
+        static_file = self.files.get(name)
+        if static_file is None:
+            static_file = await asyncio.to_thread(self.load, name)
+            # Files are re-read on every request during development
+            if static_file is not None and not settings.DEBUG:
+                self.files[name] = static_file
+        if static_file is None:
+            return await self.application(scope, receive, send)
+
+        if scope['method'] not in ('GET', 'HEAD'):
+            await self.respond(send, 405, [(b'allow', b'GET, HEAD')], b'')
+            return
+
+        headers = dict(scope['headers'])
+        encoding, content = static_file.choose(headers.get(b'accept-encoding', b'').decode('latin-1'))
+        etag = f'"{static_file.etag}-{encoding}"'.encode()
+        response_headers = [
+            (b'cache-control', IMMUTABLE_CACHE_CONTROL if static_file.immutable else REVALIDATE_CACHE_CONTROL),
+            (b'etag', etag),
+            (b'x-content-type-options', b'nosniff'),
+        ]
+        if len(static_file.variants) > 1:
+            response_headers.append((b'vary', b'Accept-Encoding'))
+
+        if etag in headers.get(b'if-none-match', b'').replace(b' ', b'').split(b','):
+            await self.respond(send, 304, response_headers, b'')
+            return
+
+        response_headers.append((b'content-type', static_file.content_type))
+        response_headers.append((b'content-length', str(len(content)).encode()))
+        if encoding != 'identity':
+            response_headers.append((b'content-encoding', encoding.encode()))
+        await self.respond(send, 200, response_headers, b'' if scope['method'] == 'HEAD' else content)
+
+    def load(self, name):
+        """
+        Find and read a static file.
+
+        Returns:
+            StaticFile: The file, or None if there is no such file
+        """
+        if settings.DEBUG:
+            path = finders.find(name)
+        else:
+            path = staticfiles_storage.path(name) if settings.STATIC_ROOT else None
+        if not path or not os.path.isfile(path):
+            return None
+        return StaticFile(path, immutable=name in self.hashed_names)
+
+    async def respond(self, send, status, headers, body):
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,175 @@
+"""
+Connection supervisor for the EtherLab servers.
+
+One ``ConnectionSupervisor`` per server owns the whole connection lifecycle,
+so there is exactly one connection attempt in flight per server:
+
+    connecting -> connected -> (connection lost) -> connecting
+    connecting -> (failed) -> failover -> connecting     next standby server
+    connecting -> (failed, all servers tried) -> backoff -> connecting
+
+The primary server is tried first, then each standby server in turn without
+waiting. Only after every server failed does the supervisor back off, with
+exponential delays and full jitter so that several workers do not retry in
+lockstep. Once ``retry_attempts`` rounds have failed it starts demo data,
+which is stopped as soon as a connection succeeds.
+
+Subscriptions registered with ``msr_protocol.subscribe`` are replayed on every
+new connection. ``request_reconnect`` performs a controlled reconnect (e.g.
+after the address changed) without touching the WebSocket clients.
+"""
+import asyncio
+import random
+
+from .msr_protocol import connect_to_etherlab, generate_demo_data, get_server
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger, get_rate_limited_logger
+    logger = get_logger()
+    # Per-sample and repeating messages, logged at most once per interval
+    limited_logger = get_rate_limited_logger()
+except ImportError:
+    import logging
+    logger = limited_logger = logging.getLogger(__name__)
+
+
+class ConnectionSupervisor:
+    """
+    State machine running the connection to one EtherLab server.
+    """
+
+    def __init__(self, server_id):
+        self.server_id = server_id
+        self.server = get_server(server_id)
+        self.endpoint_index = 0
+        self.failed_rounds = 0
+        self._session = None
+        self._demo_task = None
+        self._reconnect_requested = False
+        self._wakeup = asyncio.Event()
+
+        # Connections closing sooner than this after connecting count as failures
+        self.min_session_time = 1.0
+
+    def endpoints(self):
+        """Return the (host, port) pairs to try: the primary server, then the standbys."""
+        connection_settings = self.server['connection_settings']
+        return [(connection_settings['host'], connection_settings['port'])] + [
+            (standby['host'], standby['port']) for standby in connection_settings.get('standby', [])
+        ]
+
+    def set_state(self, state):
+        self.server['connection_state']['state'] = state
+        logger.debug(f"Connection supervisor for {self.server_id}: {state}")
+
+    def backoff_delay(self):
+        """Return the jittered delay before the next round of connection attempts."""
+        connection_settings = self.server['connection_settings']
+        ceiling = min(
+            connection_settings['reconnect_delay'] * 2 ** (self.failed_rounds - 1),
+            connection_settings['max_reconnect_delay']
+        )
+        return random.uniform(0, ceiling)
+
+    def request_reconnect(self):
+        """Close the current connection and reconnect to the primary server right away."""
+        self._reconnect_requested = True
+        self._wakeup.set()
+        if self._session is not None and not self._session.done():
+            self._session.cancel()
+
+    def _on_connected(self):
+        """Reset the failure counters and stop demo data once connected."""
+        self.set_state('connected')
+        self.failed_rounds = 0
+        self.server['connection_state']['reconnect_attempts'] = 0
+        self._stop_demo()
+
+    def _stop_demo(self):
+        if self._demo_task is not None:
+            self._demo_task.cancel()
+            self._demo_task = None
+
+    def _start_demo(self):
+        if self._demo_task is None or self._demo_task.done():
+            logger.warning(f"No EtherLab server reachable for {self.server_id}, switching to demo data")
+            self._demo_task = asyncio.get_running_loop().create_task(generate_demo_data(self.server_id))
+
+    async def run(self):
+        """Keep the server connected until cancelled."""
+        connection_state = self.server['connection_state']
+        self.server['supervisor'] = self
+        loop = asyncio.get_running_loop()
+
+        try:
+            while True:
+                endpoints = self.endpoints()
+                self.endpoint_index %= len(endpoints)
+                host, port = endpoints[self.endpoint_index]
+
+                self.set_state('connecting')
+                started = loop.time()
+                self._session = asyncio.ensure_future(
+                    connect_to_etherlab(self.server_id, host, port, on_connected=self._on_connected)
+                )
+                try:
+                    # wait() does not pass the session's cancellation on to this
+                    # task, so a cancelled session is only a reconnect if one was
+                    # requested; cancelling this task still raises right here
+                    await asyncio.wait((self._session,))
+                    if self._session.cancelled() and self._reconnect_requested:
+                        self._reconnect_requested = False
+                        self._wakeup.clear()
+                        self.endpoint_index = 0
+                        self.failed_rounds = 0
+                        logger.info(f"Reconnecting to {self.server_id}")
+                        continue
+                    self._session.result()
+                    logger.info(f"Connection to {self.server_id} at {host}:{port} closed")
+                    if loop.time() - started >= self.min_session_time:
+                        # The server closed an established connection; reconnect right away
+                        continue
+                    connection_state['reconnect_attempts'] += 1
+                except ConnectionError:
+                    connection_state['reconnect_attempts'] += 1
+                except Exception:
+                    limited_logger.exception("Error in connection to %s", self.server_id)
+                    connection_state['reconnect_attempts'] += 1
+
+                # Fail over to the next server immediately
+                self.endpoint_index += 1
+                if self.endpoint_index < len(endpoints):
+                    self.set_state('failover')
+                    host, port = endpoints[self.endpoint_index]
+                    logger.info(f"Failing over {self.server_id} to {host}:{port}")
+                    continue
+
+                # Every server failed; back off before the next round
+                self.endpoint_index = 0
+                self.failed_rounds += 1
+                if self.failed_rounds >= self.server['connection_settings']['retry_attempts']:
+                    self._start_demo()
+
+                delay = self.backoff_delay()
+                self.set_state('backoff')
+                logger.info(f"Reconnecting to {self.server_id} in {delay:.1f} seconds (round {self.failed_rounds})")
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+                # A reconnect requested during the backoff starts over right away
+                self._wakeup.clear()
+                if self._reconnect_requested:
+                    self._reconnect_requested = False
+                    self.failed_rounds = 0
+
+        finally:
+            if self._session is not None and not self._session.done():
+                # Let the session close its socket before this task ends
+                self._session.cancel()
+                await asyncio.wait((self._session,))
+            self._stop_demo()
+            self.set_state('stopped')
+            self.server['supervisor'] = None
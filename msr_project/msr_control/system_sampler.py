@@ -0,0 +1,249 @@
+"""
+Background sampler of process and host statistics.
+
+Once per interval (1 second by default) the sampler reads the process's CPU
+time, memory, threads and open file descriptors from ``/proc/self``, the
+host's load, CPU and memory from ``/proc``, the event loop lag and how busy
+the thread pools running synchronous code are. The figures are published as
+a new ``snapshot`` dictionary that is never modified afterwards, so samples
+and status responses reference it without copying and without doing any
+work per sample.
+
+Where ``/proc`` is not available (e.g. macOS), portable fallbacks from the
+os module are used and figures without one are None.
+"""
+import asyncio
+import os
+import time
+
+from django.conf import settings
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# Default sampler settings
+DEFAULT_SAMPLER_SETTINGS = {
+    'interval': 1.0  # seconds between samples
+}
+
+try:
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (ValueError, OSError, AttributeError):
+    CLOCK_TICKS = 100
+    PAGE_SIZE = 4096
+
+# Latest statistics; replaced as a whole on every sample, never modified
+snapshot = {
+    'sampled_at': None,
+    'cpu_usage': None,
+    'cpu_seconds': None,
+    'memory_usage': None,
+    'rss_bytes': None,
+    'threads': None,
+    'open_fds': None,
+    'load_average': None,
+    'host_cpu_usage': None,
+    'host_memory_usage': None,
+    'event_loop_lag': None,
+    'thread_pools': {}
+}
+
+# Counters of the previous sample, for rates
+_previous = {
+    'time': None,
+    'cpu_seconds': None,
+    'host_busy': None,
+    'host_total': None
+}
+
+
+def get_sampler_settings():
+    """Return the sampler settings with overrides from MSR_SYSTEM_STATS applied."""
+    sampler_settings = DEFAULT_SAMPLER_SETTINGS.copy()
+    sampler_settings.update(getattr(settings, 'MSR_SYSTEM_STATS', {}))
+    return sampler_settings
+
+
+def _read_file(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def read_process():
+    """
+    Read the process's CPU time, resident memory and thread count.
+
+    Returns:
+        tuple: (cpu_seconds, rss_bytes, threads); unknown figures are None
+    """
+    stat = _read_file('/proc/self/stat')
+    if stat:
+        # Fields after the command name, which may itself contain spaces
+        fields = stat[stat.rfind(')') + 2:].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        threads = int(fields[17])
+        rss = int(fields[21]) * PAGE_SIZE
+        return cpu_seconds, rss, threads
+
+    times = os.times()
+    return times.user + times.system, None, None
+
+
+def count_open_fds():
+    """Return the number of open file descriptors, or None if unknown."""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def read_host_cpu():
+    """
+    Read the host's cumulative CPU time from /proc/stat.
+
+    Returns:
+        tuple: (busy ticks, total ticks), or (None, None) if unknown
+    """
+    stat = _read_file('/proc/stat')
+    if not stat:
+        return None, None
+    ticks = [int(value) for value in stat.split('\n', 1)[0].split()[1:]]
+    idle = ticks[3] + (ticks[4] if len(ticks) > 4 else 0)  # idle + iowait
+    total = sum(ticks)
+    return total - idle, total
+
+
+def read_host_memory_usage():
+    """Return the percentage of host memory in use, or None if unknown."""
+    meminfo = _read_file('/proc/meminfo')
+    if not meminfo:
+        return None
+    values = {}
+    for line in meminfo.splitlines():
+        name, _, value = line.partition(':')
+        values[name] = value.split()[0] if value.split() else '0'
+    try:
+        total = int(values['MemTotal'])
+        available = int(values['MemAvailable'])
+    except (KeyError, ValueError):
+        return None
+    return round(100.0 * (total - available) / total, 1) if total else None
+
+
+def _executor_stats(executor):
+    """Describe a ThreadPoolExecutor's saturation, or None if it is not one."""
+    if executor is None or not hasattr(executor, '_work_queue'):
+        return None
+    workers = len(getattr(executor, '_threads', ()))
+    idle = getattr(getattr(executor, '_idle_semaphore', None), '_value', None)
+    return {
+        'max_workers': getattr(executor, '_max_workers', None),
+        'workers': workers,
+        'busy': max(0, workers - idle) if idle is not None else None,
+        'queued': executor._work_queue.qsize()
+    }
+
+
+def read_thread_pools(loop):
+    """
+    Describe the thread pools that run synchronous code for the event loop.
+
+    Returns:
+        dict: 'default' (the loop's executor, used by sync_to_async with
+            thread_sensitive=False) and 'thread_sensitive' (asgiref's shared
+            thread, used for database access), where they exist
+    """
+    pools = {}
+    default = _executor_stats(getattr(loop, '_default_executor', None))
+    if default is not None:
+        pools['default'] = default
+    try:
+        from asgiref.sync import SyncToAsync
+        sensitive = _executor_stats(getattr(SyncToAsync, 'single_thread_executor', None))
+    except ImportError:
+        sensitive = None
+    if sensitive is not None:
+        pools['thread_sensitive'] = sensitive
+    return pools
+
+
+def take_sample(loop=None):
+    """
+    Read all statistics and publish them as the new snapshot.
+
+    Args:
+        loop: The event loop whose executors are inspected (the running loop if None)
+
+    Returns:
+        dict: The new snapshot
+    """
+    global snapshot
+    from .metrics import loop_lag
+
+    now = time.monotonic()
+    cpu_seconds, rss, threads = read_process()
+    host_busy, host_total = read_host_cpu()
+
+    cpu_usage = None
+    if _previous['time'] is not None and now > _previous['time']:
+        cpu_usage = round(100.0 * (cpu_seconds - _previous['cpu_seconds']) / (now - _previous['time']), 1)
+    host_cpu_usage = None
+    if host_total is not None and _previous['host_total'] is not None and host_total > _previous['host_total']:
+        host_cpu_usage = round(
+            100.0 * (host_busy - _previous['host_busy']) / (host_total - _previous['host_total']), 1
+        )
+    _previous.update({'time': now, 'cpu_seconds': cpu_seconds, 'host_busy': host_busy, 'host_total': host_total})
+
+    host_memory = None
+    try:
+        host_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        pass
+
+    try:
+        load_average = [round(value, 2) for value in os.getloadavg()]
+    except (OSError, AttributeError):
+        load_average = None
+
+    snapshot = {
+        'sampled_at': time.time(),
+        'cpu_usage': cpu_usage,
+        'cpu_seconds': cpu_seconds,
+        'memory_usage': round(100.0 * rss / host_memory, 1) if rss and host_memory else None,
+        'rss_bytes': rss,
+        'threads': threads,
+        'open_fds': count_open_fds(),
+        'load_average': load_average,
+        'host_cpu_usage': host_cpu_usage,
+        'host_memory_usage': read_host_memory_usage(),
+        'event_loop_lag': round(loop_lag['current'], 6),
+        'thread_pools': read_thread_pools(loop or asyncio.get_running_loop())
+    }
+    return snapshot
+
+
+async def run_sampler(interval=None):
+    """
+    Take a sample every interval until cancelled.
+
+    Args:
+        interval: Seconds between samples (MSR_SYSTEM_STATS interval if None)
+    """
+    if interval is None:
+        interval = get_sampler_settings()['interval']
+
+    while True:
+        try:
+            take_sample()
+        except Exception:
+            logger.exception("Error sampling system statistics")
+        await asyncio.sleep(interval)
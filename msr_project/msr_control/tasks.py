@@ -5,62 +5,254 @@ This module contains asynchronous background tasks that run
 independently of the HTTP request/response cycle.
 """
 import asyncio
-import traceback
-from msr_control.msr_protocol import connect_to_etherlab
+import inspect
+import json
+from django.conf import settings
+from msr_control import msr_protocol
+from msr_control.autocal import observe_raw_value
+from msr_control.history import record_sample
+from msr_control.metrics import counters, monitor_event_loop
+from msr_control.system_sampler import run_sampler
+from msr_control.msr_protocol import background_tasks, send_data_to_websocket
+from msr_control.shm_ring import SharedFrameRing, get_shared_ring_settings
+from msr_control.snapshot import restore_snapshot, run_snapshots, save_final_snapshot
+from msr_control.supervisor import ConnectionSupervisor
 
 # Try to import the logger, but don't fail if it's not available yet
 try:
-    from .utils.logger import get_logger
+    from .utils.logger import get_logger, get_rate_limited_logger
     logger = get_logger()
+    limited_logger = get_rate_limited_logger()
 except ImportError:
     import logging
-    logger = logging.getLogger(__name__)
+    logger = limited_logger = logging.getLogger(__name__)
 
-async def fetch_msr_data():
+# The running ingest task (None until started)
+_ingest_task = None
+
+# Callbacks that drain buffers on shutdown, run in registration order
+_shutdown_hooks = []
+
+def register_shutdown_hook(hook):
     """
-    Background task that connects to the EtherLab server and fetches MSR data.
+    Register a callback to run when ingest is stopped.
 
-    This task runs continuously in the background, connecting to the EtherLab server,
-    processing the received data, and sending it to WebSocket clients. If the connection
-    fails, it will attempt to reconnect based on the configured retry settings.
+    Args:
+        hook: A plain or async callable taking no arguments
     """
-    logger.info("Starting MSR data fetch task")
+    if hook not in _shutdown_hooks:
+        _shutdown_hooks.append(hook)
 
-    # Track consecutive failures for exponential backoff
-    consecutive_failures = 0
-    max_backoff = 60  # Maximum backoff time in seconds
+def uses_shared_ingest():
+    """
+    Return True if the EtherLab connection runs in the run_msr_ingest process.
 
-    while True:
-        try:
-            # Connect to EtherLab server and start processing data
-            logger.info("Connecting to EtherLab server")
-            await connect_to_etherlab()
+    In that case this process has no connection of its own: it has no
+    parameter tree or channel list and cannot subscribe to channels.
+    """
+    return getattr(settings, 'MSR_INGEST_MODE', 'embedded') == 'shared_memory'
+
+def start_ingest():
+    """
+    Start the ingest task on the running event loop.
 
-            # If we get here, the connection has been closed normally
-            # Reset consecutive failures counter
-            consecutive_failures = 0
-            logger.info("Connection to EtherLab server closed normally")
+    This is called from the ASGI lifespan startup only, so ingest runs on
+    the server's own loop. Ingest, its auxiliary tasks and the snapshot
+    restore are started once until stop_ingest; calling it again returns the
+    existing task, even if that task has ended.
+
+    With ``MSR_INGEST_MODE = 'shared_memory'`` the EtherLab connection runs in
+    the standalone ``run_msr_ingest`` process, and this starts the relay of
+    its shared-memory frames to the local WebSocket clients instead.
+    Otherwise the runtime state is restored from the last snapshot before
+    ingest starts, and snapshots are written while it runs.
+
+    Returns:
+        asyncio.Task: The ingest task
+    """
+    global _ingest_task
 
-        except asyncio.CancelledError:
-            # Task was cancelled, exit gracefully
-            logger.info("MSR data fetch task cancelled")
-            break
+    if _ingest_task is not None:
+        return _ingest_task
 
+    # Measure event loop lag and sample system statistics for admins and /metrics
+    msr_protocol.spawn_background_task(monitor_event_loop())
+    msr_protocol.spawn_background_task(run_sampler())
+
+    if uses_shared_ingest():
+        logger.info("Starting relay of frames from the standalone ingest process")
+        _ingest_task = asyncio.get_running_loop().create_task(relay_shared_frames())
+    else:
+        logger.info("Starting MSR ingest on the server event loop")
+        restore_snapshot()
+        msr_protocol.spawn_background_task(run_snapshots())
+        register_shutdown_hook(save_final_snapshot)
+        _ingest_task = asyncio.get_running_loop().create_task(fetch_msr_data())
+    _ingest_task.add_done_callback(_log_ingest_end)
+    return _ingest_task
+
+def _log_ingest_end(task):
+    """Log an ingest task that ended before stop_ingest."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"MSR ingest stopped unexpectedly: {task.exception()!r}")
+
+async def stop_ingest():
+    """
+    Stop ingest and drain buffers.
+
+    Cancels the ingest task and any tasks spawned by the protocol layer, waits
+    for them to finish (closing the EtherLab socket), then runs the registered
+    shutdown hooks.
+    """
+    global _ingest_task
+
+    tasks = list(background_tasks)
+    if _ingest_task is not None:
+        tasks.append(_ingest_task)
+        _ingest_task = None
+
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    for hook in _shutdown_hooks:
+        try:
+            result = hook()
+            if inspect.isawaitable(result):
+                await result
         except Exception as e:
-            # Log the error with traceback
-            logger.error(f"Error in fetch_msr_data task: {str(e)}")
-            logger.debug(traceback.format_exc())
+            logger.error(f"Error in shutdown hook {getattr(hook, '__name__', hook)}: {e}")
 
-            # Increment consecutive failures counter
-            consecutive_failures += 1
+    logger.info("MSR ingest stopped")
 
-            # Calculate backoff time with exponential backoff and jitter
-            backoff_time = min(2 ** consecutive_failures + (0.1 * asyncio.get_event_loop().time() % 1), max_backoff)
+async def relay_shared_frames():
+    """
+    Relay frames from the standalone ingest process to local WebSocket clients.
 
-            logger.warning(f"Retrying in {backoff_time:.1f} seconds (attempt {consecutive_failures})")
+    Attaches to the shared-memory ring published by ``run_msr_ingest`` (waiting
+    for it to appear), and polls it for new frames. Each frame is recorded in
+    the local history, fed to this worker's auto-calibration hold windows and
+    sent to this worker's channel layer group; a frame that cannot be decoded
+    is counted in ``relay_errors`` and skipped. Settings changed by clients of
+    this worker are forwarded to the ingest process through the ring's control
+    block; the ingest process writes mapped calibration parameters to the
+    server and logs write failures, which this worker does not see.
+    """
+    ring_settings = get_shared_ring_settings()
+    poll_interval = ring_settings['poll_interval']
+    loop = asyncio.get_running_loop()
+    ring = None
+    last_frame_time = loop.time()
+
+    try:
+        while True:
+            if ring is None:
+                try:
+                    ring = SharedFrameRing.attach(ring_settings['name'])
+                    msr_protocol.settings_forwarder = ring.update_control
+                    logger.info(f"Attached to shared frame ring {ring_settings['name']}")
+                except FileNotFoundError:
+                    await asyncio.sleep(1)
+                    continue
+
+            frames = ring.read_new()
+            if frames:
+                last_frame_time = loop.time()
+            for payload in frames:
+                try:
+                    data = json.loads(payload)
+                    server_id = data.get('server', msr_protocol.DEFAULT_SERVER)
+                    server = msr_protocol.servers.get(server_id)
+                    if server is not None and 'calibrated_value' in data:
+                        channel = msr_protocol.history_channel(server, data['channel'])
+                        record_sample(channel, data['timestamp'], data['calibrated_value'])
+                    if server is not None and 'raw_value' in data and data['channel'] == server['channel']:
+                        observe_raw_value(data['raw_value'], server_id)
+                    if server is not None and 'calibration_data' in data:
+                        # Mirror the calibration applied by the ingest process
+                        server['calibration_settings'].update(data['calibration_data'])
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    counters['relay_errors'] += 1
+                    limited_logger.error("Skipping malformed shared frame: %s", e)
+                    continue
+                # Every worker relays the same frames, so only deliver locally;
+                # the ingest process has decimated them already
+                await send_data_to_websocket(data, local_only=True)
+
+            # Check for a restarted ingest process about once a second while idle
+            if not frames and loop.time() - last_frame_time > 1:
+                last_frame_time = loop.time()
+                if ring.is_replaced():
+                    logger.info("Shared frame ring was replaced, re-attaching")
+                    msr_protocol.settings_forwarder = None
+                    ring.close()
+                    ring = None
+                    continue
+
+            await asyncio.sleep(poll_interval)
+
+    except asyncio.CancelledError:
+        logger.info("Shared frame relay cancelled")
+    finally:
+        msr_protocol.settings_forwarder = None
+        if ring is not None:
+            ring.close()
+
+async def apply_shared_control(ring, interval=0.5):
+    """
+    Apply settings requested by the ASGI workers in the ingest process.
+
+    Args:
+        ring: The SharedFrameRing owned by this process
+        interval: Seconds between checks of the control block
+    """
+    applied_version = ring.control_version()
+
+    while True:
+        await asyncio.sleep(interval)
+        if ring.control_version() == applied_version:
+            continue
+
+        applied_version, control = ring.read_control()
+        for server_id, values in control.get('calibration', {}).items():
+            await msr_protocol.update_calibration(values, server_id)
+        for server_id, values in control.get('connection', {}).items():
+            await msr_protocol.update_connection_settings(values, server_id)
+
+async def fetch_msr_data():
+    """
+    Background task running one connection session per configured EtherLab server.
 
-            # Wait before retrying
-            await asyncio.sleep(backoff_time)
+    Each server (see ``msr_protocol.servers``) gets its own session with its
+    own connection state, calibration and WebSocket group; all sessions run
+    concurrently on this loop.
+    """
+    logger.info(f"Starting MSR data fetch for servers: {', '.join(msr_protocol.servers)}")
 
-        # Small delay to prevent tight loop in case of repeated immediate failures
-        await asyncio.sleep(1)
+    sessions = [
+        asyncio.ensure_future(fetch_server_data(server_id))
+        for server_id in msr_protocol.servers
+    ]
+    try:
+        await asyncio.gather(*sessions)
+    finally:
+        for session in sessions:
+            session.cancel()
+
+async def fetch_server_data(server_id):
+    """
+    Keep one EtherLab server connected and fetch its MSR data.
+
+    The server's ConnectionSupervisor handles reconnects, failover to standby
+    servers, subscription replay and the demo data fallback.
+
+    Args:
+        server_id: The server to connect to
+    """
+    logger.info(f"Starting MSR data fetch task for {server_id}")
+    try:
+        await ConnectionSupervisor(server_id).run()
+    except asyncio.CancelledError:
+        logger.info(f"MSR data fetch task for {server_id} cancelled")
+        raise
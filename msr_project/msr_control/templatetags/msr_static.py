@@ -0,0 +1,42 @@
+"""
+Template tags loading the client code of the MSR Control pages.
+"""
+from django import template
+from django.conf import settings
+from django.templatetags.static import static
+from django.utils.html import format_html, json_script
+
+register = template.Library()
+
+# Copy of Chart.js shipped with the app, so pages work without internet access
+CHART_JS_STATIC_PATH = 'msr_control/vendor/chart.umd.min.js'
+
+
+def chart_js_url():
+    """Return the URL of Chart.js: MSR_CHART_JS_URL if set, else the shipped copy."""
+    return getattr(settings, 'MSR_CHART_JS_URL', None) or static(CHART_JS_STATIC_PATH)
+
+
+@register.simple_tag
+def chart_js():
+    """Render the script element loading Chart.js."""
+    return format_html('<script src="{}" defer></script>', chart_js_url())
+
+
+@register.simple_tag
+def msr_script(path):
+    """Render a deferred script element for one of the app's static scripts."""
+    return format_html('<script src="{}" defer></script>', static(f'msr_control/js/{path}'))
+
+
+@register.simple_tag
+def msr_config(**values):
+    """
+    Render the page configuration read by dashboard.js.
+
+    Args:
+        **values: Configuration values, e.g. role and latency_ms
+    """
+    # The worker receiving the samples (stream_worker.js) is started by URL
+    values.setdefault('worker_url', static('msr_control/js/stream_worker.js'))
+    return json_script(values, 'msr-config')
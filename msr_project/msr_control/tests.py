@@ -1,3 +1,1380 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.utils.functional import SimpleLazyObject
+
+from . import (
+    autocal,
+    history,
+    instrumentation,
+    load_shedding,
+    metrics,
+    msr_protocol,
+    snapshot,
+    system_sampler,
+    ws_auth,
+)
+from .alignment import align_channels, resample
+from .channel_index import (
+    MAX_CLIENT_PATTERNS,
+    MAX_PATTERN_CHANNELS,
+    ChannelIndex,
+    channel_group_name,
+    decode_fields,
+    format_indices,
+    subscribe_channels,
+)
+from .channel_layer import UnixSocketChannelLayer
+from .consumers import MSRConsumer, get_command_settings, pack_samples
+from .framing import MessageFramer
+from .instrumentation import Histogram
+from .management.commands.bench_channel_layer import GROUP, _child_receiver
+from .metrics import counters
+from .middleware import (
+    RequestLoggingMiddleware,
+    SecurityHeadersMiddleware,
+    content_security_policy,
+)
+from .parameter_tree import (
+    MAX_PAGE_SIZE,
+    handle_parameter_update,
+    load_parameter_tree,
+    query_parameters,
+)
+from .parameters import ParameterClient, ParameterError
+from .ratelimit import (
+    TokenBucket,
+    check_rate_limit,
+    create_connection_bucket,
+    throttle_stats,
+)
+from .shm_ring import SharedFrameRing
+from .spectrum import _attach_shared_memory, get_spectrum, shutdown_spectrum_pool
+from .static_files import StaticFile, StaticFilesApp, compress_file
+from .supervisor import ConnectionSupervisor
+from .tasks import relay_shared_frames
+from .utils.logger import RateLimitedLogger
+
+
+class HistoryTestCase(SimpleTestCase):
+    """Runs each test with an empty sample history."""
+
+    def setUp(self):
+        self._saved_history = dict(history.channel_history)
+        history.channel_history.clear()
+
+    def tearDown(self):
+        history.channel_history.clear()
+        history.channel_history.update(self._saved_history)
+
+
+class AlignmentTests(HistoryTestCase):
+
+    def test_resample_zoh_holds_the_last_sample(self):
+        times = np.array([0.0, 1.0, 2.0])
+        values = np.array([10.0, 20.0, 30.0])
+        aligned = resample(times, values, np.array([-0.5, 0.0, 0.5, 1.9, 5.0]), 'zoh')
+        self.assertTrue(math.isnan(aligned[0]))
+        self.assertEqual(aligned[1:].tolist(), [10.0, 10.0, 20.0, 30.0])
+
+    def test_resample_linear_interpolates_inside_the_samples(self):
+        times = np.array([0.0, 1.0])
+        values = np.array([0.0, 10.0])
+        aligned = resample(times, values, np.array([0.25, 2.0]), 'linear')
+        self.assertEqual(aligned[0], 2.5)
+        self.assertTrue(math.isnan(aligned[1]))
+
+    def test_resample_rejects_unknown_method(self):
+        with self.assertRaises(ValueError):
+            resample(np.array([0.0]), np.array([0.0]), np.array([0.0]), 'cubic')
+
+    def test_align_channels_of_different_rates(self):
+        for i in range(101):
+            history.record_sample('fast', i * 0.01, float(i))
+        for i in range(11):
+            history.record_sample('slow', i * 0.1, float(-i))
+
+        aligned = align_channels(['fast', 'slow'])
+
+        self.assertAlmostEqual(aligned['period'], 0.01)
+        self.assertEqual(aligned['timestamps'][0], 0.0)
+        self.assertLessEqual(aligned['timestamps'][-1], 1.0)
+        self.assertEqual(aligned['channels']['fast'].size, aligned['channels']['slow'].size)
+        # Zero-order hold keeps the slow channel's value until its next sample
+        self.assertEqual(aligned['channels']['slow'][5], 0.0)
+        self.assertEqual(aligned['channels']['slow'][15], -1.0)
+
+    def test_align_channels_without_samples(self):
+        with self.assertRaises(ValueError):
+            align_channels(['missing'])
+
+
+class SpectrumCacheTests(HistoryTestCase):
+
+    def tearDown(self):
+        shutdown_spectrum_pool()
+        super().tearDown()
+
+    async def test_repeated_request_is_served_from_the_cache(self):
+        rate = 1000.0
+        for i in range(2048):
+            history.record_sample('vibration', i / rate, math.sin(2 * math.pi * 50.0 * i / rate))
+
+        first = await get_spectrum('vibration', window_length=256, averages=4)
+        second = await get_spectrum('vibration', window_length=256, averages=4)
+
+        self.assertFalse(first['cached'])
+        self.assertTrue(second['cached'])
+        self.assertEqual(first['end_sample'], second['end_sample'])
+        peak = first['frequencies'][int(np.argmax(first['amplitudes']))]
+        self.assertAlmostEqual(peak, 50.0, delta=rate / 256)
+
+    async def test_concurrent_requests_share_one_computation(self):
+        for i in range(1024):
+            history.record_sample('vibration', i * 0.001, float(i % 7))
+
+        results = await asyncio.gather(*(get_spectrum('vibration', window_length=128) for _ in range(3)))
+
+        self.assertEqual(sum(not result['cached'] for result in results), 1)
+
+    async def test_rejects_invalid_requests(self):
+        history.record_sample('vibration', 0.0, 0.0)
+        with self.assertRaises(ValueError):
+            await get_spectrum('vibration', window_function='triangle')
+        with self.assertRaises(ValueError):
+            await get_spectrum('vibration', window_length=4)
+        with self.assertRaises(ValueError):
+            await get_spectrum('vibration', window_length=128)
+
+    def test_worker_attach_does_not_register_the_block(self):
+        shm = shared_memory.SharedMemory(create=True, size=16)
+        self.addCleanup(shm.unlink)
+        self.addCleanup(shm.close)
+        with mock.patch('multiprocessing.resource_tracker.register') as register:
+            _attach_shared_memory(shm.name).close()
+        register.assert_not_called()
+
+
+class AutoCalibrationTests(SimpleTestCase):
+
+    def setUp(self):
+        self._saved_sessions = dict(autocal.autocal_sessions)
+        autocal.autocal_sessions.clear()
+
+    def tearDown(self):
+        autocal.autocal_sessions.clear()
+        autocal.autocal_sessions.update(self._saved_sessions)
+
+    def add_points(self, user, server_id, points):
+        session = autocal.get_session(user, server_id)
+        session['points'].extend({'reference': reference, 'raw_mean': raw} for raw, reference in points)
+
+    async def test_hold_window_averages_the_samples_during_the_capture(self):
+        autocal.start_session('cal', 'plant')
+        autocal.observe_raw_value(50.0, 'plant')  # before the window opens
+
+        capture = asyncio.ensure_future(autocal.capture_point('cal', 'plant', 10.0, duration=0.05))
+        await asyncio.sleep(0)
+        autocal.observe_raw_value(1.0, 'plant')
+        autocal.observe_raw_value(3.0, 'plant')
+        autocal.observe_raw_value(99.0, 'other')
+        point = await capture
+
+        self.assertEqual((point['raw_mean'], point['samples']), (2.0, 2))
+        self.assertAlmostEqual(point['raw_std'], math.sqrt(2))
+        self.assertEqual(autocal.session_summary('cal', 'plant')['points'], [point])
+
+    async def test_empty_hold_window_is_rejected(self):
+        autocal.start_session('cal', 'plant')
+        with self.assertRaises(ValueError):
+            await autocal.capture_point('cal', 'plant', 1.0, duration=0.01)
+        self.assertEqual(autocal.session_summary('cal', 'plant')['points'], [])
+
+    def test_linear_fit_as_gain_and_offset(self):
+        autocal.start_session('cal', 'plant')
+        # reference = (raw + 1) * 2
+        self.add_points('cal', 'plant', [(0.0, 2.0), (1.0, 4.0), (2.0, 6.0)])
+
+        report = autocal.fit_calibration('cal', 'plant')
+
+        self.assertAlmostEqual(report['settings']['gain'], 2.0)
+        self.assertAlmostEqual(report['settings']['offset'], 1.0)
+        self.assertIsNone(report['settings']['polynomial'])
+        self.assertLess(report['max'], 1e-9)
+
+    def test_polynomial_fit(self):
+        autocal.start_session('cal', 'plant', degree=2)
+        self.add_points('cal', 'plant', [(raw, raw * raw) for raw in (-1.0, 0.0, 1.0, 2.0)])
+
+        coefficients = autocal.fit_calibration('cal', 'plant')['settings']['polynomial']
+
+        np.testing.assert_allclose(coefficients, [1.0, 0.0, 0.0], atol=1e-9)
+
+    def test_fit_needs_enough_distinct_points(self):
+        autocal.start_session('cal', 'plant')
+        self.add_points('cal', 'plant', [(1.0, 2.0)])
+        with self.assertRaises(ValueError):
+            autocal.fit_calibration('cal', 'plant')
+
+        self.add_points('cal', 'plant', [(1.0, 3.0)])
+        with self.assertRaises(ValueError):
+            autocal.fit_calibration('cal', 'plant')
+
+    def test_one_session_per_server(self):
+        autocal.start_session('cal', 'plant')
+        with self.assertRaises(ValueError):
+            autocal.start_session('other', 'plant')
+        autocal.start_session('other', 'plant2')
+        self.assertEqual(autocal.session_summary('other', 'plant')['held_by'], 'cal')
+
+
+class SharedFrameRingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.runtime_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(MSR_RUNTIME_DIR=self.runtime_dir)
+        self.settings_override.enable()
+        self.writer = SharedFrameRing.create(f'msr_test_{uuid.uuid4().hex[:12]}', 4, 64)
+        # A second mapping of the block, as a worker process would have
+        self.reader = SharedFrameRing(shared_memory.SharedMemory(name=self.writer._shm.name), owner=False)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        self.settings_override.disable()
+        shutil.rmtree(self.runtime_dir)
+
+    def test_reader_receives_published_frames(self):
+        self.writer.publish(b'one')
+        self.writer.publish(b'two')
+        self.assertEqual(self.reader.read_new(), [b'one', b'two'])
+        self.assertEqual(self.reader.read_new(), [])
+
+    def test_reader_lapped_by_the_writer_skips_ahead(self):
+        for i in range(7):
+            self.writer.publish(b'frame %d' % i)
+        self.assertEqual(self.reader.read_new(), [b'frame 3', b'frame 4', b'frame 5', b'frame 6'])
+        self.assertEqual(self.reader.dropped, 3)
+
+    def test_slot_being_written_is_not_read(self):
+        self.writer.publish(b'intact')
+        self.writer.publish(b'torn')
+        # The writer invalidates a slot before overwriting its payload
+        offset = self.writer._slot_offset(2)
+        struct.pack_into('<Q', self.writer._buf, offset, 0)
+
+        self.assertEqual(self.reader.read_new(), [b'intact'])
+        self.assertEqual(self.reader.dropped, 1)
+
+    def test_oversized_frame_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.writer.publish(b'x' * 65)
+
+    def test_control_block_merges_settings(self):
+        self.reader.update_control('calibration', 'default', {'gain': 2.0})
+        self.reader.update_control('calibration', 'default', {'offset': 1.0})
+        version, control = self.writer.read_control()
+        self.assertEqual(version, 4)
+        self.assertEqual(control, {'calibration': {'default': {'gain': 2.0, 'offset': 1.0}}})
+        self.assertTrue(os.path.exists(os.path.join(self.runtime_dir, f'{self.writer._shm.name.lstrip("/")}.lock')))
+
+    async def test_relay_skips_malformed_frames(self):
+        relayed = []
+
+        async def send_data_to_websocket(data, local_only=False):
+            relayed.append(data)
+
+        errors = counters['relay_errors']
+        with mock.patch('msr_control.tasks.SharedFrameRing.attach', return_value=self.reader), \
+                mock.patch('msr_control.tasks.send_data_to_websocket', send_data_to_websocket):
+            relay = asyncio.ensure_future(relay_shared_frames())
+            await asyncio.sleep(0)
+            self.writer.publish(b'not json')
+            self.writer.publish(b'[1]')
+            self.writer.publish(b'{"server": "missing", "channel": "x", "timestamp": 1.0}')
+            await asyncio.sleep(0.1)
+            relay.cancel()
+            await asyncio.gather(relay, return_exceptions=True)
+
+        self.assertEqual(counters['relay_errors'] - errors, 2)
+        self.assertEqual([data['channel'] for data in relayed], ['x'])
+
+
+class UnixSocketChannelLayerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.socket_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.socket_dir)
+
+    def test_every_message_reaches_a_process_that_falls_behind(self):
+        messages = 2000
+        context = multiprocessing.get_context('spawn')
+        ready = context.Event()
+        results = context.Queue()
+        child = context.Process(target=_child_receiver, args=(self.socket_dir, messages, 1, ready, results))
+        child.start()
+        self.addCleanup(child.join, 10)
+        self.assertTrue(ready.wait(30))
+
+        async def run():
+            layer = UnixSocketChannelLayer(socket_dir=self.socket_dir, peer_refresh_interval=0)
+            # Sent without yielding: far more datagrams than the peer's socket queues
+            for _ in range(messages):
+                await layer.group_send(GROUP, {'type': 'bench', 'sent': 0.0, 'payload': 'x' * 4096})
+            loop = asyncio.get_running_loop()
+            latencies = await loop.run_in_executor(None, results.get, True, 30)
+            stats = dict(layer.stats)
+            await layer.close()
+            return len(latencies), stats
+
+        received, stats = asyncio.run(run())
+        self.assertEqual(received, messages)
+        self.assertEqual(stats['dropped'], 0)
+        self.assertGreater(stats['datagrams_backlogged'], 0)
+
+
+class SessionCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self._saved_cache = dict(ws_auth.session_cache)
+        ws_auth.session_cache.clear()
+        self.user = User(pk=7, username='operator7')
+        self.get_user = mock.AsyncMock(return_value=self.user)
+        self.load_role = mock.AsyncMock(return_value='calibrator')
+        patches = [
+            mock.patch('msr_control.ws_auth.get_user', self.get_user),
+            mock.patch('msr_control.ws_auth._load_role', self.load_role),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        ws_auth.session_cache.clear()
+        ws_auth.session_cache.update(self._saved_cache)
+
+    @staticmethod
+    def scope(session_key):
+        return {'session': SimpleNamespace(session_key=session_key)}
+
+    async def test_cached_session_needs_no_lookup(self):
+        first = await ws_auth.resolve_session(self.scope('a'))
+        second = await ws_auth.resolve_session(self.scope('a'))
+
+        self.assertEqual((second['username'], second['role']), ('operator7', 'calibrator'))
+        self.assertIs(first, second)
+        self.assertEqual(self.get_user.await_count, 1)
+
+    async def test_concurrent_connects_share_one_lookup(self):
+        entries = await asyncio.gather(*(ws_auth.resolve_session(self.scope('a')) for _ in range(5)))
+
+        self.assertEqual({entry['role'] for entry in entries}, {'calibrator'})
+        self.assertEqual(self.get_user.await_count, 1)
+
+    async def test_invalidation_during_a_lookup_is_not_cached(self):
+        async def get_user(scope):
+            ws_auth.invalidate_user(self.user.pk)
+            return self.user
+
+        self.get_user.side_effect = get_user
+        entry = await ws_auth.resolve_session(self.scope('a'))
+
+        self.assertEqual(entry['role'], 'calibrator')
+        self.assertIsNone(ws_auth.get_cached_session('a'))
+
+    def test_invalidation_by_user_and_by_session(self):
+        ws_auth.cache_session('a', self.user, 'operator')
+        ws_auth.cache_session('b', self.user, 'operator')
+        ws_auth.cache_session('c', User(pk=8, username='other'), 'admin')
+
+        ws_auth.invalidate_session('a')
+        self.assertEqual(sorted(ws_auth.session_cache), ['b', 'c'])
+        ws_auth.invalidate_user(self.user.pk)
+        self.assertEqual(sorted(ws_auth.session_cache), ['c'])
+
+    @override_settings(MSR_WS_AUTH_CACHE={'ttl': -1})
+    def test_expired_entry_is_dropped(self):
+        ws_auth.cache_session('a', self.user, 'operator')
+        self.assertIsNone(ws_auth.get_cached_session('a'))
+        self.assertNotIn('a', ws_auth.session_cache)
+
+
+class CommandDispatchTests(SimpleTestCase):
+
+    def setUp(self):
+        patch = mock.patch('msr_control.consumers.check_rate_limit', return_value=None)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def consumer(self, role='operator'):
+        consumer = MSRConsumer()
+        consumer.user = User(pk=7, username='operator7')
+        consumer.user_role = role
+        consumer.rate_bucket = None
+        consumer.throttled = False
+        consumer.command_tasks = set()
+        consumer.command_slots = asyncio.Semaphore(get_command_settings()['max_concurrent'])
+        consumer.sent = []
+        consumer.send = mock.AsyncMock(side_effect=lambda text_data: consumer.sent.append(json.loads(text_data)))
+        return consumer
+
+    async def test_response_echoes_the_request_id(self):
+        consumer = self.consumer()
+
+        async def handler():
+            await asyncio.sleep(0)
+            await consumer.send_response({'type': 'status'})
+
+        consumer.handle_status_request = handler
+        await consumer.receive(json.dumps({'action': 'get_status', 'request_id': 'r1'}))
+        await consumer.receive(json.dumps({'action': 'get_status', 'request_id': 'r2'}))
+        await asyncio.gather(*consumer.command_tasks)
+
+        self.assertEqual(sorted(message['request_id'] for message in consumer.sent), ['r1', 'r2'])
+
+    async def test_unknown_and_forbidden_actions_are_rejected(self):
+        consumer = self.consumer()
+        await consumer.receive(json.dumps({'action': 'reboot', 'request_id': 1}))
+        await consumer.receive(json.dumps({'action': 'calibrate', 'request_id': 2}))
+
+        self.assertEqual([message['request_id'] for message in consumer.sent], [1, 2])
+        self.assertEqual(consumer.sent[0]['error'], 'Unknown action: reboot')
+        self.assertTrue(consumer.sent[1]['error'].startswith('Permission denied.'))
+        self.assertFalse(consumer.command_tasks)
+
+    @override_settings(MSR_WS_COMMANDS={'max_concurrent': 2, 'max_pending': 3})
+    async def test_commands_wait_for_a_slot_and_excess_is_rejected(self):
+        consumer = self.consumer()
+        release = asyncio.Event()
+        running = []
+        peak = []
+
+        async def handler(parameters):
+            running.append(parameters['n'])
+            peak.append(len(running))
+            await release.wait()
+            running.remove(parameters['n'])
+
+        consumer.handle_latency_budget = handler
+        for n in range(4):
+            await consumer.receive(json.dumps({'action': 'set_latency_budget', 'parameters': {'n': n}}))
+        await asyncio.sleep(0)
+
+        self.assertEqual(len(consumer.command_tasks), 3)
+        self.assertEqual(consumer.sent, [{'type': 'error', 'error': 'Too many commands in progress'}])
+        self.assertEqual(running, [0, 1])
+
+        release.set()
+        await asyncio.gather(*consumer.command_tasks)
+        self.assertEqual(max(peak), 2)
+        self.assertFalse(consumer.command_tasks)
+
+
+class TokenBucketTests(SimpleTestCase):
+
+    @mock.patch('msr_control.ratelimit.time.monotonic')
+    def test_burst_then_refill(self, monotonic):
+        monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=2, burst=3)
+
+        self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+        monotonic.return_value = 100.5
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+        # Refilling never exceeds the burst
+        monotonic.return_value = 200.0
+        self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+    @override_settings(MSR_WS_RATE_LIMITS={'role': {'operator': {'rate': 0, 'burst': 2}}})
+    @mock.patch.dict('msr_control.ratelimit.role_buckets', clear=True)
+    def test_role_bucket_is_shared_by_connections(self):
+        rejected = throttle_stats['by_limit']['role']
+        first = create_connection_bucket('operator')
+        second = create_connection_bucket('operator')
+
+        self.assertIsNone(check_rate_limit(first, 'operator'))
+        self.assertIsNone(check_rate_limit(second, 'operator'))
+        self.assertEqual(check_rate_limit(first, 'operator'), 'role')
+        self.assertEqual(throttle_stats['by_limit']['role'], rejected + 1)
+
+
+class SampleBatchingTests(SimpleTestCase):
+
+    def consumer(self, latency_ms):
+        consumer = MSRConsumer()
+        consumer.user_role = 'calibrator'
+        consumer.channel_paths = set()
+        consumer.sample_interval = 0
+        consumer.last_sample_time = {}
+        consumer.last_sent_at = {}
+        consumer.pending_samples = []
+        consumer.flush_task = None
+        consumer.binary_samples = False
+        consumer.set_latency_budget(latency_ms)
+        consumer.sent = []
+        consumer.send = mock.AsyncMock(side_effect=lambda text_data: consumer.sent.append(json.loads(text_data)))
+        return consumer
+
+    def test_pack_samples_as_columns(self):
+        message = pack_samples([
+            {'timestamp': 1.0, 'raw_value': 1, 'connection_state': {'connected': False}},
+            {'timestamp': 2.0, 'raw_value': 2, 'filtered_value': 2.5},
+            {'timestamp': 3.0, 'connection_state': {'connected': True}},
+        ])
+
+        self.assertEqual(message['count'], 3)
+        self.assertEqual(message['timestamps'], [1.0, 2.0, 3.0])
+        self.assertEqual(message['columns'], {'raw_value': [1, 2, None], 'filtered_value': [None, 2.5, None]})
+        self.assertEqual(message['latest'], {'connection_state': {'connected': True}})
+
+    @override_settings(MSR_WS_BATCHING={'max_latency_ms': 100})
+    def test_latency_budget_is_clamped(self):
+        consumer = self.consumer(0)
+
+        self.assertEqual(consumer.set_latency_budget(500), 100)
+        self.assertEqual(consumer.set_latency_budget(-5), 0)
+        self.assertEqual(consumer.set_latency_budget('x'), 0)
+
+    async def test_samples_within_the_budget_are_sent_together(self):
+        consumer = self.consumer(20)
+        for n in range(5):
+            await consumer.send_data({'data': {'timestamp': float(n), 'raw_value': n}})
+
+        self.assertEqual(consumer.sent, [])
+        await consumer.flush_task
+
+        self.assertEqual(len(consumer.sent), 1)
+        self.assertEqual(consumer.sent[0]['columns']['raw_value'], [0, 1, 2, 3, 4])
+
+    @override_settings(MSR_WS_BATCHING={'max_batch': 3})
+    async def test_full_batch_is_sent_early(self):
+        consumer = self.consumer(1000)
+        for n in range(4):
+            await consumer.send_data({'data': {'timestamp': float(n), 'raw_value': n}})
+
+        self.assertEqual([message['count'] for message in consumer.sent], [3])
+        consumer.flush_task.cancel()
+
+
+class ServerRoutingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.layer = SimpleNamespace(group_send=mock.AsyncMock())
+        patches = [
+            mock.patch.dict('msr_control.msr_protocol.servers', clear=True),
+            mock.patch('msr_control.msr_protocol.get_channel_layer', return_value=self.layer),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.line1 = msr_protocol.register_server('line1', {'host': 'plc1'})
+        self.line2 = msr_protocol.register_server('line2', {'host': 'plc2'})
+
+    def test_servers_have_isolated_state(self):
+        self.line1['calibration_settings']['gain'] = 3.0
+        self.line1['connection_state']['connected'] = True
+
+        self.assertNotEqual(self.line2['calibration_settings']['gain'], 3.0)
+        self.assertFalse(self.line2['connection_state']['connected'])
+        self.assertEqual(self.line2['connection_settings']['host'], 'plc2')
+        self.assertNotEqual(self.line1['group'], self.line2['group'])
+
+    def test_invalid_server_identifier_is_rejected(self):
+        with self.assertRaises(ValueError):
+            msr_protocol.register_server('line 3/a')
+
+    async def test_samples_go_to_their_servers_group(self):
+        await msr_protocol.send_data_to_websocket({'server': 'line2', 'raw_value': 1.0})
+        await msr_protocol.send_data_to_websocket({'server': 'line2', 'channel': '/a/b', 'channel_index': 4})
+        await msr_protocol.send_data_to_websocket({'server': 'line9', 'raw_value': 1.0})
+
+        groups = [call.args[0] for call in self.layer.group_send.await_args_list]
+        self.assertEqual(groups, [self.line2['group'], channel_group_name(self.line2['group'], '/a/b')])
+        self.assertNotEqual(groups[1], channel_group_name(self.line1['group'], '/a/b'))
+
+
+class ConnectionSupervisorTests(SimpleTestCase):
+
+    def setUp(self):
+        patch = mock.patch.dict('msr_control.msr_protocol.servers', clear=True)
+        patch.start()
+        self.addCleanup(patch.stop)
+        msr_protocol.register_server('line1', {
+            'host': 'primary',
+            'port': 1,
+            'standby': [{'host': 'standby', 'port': 2}],
+            'retry_attempts': 2,
+            'reconnect_delay': 0,
+        })
+        self.attempts = []
+        self.demo_running = asyncio.Event()
+
+    async def demo(self, server_id):
+        self.demo_running.set()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.demo_running.clear()
+
+    async def run_supervisor(self, connect, until):
+        supervisor = ConnectionSupervisor('line1')
+        with mock.patch('msr_control.supervisor.connect_to_etherlab', connect), \
+                mock.patch('msr_control.supervisor.generate_demo_data', self.demo):
+            task = asyncio.get_running_loop().create_task(supervisor.run())
+            try:
+                await asyncio.wait_for(until(supervisor), 5)
+            finally:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        return supervisor
+
+    @mock.patch('msr_control.supervisor.random.uniform', side_effect=lambda low, high: high)
+    def test_backoff_doubles_up_to_the_maximum(self, uniform):
+        supervisor = ConnectionSupervisor('line1')
+        supervisor.server['connection_settings'].update(reconnect_delay=5, max_reconnect_delay=60)
+
+        delays = []
+        for rounds in range(1, 6):
+            supervisor.failed_rounds = rounds
+            delays.append(supervisor.backoff_delay())
+        self.assertEqual(delays, [5, 10, 20, 40, 60])
+
+    async def test_fails_over_then_falls_back_to_demo_data_until_connected(self):
+        connected = asyncio.Event()
+
+        async def connect(server_id, host, port, on_connected):
+            self.attempts.append(host)
+            if len(self.attempts) <= 4:
+                raise ConnectionRefusedError
+            on_connected()
+            connected.set()
+            await asyncio.Event().wait()
+
+        async def until(supervisor):
+            await self.demo_running.wait()
+            await connected.wait()
+            await asyncio.sleep(0)
+
+        supervisor = await self.run_supervisor(connect, until)
+
+        self.assertEqual(self.attempts, ['primary', 'standby', 'primary', 'standby', 'primary'])
+        self.assertFalse(self.demo_running.is_set())
+        self.assertEqual(supervisor.failed_rounds, 0)
+        self.assertEqual(supervisor.server['connection_state']['state'], 'stopped')
+        self.assertIsNone(supervisor.server['supervisor'])
+
+    async def test_requested_reconnect_starts_over_at_the_primary(self):
+        async def connect(server_id, host, port, on_connected):
+            self.attempts.append(host)
+            if host == 'primary' and len(self.attempts) == 1:
+                raise ConnectionRefusedError
+            on_connected()
+            await asyncio.Event().wait()
+
+        async def until(supervisor):
+            while self.attempts != ['primary', 'standby']:
+                await asyncio.sleep(0)
+            supervisor.request_reconnect()
+            while len(self.attempts) < 3:
+                await asyncio.sleep(0)
+
+        await self.run_supervisor(connect, until)
+
+        self.assertEqual(self.attempts, ['primary', 'standby', 'primary'])
+
+
+class MessageFramerTests(SimpleTestCase):
+
+    def test_elements_split_across_chunks(self):
+        framer = MessageFramer()
+        self.assertEqual(framer.feed(b'<ack id="1"/><data time="1"><F c="0" d="A'), [b'<ack id="1"/>'])
+        self.assertEqual(framer.feed(b'A=="/></da'), [])
+        self.assertEqual(framer.feed(b'ta>\n<pu index="3"/>'),
+                         [b'<data time="1"><F c="0" d="AA=="/></data>', b'<pu index="3"/>'])
+        self.assertEqual(framer.buffer, bytearray())
+
+    def test_large_reply_fed_byte_by_byte(self):
+        reply = b'<parameters>' + b''.join(
+            b'<parameter index="%d" path="/p/%d"/>' % (i, i) for i in range(500)
+        ) + b'</parameters>'
+        framer = MessageFramer()
+        messages = []
+        for i in range(len(reply)):
+            messages += framer.feed(reply[i:i + 1])
+        self.assertEqual(messages, [reply])
+
+    def test_comments_are_skipped_and_raw_data_is_kept(self):
+        framer = MessageFramer()
+        messages = framer.feed(b'<?xml version="1.0"?><!-- hello -->raw bytes <ack/>')
+        self.assertEqual(messages, [b'raw bytes', b'<ack/>'])
+
+    def test_runaway_element_is_dropped(self):
+        framer = MessageFramer(max_buffer=64)
+        self.assertEqual(framer.feed(b'<data>' + b'x' * 100), [])
+        self.assertEqual(framer.feed(b'<ack/>'), [b'<ack/>'])
+
+
+class ParameterClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.messages = []
+        self.reply_tag = 'ack'
+        self.client = ParameterClient('line1', self.send, timeout=1)
+
+    async def send(self, message):
+        # Answer every command of the message like the server would
+        self.messages.append(message.decode())
+        loop = asyncio.get_running_loop()
+        for request_id in re.findall(r'id="(p\d+)"', message.decode()):
+            loop.call_soon(self.client.handle_reply, self.reply_tag, {'id': request_id, 'text': 'read only'})
+        return True
+
+    async def test_writes_are_sent_together_and_coalesced(self):
+        results = await asyncio.gather(
+            self.client.write('/gain', 1.0),
+            self.client.write('/offset', 2),
+            self.client.write('/gain', 3.0),
+        )
+
+        self.assertEqual(self.messages, ['<wp path="/gain" value="3.0" id="p1"/><wp path="/offset" value="2" id="p2"/>\n'])
+        self.assertEqual([result['value'] for result in results], ['3.0', '2', '3.0'])
+        self.assertEqual(self.client.stats['coalesced'], 1)
+        self.assertGreaterEqual(min(result['latency'] for result in results), 0)
+
+    async def test_rejected_write_raises(self):
+        self.reply_tag = 'error'
+        with self.assertRaisesRegex(ParameterError, 'read only'):
+            await self.client.write('/gain', 1.0)
+        self.assertEqual(self.client.stats['errors'], 1)
+
+    async def test_write_without_connection_or_reply_raises(self):
+        self.client.send = mock.AsyncMock(return_value=False)
+        with self.assertRaisesRegex(ParameterError, 'not connected'):
+            await self.client.write('/gain', 1.0)
+
+        self.client.send = mock.AsyncMock(return_value=True)
+        self.client.timeout = 0.01
+        with self.assertRaisesRegex(ParameterError, 'No reply'):
+            await self.client.write('/gain', 1.0)
+        self.assertEqual(self.client.stats['timeouts'], 1)
+        self.assertFalse(self.client._pending)
+
+
+class ParameterTreeTests(SimpleTestCase):
+
+    def setUp(self):
+        patch = mock.patch.dict('msr_control.msr_protocol.servers', clear=True)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.server = msr_protocol.register_server('line1')
+        self.tree = self.server['parameter_tree']
+        self.tree.load([
+            {'path': '/a/b', 'index': '1'},
+            {'path': '/a/b/c', 'index': '2'},
+            {'path': '/a/bc', 'index': '3'},
+            {'path': '/z', 'index': '4'},
+        ])
+
+    def test_page_below_a_prefix(self):
+        page = self.tree.page('/a/b', offset=0, limit=10)
+        self.assertEqual(page['total'], 2)
+        self.assertEqual([entry['path'] for entry in page['parameters']], ['/a/b', '/a/b/c'])
+
+        page = self.tree.page('/', offset=1, limit=2)
+        self.assertEqual(page['total'], 4)
+        self.assertEqual([entry['path'] for entry in page['parameters']], ['/a/b/c', '/a/bc'])
+
+    def test_browse_and_update(self):
+        self.tree.update({'path': '/a/a', 'index': '5'})
+        self.tree.update({'path': '/a/b', 'value': '2.0'})
+
+        children = self.tree.children('/a')
+        self.assertEqual([(child['name'], child['children']) for child in children], [('a', 0), ('b', 1), ('bc', 0)])
+        self.assertEqual(self.tree.get('/a/b'), {'path': '/a/b', 'index': '1', 'value': '2.0'})
+        self.assertEqual(self.tree.page('/a', limit=1)['parameters'], [{'path': '/a/a', 'index': '5'}])
+
+    def test_query_caps_the_page_size(self):
+        result = query_parameters('line1', limit=MAX_PAGE_SIZE + 1, offset=-3)
+        self.assertEqual((result['total'], result['offset']), (4, 0))
+
+        with self.assertRaises(ValueError):
+            query_parameters('line1', limit='many')
+
+    @mock.patch('msr_control.parameter_tree.refresh_parameter', new_callable=mock.AsyncMock)
+    async def test_changes_during_the_load_are_read_again(self, refresh_parameter):
+        async def list_parameters():
+            handle_parameter_update('line1', {'index': '2'})
+            handle_parameter_update('line1', {'index': '9'})
+            return [{'path': '/a', 'index': '1'}, {'path': '/b', 'index': '2'}]
+
+        self.server['socket'] = object()
+        client = SimpleNamespace(list_parameters=list_parameters)
+        with mock.patch('msr_control.msr_protocol.get_parameter_client', return_value=client):
+            await load_parameter_tree('line1')
+        await asyncio.sleep(0)
+
+        self.assertEqual(sorted(self.tree.parameters), ['/a', '/b'])
+        self.assertEqual(self.tree.pending_updates, set())
+        refresh_parameter.assert_awaited_once_with('line1', '/b')
+
+
+class ChannelIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.index = ChannelIndex()
+        self.index.load([
+            {'path': '/Line1/Motor/A/Current', 'index': '0', 'typ': 'TDBL'},
+            {'path': '/Line1/Motor/B/Current', 'index': '1', 'typ': 'TINT'},
+            {'path': '/Line1/Motor/B/Speed', 'index': '2', 'typ': 'TDBL'},
+            {'path': '/Line2/Pump/Pressure', 'index': '10', 'typ': 'TFLT'},
+            {'path': '/Taskinfo/0/ExecTime', 'index': 'x', 'typ': 'TDBL'},
+        ])
+
+    def test_exact_path(self):
+        self.assertEqual(self.index.match('/Line1/Motor/B/Speed'), ['/Line1/Motor/B/Speed'])
+        self.assertEqual(self.index.match('/Line1/Motor'), [])
+
+    def test_single_segment_wildcards(self):
+        self.assertEqual(sorted(self.index.match('/Line1/Motor/*/Current')),
+                         ['/Line1/Motor/A/Current', '/Line1/Motor/B/Current'])
+        self.assertEqual(self.index.match('/Line*/Pump/*'), ['/Line2/Pump/Pressure'])
+
+    def test_any_depth(self):
+        self.assertEqual(sorted(self.index.match('/**/Current')),
+                         ['/Line1/Motor/A/Current', '/Line1/Motor/B/Current'])
+        self.assertEqual(len(self.index.match('/Line1/')), 3)
+        self.assertEqual(len(self.index.match('/', limit=2)), 2)
+
+    def test_expand_and_format_indices(self):
+        indices = self.index.expand(['/Line2/', '/Line1/Motor/*/Current', '/Taskinfo/**'])
+        self.assertEqual(format_indices(indices), '0,1,10,x')
+
+    def test_relative_pattern_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.index.match('Line1/*')
+
+    def test_decode_fields_by_channel_type(self):
+        doubles = base64.b64encode(struct.pack('<2d', 1.5, 2.5)).decode()
+        integer = base64.b64encode(struct.pack('<i', -7)).decode()
+        message = (
+            f'<data time="3.0"><F c="0" d="{doubles}"/><F c="1" d="{integer}"/>'
+            f'<F c="99" d="{integer}"/></data>'
+        ).encode()
+        self.assertEqual(decode_fields(self.index, message), [
+            ('/Line1/Motor/A/Current', '0', 2.5),
+            ('/Line1/Motor/B/Current', '1', -7.0),
+        ])
+
+
+class ChannelSubscriptionTests(SimpleTestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.dict('msr_control.msr_protocol.servers', clear=True),
+            mock.patch('msr_control.channel_index.sync_channel_subscriptions', new_callable=mock.AsyncMock),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.server = msr_protocol.register_server('line1')
+        self.server['channel_index'].load(
+            [{'path': f'/Bank/{i}/Value', 'index': str(i), 'typ': 'TDBL'} for i in range(MAX_PATTERN_CHANNELS + 10)]
+        )
+
+    async def test_patterns_without_a_segment_or_too_many_matches_are_rejected(self):
+        for pattern in ('/**', '/*/*', '/Bank/*/Value'):
+            with self.subTest(pattern=pattern), self.assertRaises(ValueError):
+                await subscribe_channels('line1', 'client', [pattern])
+
+        matches = await subscribe_channels('line1', 'client', ['/Bank/1*/Value'])
+        self.assertEqual(len(matches['/Bank/1*/Value']), 111)
+        self.assertEqual(list(self.server['channel_patterns']), ['/Bank/1*/Value'])
+
+    async def test_patterns_per_client_are_limited(self):
+        patterns = [f'/Bank/{i}/Value' for i in range(MAX_CLIENT_PATTERNS + 1)]
+        await subscribe_channels('line1', 'client', patterns[:-1])
+
+        with self.assertRaises(ValueError):
+            await subscribe_channels('line1', 'client', patterns[-1:])
+        await subscribe_channels('line1', 'other', patterns[-1:])
+        # Subscribing to a pattern again does not count twice
+        await subscribe_channels('line1', 'client', patterns[:1])
+
+
+class HistogramTests(SimpleTestCase):
+
+    def test_percentiles_and_maximum(self):
+        histogram = Histogram()
+        for _ in range(99):
+            histogram.record(0.001)
+        histogram.record(0.5)
+
+        summary, _ = histogram.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['p50'], 1.0, delta=0.4)
+        self.assertEqual(summary['p99'], summary['p50'])
+        self.assertEqual(summary['max'], 500.0)
+        self.assertAlmostEqual(summary['mean'], 5.99, places=2)
+        self.assertIsNone(Histogram().summary()[0]['p95'])
+
+    @mock.patch('msr_control.instrumentation.time.monotonic')
+    def test_rate_is_kept_per_reader(self, monotonic):
+        monotonic.return_value = 100.0
+        histogram = Histogram()
+        for _ in range(10):
+            histogram.record(0.001)
+
+        monotonic.return_value = 105.0
+        first, first_mark = histogram.summary()
+        for _ in range(10):
+            histogram.record(0.001)
+
+        monotonic.return_value = 110.0
+        second, _ = histogram.summary(first_mark)
+        other, _ = histogram.summary()
+        self.assertEqual((first['rate'], second['rate'], other['rate']), (2.0, 2.0, 2.0))
+
+        # A mark from before a reset is ignored
+        histogram.reset()
+        histogram.record(0.001)
+        monotonic.return_value = 111.0
+        self.assertEqual(histogram.summary(first_mark)[0]['rate'], 1.0)
+
+    @mock.patch('msr_control.instrumentation.enabled', True)
+    def test_latency_summary_updates_the_readers_marks(self):
+        saved = instrumentation.histograms
+        instrumentation.histograms = {stage: Histogram() for stage in instrumentation.STAGES}
+        self.addCleanup(setattr, instrumentation, 'histograms', saved)
+
+        instrumentation.record_duration('send', 0.002)
+        marks = {}
+        summary = instrumentation.latency_summary(marks)
+
+        self.assertEqual(set(marks), set(instrumentation.STAGES))
+        self.assertEqual(marks['send'][0], 1)
+        self.assertEqual(summary['stages']['send']['count'], 1)
+
+
+class MetricsTests(SimpleTestCase):
+
+    def setUp(self):
+        queue = asyncio.Queue()
+        for n in range(3):
+            queue.put_nowait(n)
+        self.layer = SimpleNamespace(
+            channels={'c1': queue, 'c2': asyncio.Queue()},
+            channel_drops={'c1': 2, 'c3': 5},
+            stats={'dropped': 7},
+        )
+        patches = [
+            mock.patch.dict('msr_control.metrics.consumers', clear=True),
+            mock.patch.dict('msr_control.metrics.departed_drops', clear=True),
+            mock.patch.dict('msr_control.msr_protocol.servers', clear=True),
+            mock.patch('msr_control.metrics.get_channel_layer', return_value=self.layer),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        msr_protocol.register_server('line1')
+        for name in ('c1', 'c2', 'c3'):
+            metrics.register_consumer(name, 'operator', 'line1')
+
+    def series(self):
+        return {
+            line.rsplit(' ', 1)[0]: line.rsplit(' ', 1)[1]
+            for line in metrics.render_metrics().splitlines() if not line.startswith('#')
+        }
+
+    def test_consumer_series_are_per_role_and_server(self):
+        series = self.series()
+        labels = '{role="operator",server="line1"}'
+
+        self.assertEqual(series['msr_consumers' + labels], '3')
+        self.assertEqual(series['msr_consumer_queue_depth_max' + labels], '3')
+        self.assertEqual(series['msr_consumer_queue_depth_sum' + labels], '3')
+        self.assertEqual(series['msr_consumer_dropped_total' + labels], '7')
+        self.assertEqual(series['msr_channel_layer_dropped_total'], '7')
+        self.assertEqual(series['msr_connected{server="line1"}'], '0')
+        self.assertFalse([name for name in series if 'c1' in name])
+
+    def test_drops_of_departed_consumers_are_kept(self):
+        metrics.unregister_consumer('c3')
+
+        series = self.series()
+        self.assertEqual(series['msr_consumers{role="operator",server="line1"}'], '2')
+        self.assertEqual(series['msr_consumer_dropped_total{role="operator",server="line1"}'], '7')
+        self.assertNotIn('c3', self.layer.channel_drops)
+
+
+class SystemSamplerTests(SimpleTestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.dict('msr_control.system_sampler._previous'),
+            mock.patch('msr_control.system_sampler.snapshot', system_sampler.snapshot),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_read_proc_files(self):
+        stat = '42 (msr worker (1)) S ' + ' '.join(['0'] * 10) + ' 250 150 ' + ' '.join(['0'] * 4) + ' 6 0 0 0 1000'
+        meminfo = 'MemTotal:       1000 kB\nMemFree:         100 kB\nMemAvailable:    250 kB\n'
+        files = {'/proc/self/stat': stat, '/proc/meminfo': meminfo, '/proc/stat': 'cpu  10 0 10 70 10 0 0\ncpu0 1\n'}
+
+        with mock.patch('msr_control.system_sampler._read_file', files.get):
+            self.assertEqual(
+                system_sampler.read_process(),
+                (400 / system_sampler.CLOCK_TICKS, 1000 * system_sampler.PAGE_SIZE, 6)
+            )
+            self.assertEqual(system_sampler.read_host_memory_usage(), 75.0)
+            self.assertEqual(system_sampler.read_host_cpu(), (20, 100))
+
+        with mock.patch('msr_control.system_sampler._read_file', return_value=None):
+            self.assertEqual(system_sampler.read_process()[1:], (None, None))
+            self.assertIsNone(system_sampler.read_host_memory_usage())
+
+    @mock.patch('msr_control.system_sampler.time.monotonic')
+    @mock.patch('msr_control.system_sampler.read_host_cpu')
+    @mock.patch('msr_control.system_sampler.read_process')
+    def test_sample_rates_and_a_new_snapshot(self, read_process, read_host_cpu, monotonic):
+        system_sampler._previous.update(time=None, cpu_seconds=None, host_busy=None, host_total=None)
+        loop = SimpleNamespace()
+        read_process.return_value = (10.0, 1 << 20, 4)
+        read_host_cpu.return_value = (100, 1000)
+        monotonic.return_value = 50.0
+        first = system_sampler.take_sample(loop)
+
+        read_process.return_value = (10.5, 1 << 20, 4)
+        read_host_cpu.return_value = (150, 1100)
+        monotonic.return_value = 52.0
+        second = system_sampler.take_sample(loop)
+
+        self.assertIsNone(first['cpu_usage'])
+        self.assertEqual((second['cpu_usage'], second['host_cpu_usage']), (25.0, 50.0))
+        self.assertIsNot(first, second)
+        self.assertIs(system_sampler.snapshot, second)
+        self.assertNotIn('default', second['thread_pools'])
+
+    def test_thread_pool_saturation(self):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            release = threading.Event()
+            for _ in range(3):
+                executor.submit(release.wait)
+            while executor._work_queue.qsize() > 1:
+                release.wait(0.001)
+            stats = system_sampler._executor_stats(executor)
+            release.set()
+
+        self.assertEqual((stats['max_workers'], stats['workers'], stats['busy'], stats['queued']), (2, 2, 2, 1))
+        self.assertIsNone(system_sampler._executor_stats(None))
+
+
+class LoadSheddingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.layer = SimpleNamespace(group_send=mock.AsyncMock(), group_send_local=mock.AsyncMock())
+        patches = [
+            mock.patch.object(load_shedding, 'level', load_shedding.NORMAL),
+            mock.patch.dict('msr_control.load_shedding._state'),
+            mock.patch.dict('msr_control.load_shedding._decimation_counts', clear=True),
+            mock.patch.dict('msr_control.load_shedding.policy', load_shedding.DEFAULT_LOAD_SHEDDING_SETTINGS),
+            mock.patch.dict('msr_control.msr_protocol.servers', clear=True),
+            mock.patch('msr_control.load_shedding.get_channel_layer', return_value=self.layer),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        load_shedding._state['calm_since'] = None
+
+    def step(self, lag, now):
+        load_shedding.level = load_shedding.next_level(lag, now)
+        return load_shedding.level
+
+    def test_levels_rise_one_step_per_probe_and_recover_slowly(self):
+        self.assertEqual([self.step(1.0, now) for now in range(5)], [1, 2, 3, 3, 3])
+
+        # Lag below the recovery limit must last recover_after seconds per step
+        self.assertEqual([self.step(0.01, now) for now in (10, 12, 15, 16, 19)], [3, 3, 2, 2, 2])
+        self.assertEqual(self.step(0.3, 21), 3)
+        # Lag between the recovery limit and the threshold holds the level
+        self.assertEqual([self.step(0.2, now) for now in (30, 40)], [3, 3])
+        self.assertEqual([self.step(0.0, now) for now in (50, 55, 60, 65)], [3, 2, 1, 0])
+
+    async def test_level_changes_are_announced_to_local_clients(self):
+        msr_protocol.register_server('line1')
+        msr_protocol.register_server('line2')
+        await load_shedding.set_level(load_shedding.DECIMATE, 0.12)
+
+        self.assertEqual(load_shedding.level, load_shedding.DECIMATE)
+        self.layer.group_send.assert_not_awaited()
+        groups = [call.args[0] for call in self.layer.group_send_local.await_args_list]
+        self.assertEqual(groups, ['msr_data_line1', 'msr_data_line2'])
+        event = self.layer.group_send_local.await_args.args[1]
+        self.assertEqual((event['type'], event['name']), ('load_level', 'decimation'))
+
+    def test_decimation_keeps_every_nth_sample_per_server(self):
+        kept = [load_shedding.keep_broadcast('line1') for _ in range(8)]
+        self.assertEqual(kept, [False, False, False, True] * 2)
+        self.assertFalse(load_shedding.keep_broadcast('line2'))
+
+
+class RateLimitedLoggerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.logger = RateLimitedLogger(logging.getLogger('msr_control.tests.limited'), interval=10)
+
+    @mock.patch('msr_control.utils.logger.time.monotonic')
+    def test_repeats_are_suppressed_and_counted(self, monotonic):
+        with self.assertLogs('msr_control.tests.limited') as logs:
+            for now in (0, 1, 2, 3):
+                monotonic.return_value = now
+                self.logger.error("Frame from %s is malformed", 'line1')
+            self.logger.warning("Other message")
+            monotonic.return_value = 12
+            self.logger.error("Frame from %s is malformed", 'line2')
+
+        self.assertEqual([record.getMessage() for record in logs.records], [
+            'Frame from line1 is malformed',
+            'Other message',
+            'Frame from line2 is malformed (3 similar messages suppressed)',
+        ])
+
+    def test_exception_logs_the_traceback(self):
+        with self.assertLogs('msr_control.tests.limited') as logs:
+            try:
+                raise KeyError('x')
+            except KeyError:
+                self.logger.exception("Error relaying")
+
+        self.assertIs(logs.records[0].exc_info[0], KeyError)
+        self.assertEqual(logs.records[0].funcName, 'test_exception_logs_the_traceback')
+
+
+class MiddlewareTests(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_cache_headers_by_request(self):
+        middleware = SecurityHeadersMiddleware(lambda request: HttpResponse())
+
+        api = middleware(self.factory.get('/metrics'))
+        self.assertEqual(api['Cache-Control'], 'no-store, no-cache, must-revalidate, max-age=0')
+        self.assertEqual(api['X-Frame-Options'], 'DENY')
+
+        request = self.factory.get('/msr_control/')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = 'abc'
+        self.assertEqual(middleware(request)['Pragma'], 'no-cache')
+        self.assertEqual(middleware(self.factory.get('/accounts/login/'))['Cache-Control'], 'private, no-cache')
+
+        def view(request):
+            response = HttpResponse()
+            response['Cache-Control'] = 'max-age=60'
+            return response
+
+        own = SecurityHeadersMiddleware(view)(self.factory.get('/metrics'))
+        self.assertEqual(own['Cache-Control'], 'max-age=60')
+        self.assertNotIn('Pragma', own)
+
+    async def test_async_chain_awaits_the_view(self):
+        async def view(request):
+            return HttpResponse(status=204)
+
+        middleware = RequestLoggingMiddleware(SecurityHeadersMiddleware(view))
+        request = self.factory.get('/metrics')
+        request.user = SimpleLazyObject(lambda: self.fail('the user must not be loaded'))
+        with self.assertLogs('msr_control.middleware') as logs:
+            response = await middleware(request)
+
+        self.assertEqual(response.status_code, 204)
+        self.assertIn('Content-Security-Policy', response)
+        self.assertIn('User: -', logs.records[0].getMessage())
+
+    def test_configured_chart_js_origin_is_allowed(self):
+        self.assertIn("script-src 'self';", content_security_policy())
+        with override_settings(MSR_CHART_JS_URL='https://cdn.example.com/chart.js'):
+            self.assertIn("script-src 'self' https://cdn.example.com;", content_security_policy())
+
+
+class StaticFilesTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'app.3f2a.js')
+        with open(self.path, 'w') as f:
+            f.write('console.log("msr");\n' * 50)
+        compress_file(self.path)
+        self.static_file = StaticFile(self.path, immutable=True)
+
+        self.inner = mock.AsyncMock()
+        self.app = StaticFilesApp(self.inner)
+        self.app.load = mock.Mock(return_value=self.static_file)
+
+    async def get(self, path, *headers):
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'headers': list(headers)}
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await self.app(scope, None, send)
+        if not messages:
+            return None, {}, b''
+        return messages[0]['status'], dict(messages[0]['headers']), messages[1]['body']
+
+    def test_choose_honours_accept_encoding(self):
+        self.assertEqual(self.static_file.choose('gzip, deflate')[0], 'gzip')
+        self.assertEqual(self.static_file.choose('gzip;q=0, deflate')[0], 'identity')
+        self.assertEqual(self.static_file.choose('*')[0], 'br' if 'br' in self.static_file.variants else 'gzip')
+        self.assertEqual(self.static_file.choose('')[0], 'identity')
+        self.assertTrue(self.static_file.content_type.endswith(b'javascript; charset=utf-8'))
+
+    async def test_compressed_file_and_not_modified(self):
+        status, headers, body = await self.get('/static/app.3f2a.js', (b'accept-encoding', b'gzip'))
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-encoding'], b'gzip')
+        self.assertEqual(headers[b'cache-control'], b'public, max-age=31536000, immutable')
+        self.assertEqual(gzip.decompress(body), self.static_file.variants['identity'])
+
+        status, _, body = await self.get(
+            '/static/app.3f2a.js', (b'accept-encoding', b'gzip'), (b'if-none-match', b'"x", ' + headers[b'etag'])
+        )
+        self.assertEqual((status, body), (304, b''))
+        # A validator of another encoding does not match
+        status, _, _ = await self.get('/static/app.3f2a.js', (b'if-none-match', headers[b'etag']))
+        self.assertEqual(status, 200)
+        self.assertEqual(self.app.load.call_count, 1)
+
+    async def test_other_paths_are_passed_on(self):
+        for path in ('/msr_control/', '/static/../settings.py'):
+            await self.get(path)
+        self.app.load.return_value = None
+        await self.get('/static/missing.js')
+
+        self.assertEqual(self.inner.await_count, 3)
+
+
+class SnapshotEncodingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        metadata = {
+            'servers': {'default': {'calibration_settings': {'gain': 2.0}}},
+            'parameters': {},
+            'channels': [['a', 3, 10], ['b', 0, 0]]
+        }
+        columns = [
+            (np.array([1.0, 2.0, 3.0]), np.array([0.5, -1.0, 7.25])),
+            (np.empty(0), np.empty(0))
+        ]
+        snapshot.write_file(self.path, snapshot.encode_snapshot(metadata, columns, 1234.5))
+
+        written_at, decoded, channels = snapshot.read_snapshot(self.path)
+
+        self.assertEqual(written_at, 1234.5)
+        self.assertEqual(decoded, metadata)
+        self.assertEqual(channels['a'][0].tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual(channels['a'][1].tolist(), [0.5, -1.0, 7.25])
+        self.assertEqual(channels['b'][0].size, 0)
+
+    def test_corrupt_snapshot_is_ignored(self):
+        content = bytearray(snapshot.encode_snapshot({'channels': []}, [], 1.0))
+        content[-1] ^= 0xFF
+        snapshot.write_file(self.path, bytes(content))
+        self.assertIsNone(snapshot.read_snapshot(self.path))
+
+    def test_missing_snapshot(self):
+        self.assertIsNone(snapshot.read_snapshot(self.path))
+
+
+class SnapshotRestoreTests(HistoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'state.snapshot')
+        patches = [
+            mock.patch.dict('msr_control.msr_protocol.servers', clear=True),
+            mock.patch('msr_control.snapshot.snapshot_path', return_value=self.path),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def write(self, written_at=None):
+        metadata, columns = snapshot.capture_state(100)
+        snapshot.write_file(self.path, snapshot.encode_snapshot(metadata, columns, written_at or time.time()))
+
+    def test_restart_restores_settings_filter_state_and_history(self):
+        server = msr_protocol.register_server('line1', {'host': 'plc1'}, {'gain': 1.0})
+        server['calibration_settings']['gain'] = 2.5
+        server['connection_settings']['host'] = 'plc1-spare'
+        server['last_value'] = 4.0
+        server['channel_values'].update({'/a': 1.0, '/b': 2.0})
+        history.record_sample('line1', 10.0, 4.0)
+        self.write()
+
+        # Restart with the same configuration; /b was filtered before the restore
+        server = msr_protocol.register_server('line1', {'host': 'plc1'}, {'gain': 1.0})
+        server['channel_values']['/b'] = 3.0
+        history.channel_history.clear()
+        self.assertTrue(snapshot.restore_snapshot())
+
+        self.assertEqual(server['calibration_settings']['gain'], 2.5)
+        self.assertEqual(server['connection_settings']['host'], 'plc1-spare')
+        self.assertEqual(server['last_value'], 4.0)
+        self.assertEqual(server['channel_values'], {'/a': 1.0, '/b': 3.0})
+        self.assertEqual(history.channel_history['line1'].latest(10)[1].tolist(), [4.0])
+
+    def test_changed_configuration_and_old_state_are_not_restored(self):
+        server = msr_protocol.register_server('line1', {'host': 'plc1'})
+        server['connection_settings']['host'] = 'plc1-spare'
+        server['last_value'] = 4.0
+        server['channel_values']['/a'] = 1.0
+        history.record_sample('line1', 10.0, 4.0)
+        self.write(written_at=time.time() - 3600)
+
+        server = msr_protocol.register_server('line1', {'host': 'plc2'})
+        history.channel_history.clear()
+        self.assertTrue(snapshot.restore_snapshot())
+
+        self.assertEqual(server['connection_settings']['host'], 'plc2')
+        self.assertIsNone(server['last_value'])
+        self.assertEqual(server['channel_values'], {})
+        self.assertEqual(history.channel_history, {})
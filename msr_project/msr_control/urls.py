@@ -12,4 +12,7 @@ urlpatterns = [
     path('operator/', views.operator_view, name='operator'),
     path('calibrator/', views.calibrator_view, name='calibrator'),
     path('admin/', views.admin_view, name='admin_panel'),
+
+    # Cached EtherLab parameters
+    path('api/parameters/', views.parameters_api, name='parameters_api'),
 ]
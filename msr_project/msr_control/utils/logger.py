@@ -1,10 +1,35 @@
 """
 Logging utility for the MSR Control application.
+
+Records of the ``msr_control`` loggers are handed to a queue and written to
+the file and console by a listener thread, so the event loop never waits for
+disk or terminal I/O.
+
+Log statements on the sample path go through a RateLimitedLogger: messages
+are formatted lazily (%-style arguments, only when the level is enabled) and
+each message template is logged at most once per interval. The number of
+suppressed repeats is appended to the next message that gets through, so a
+flood of e.g. receive timeouts collapses into one line per interval.
 """
+import atexit
 import logging
 import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+
 from django.conf import settings
 
+# Default logging settings
+DEFAULT_LOG_SETTINGS = {
+    'queue': True,  # write records from a listener thread
+    'rate_limit_interval': 10.0,  # seconds between repeats of a rate-limited message
+    'rate_limit_keys': 1000  # message templates tracked before the oldest are forgotten
+}
+
+# Loggers whose handlers are moved behind the queue
+QUEUED_LOGGERS = ('msr_control', 'msr_control.middleware')
+
 # Create logs directory if it doesn't exist
 os.makedirs(os.path.join(settings.BASE_DIR, 'logs'), exist_ok=True)
 
@@ -12,29 +37,145 @@ os.makedirs(os.path.join(settings.BASE_DIR, 'logs'), exist_ok=True)
 logger = logging.getLogger('msr_control')
 
 if not logger.handlers:
-    # Set the logging level based on DEBUG setting
-    level = logging.DEBUG if settings.DEBUG else logging.INFO
+    # Set the logging level, INFO unless MSR_LOG_LEVEL asks for more
+    level = getattr(settings, 'MSR_LOG_LEVEL', 'INFO')
     logger.setLevel(level)
-    
+
     # Create file handler for logging to a file
     file_handler = logging.FileHandler(os.path.join(settings.BASE_DIR, 'logs/msr_control.log'))
     file_handler.setLevel(level)
-    
+
     # Create console handler for logging to the console
     console_handler = logging.StreamHandler()
     console_handler.setLevel(level)
-    
+
     # Create a formatter and add it to the handlers
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     file_handler.setFormatter(formatter)
     console_handler.setFormatter(formatter)
-    
+
     # Add the handlers to the logger
     logger.addHandler(file_handler)
     logger.addHandler(console_handler)
 
+# The running queue listener (None until install_queue_logging)
+_listener = None
+
+
+def get_log_settings():
+    """Return the logging settings with overrides from MSR_LOGGING applied."""
+    log_settings = DEFAULT_LOG_SETTINGS.copy()
+    log_settings.update(getattr(settings, 'MSR_LOGGING', {}))
+    return log_settings
+
+
+def install_queue_logging():
+    """
+    Move the handlers of QUEUED_LOGGERS behind a queue drained by a listener thread.
+
+    Idempotent; called from the app's ready(). The listener is stopped at
+    exit, after writing the records still queued.
+
+    Returns:
+        QueueListener: The listener, or None if queued logging is disabled
+    """
+    global _listener
+
+    if _listener is not None or not get_log_settings()['queue']:
+        return _listener
+
+    records = queue.SimpleQueue()
+    handlers = []
+    for name in QUEUED_LOGGERS:
+        target = logging.getLogger(name)
+        for handler in list(target.handlers):
+            if not isinstance(handler, QueueHandler):
+                target.removeHandler(handler)
+                if handler not in handlers:
+                    handlers.append(handler)
+        target.addHandler(QueueHandler(records))
+
+    # Handlers keep their own levels, e.g. a console limited to INFO
+    _listener = QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+
+class RateLimitedLogger:
+    """
+    Logs each message template at most once per interval.
+
+    Has the debug/info/warning/error signature of a logger, so a plain logger
+    can stand in for it. Messages take %-style arguments, which are only
+    formatted for messages that are actually logged.
+    """
+
+    def __init__(self, target, interval=None):
+        log_settings = get_log_settings()
+        self.logger = target
+        self.interval = log_settings['rate_limit_interval'] if interval is None else interval
+        self.max_keys = log_settings['rate_limit_keys']
+        self.last = {}  # message template -> [time last logged, repeats suppressed since]
+
+    def log(self, level, msg, *args, **kwargs):
+        """
+        Log a message unless its template was logged within the interval.
+
+        Args:
+            level: Logging level
+            msg: Message template; also identifies repeats
+            *args: Arguments for the template
+            **kwargs: Passed to the logger, e.g. exc_info
+        """
+        if not self.logger.isEnabledFor(level):
+            return
+
+        now = time.monotonic()
+        entry = self.last.get(msg)
+        if entry is not None and now - entry[0] < self.interval:
+            entry[1] += 1
+            return
+
+        suppressed = entry[1] if entry is not None else 0
+        if entry is None and len(self.last) >= self.max_keys:
+            self.last.clear()
+        self.last[msg] = [now, 0]
+
+        if suppressed:
+            msg = f"{msg} (%d similar messages suppressed)"
+            args += (suppressed,)
+        self.logger.log(level, msg, *args, stacklevel=3, **kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+    def exception(self, msg, *args, exc_info=True, **kwargs):
+        self.log(logging.ERROR, msg, *args, exc_info=exc_info, **kwargs)
+
+
 def get_logger():
     """
     Returns the configured logger instance.
     """
     return logger
+
+
+def get_rate_limited_logger(interval=None):
+    """
+    Returns a RateLimitedLogger writing to the configured logger.
+
+    Args:
+        interval: Seconds between repeats of a message (MSR_LOGGING
+            rate_limit_interval if None)
+    """
+    return RateLimitedLogger(logger, interval)
@@ -0,0 +1,60 @@
+"""
+Private runtime directory of the MSR Control processes.
+
+Sockets, lock files and other files the processes on one host share with
+each other live below MSR_RUNTIME_DIR. The directory must belong to the
+user running the service and be closed to everyone else: anyone who can
+create files in it can talk to the processes as one of them.
+"""
+import os
+import stat
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+def get_runtime_dir():
+    """
+    Return the runtime directory.
+
+    MSR_RUNTIME_DIR if set, else msr_control in XDG_RUNTIME_DIR, else run
+    in the project directory.
+    """
+    configured = getattr(settings, 'MSR_RUNTIME_DIR', None)
+    if configured:
+        return os.fspath(configured)
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'msr_control')
+    return os.path.join(settings.BASE_DIR, 'run')
+
+
+def ensure_private_directory(path):
+    """
+    Create a directory only the current user can use, or check an existing one.
+
+    Args:
+        path: Path of the directory
+
+    Returns:
+        str: The path
+
+    Raises:
+        ImproperlyConfigured: If the path is not a directory owned by the
+            current user with mode 0700 (e.g. created by another user)
+    """
+    path = os.fspath(path)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise ImproperlyConfigured(f"Runtime directory {path} is not a directory")
+    if info.st_uid != os.getuid():
+        raise ImproperlyConfigured(
+            f"Runtime directory {path} belongs to user {info.st_uid}, not {os.getuid()}"
+        )
+    if info.st_mode & 0o077:
+        raise ImproperlyConfigured(
+            f"Runtime directory {path} has mode {stat.S_IMODE(info.st_mode):o}; "
+            f"it must only be accessible to its owner (chmod 700)"
+        )
+    return path
@@ -4,7 +4,7 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages
 from .models import UserRole
-from django.http import HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from .forms import SignUpForm
 
 def login_view(request):
@@ -100,3 +100,67 @@ def admin_view(request):
         return HttpResponseForbidden("Role not assigned")
 
     return render(request, 'msr_control/admin.html')
+
+@login_required
+def parameters_api(request):
+    """
+    Page through or browse the cached parameter tree of an EtherLab server.
+
+    Query parameters: 'server', 'prefix', 'offset', 'limit' and 'browse'.
+    Answered from the local cache, without a round trip to the server. Not
+    available in workers of the shared-memory ingest mode, which have no
+    connection and no cache of their own.
+    """
+    try:
+        user_role = request.user.role
+        if not (user_role.is_calibrator or user_role.is_admin):
+            return HttpResponseForbidden("You don't have permission to access this page")
+    except UserRole.DoesNotExist:
+        return HttpResponseForbidden("Role not assigned")
+
+    from .msr_protocol import DEFAULT_SERVER, servers
+    from .parameter_tree import DEFAULT_PAGE_SIZE, query_parameters
+    from .tasks import uses_shared_ingest
+
+    if uses_shared_ingest():
+        return JsonResponse(
+            {'error': 'Parameters are not available: the EtherLab connection runs in the ingest process'},
+            status=503
+        )
+
+    server_id = request.GET.get('server', DEFAULT_SERVER)
+    if server_id not in servers:
+        return JsonResponse({'error': f'Unknown server: {server_id}'}, status=404)
+
+    try:
+        result = query_parameters(
+            server_id,
+            prefix=request.GET.get('prefix', '/'),
+            offset=request.GET.get('offset', 0),
+            limit=request.GET.get('limit', DEFAULT_PAGE_SIZE),
+            browse=request.GET.get('browse') in ('1', 'true')
+        )
+    except ValueError as e:
+        return JsonResponse({'error': f'Invalid parameter query: {e}'}, status=400)
+
+    return JsonResponse(result)
+
+async def metrics_view(request):
+    """
+    Serve the process metrics in the Prometheus text exposition format.
+
+    Runs on the event loop, so it reads the counters without racing the
+    ingest task. If MSR_METRICS sets a 'token', scrapes must send it as a
+    bearer token.
+    """
+    from .metrics import get_metrics_settings, render_metrics
+
+    metrics_settings = get_metrics_settings()
+    if not metrics_settings['enabled']:
+        return HttpResponse(status=404)
+
+    token = metrics_settings['token']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponse('Unauthorized\n', status=401, content_type='text/plain')
+
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
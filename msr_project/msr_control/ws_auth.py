@@ -0,0 +1,335 @@
+"""
+Cached authentication for WebSocket connections.
+
+After a network interruption every dashboard reconnects at the same moment.
+Resolving the session, the user and the role from the database for each of
+them floods the database and the thread pool, so this module caches
+authenticated sessions in process as session key -> (user id, username,
+role) with a TTL. A reconnecting client with a cached session costs no
+database queries.
+
+Entries are invalidated when a User or UserRole is saved or deleted and when
+the user logs out. Invalidations are broadcast to the other processes through
+the channel layer, and connected consumers are told about role changes and
+revoked sessions through a per-user group, so they never need to reconnect.
+"""
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from channels.auth import get_user
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.middleware import BaseMiddleware
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import UserRole
+
+# Try to import the logger, but don't fail if it's not available yet
+try:
+    from .utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# Default auth cache settings
+DEFAULT_AUTH_CACHE_SETTINGS = {
+    'ttl': 300,  # seconds a resolved session stays cached
+    'max_entries': 10000
+}
+
+# Group every process listens on for cache invalidations
+INVALIDATION_GROUP = 'msr_auth'
+
+# session key -> {'user', 'user_id', 'username', 'role', 'expires'}
+session_cache = {}
+
+cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'invalidations': 0
+}
+
+# Bumped on every invalidation so lookups racing with one are not cached
+_generation = 0
+
+# session key -> task resolving that session, shared by concurrent connects
+_pending = {}
+
+_listener_task = None
+
+
+def get_auth_cache_settings():
+    """Return the auth cache settings with overrides from MSR_WS_AUTH_CACHE applied."""
+    cache_settings = DEFAULT_AUTH_CACHE_SETTINGS.copy()
+    cache_settings.update(getattr(settings, 'MSR_WS_AUTH_CACHE', {}))
+    return cache_settings
+
+
+def user_group_name(user_id):
+    """Return the name of the group joined by all consumers of a user."""
+    return f"msr_user_{user_id}"
+
+
+def get_cached_session(session_key):
+    """
+    Return the cached entry for a session, or None if missing or expired.
+
+    Args:
+        session_key: The Django session key
+
+    Returns:
+        dict: The cached entry with 'user', 'user_id', 'username' and 'role'
+    """
+    entry = session_cache.get(session_key)
+    if entry is None:
+        return None
+    if entry['expires'] < time.monotonic():
+        session_cache.pop(session_key, None)
+        return None
+    return entry
+
+
+def cache_session(session_key, user, role):
+    """
+    Cache an authenticated session.
+
+    Args:
+        session_key: The Django session key
+        user: The authenticated user
+        role: The user's role
+
+    Returns:
+        dict: The cached entry
+    """
+    cache_settings = get_auth_cache_settings()
+    if len(session_cache) >= cache_settings['max_entries']:
+        _prune(cache_settings['max_entries'])
+
+    entry = {
+        'user': user,
+        'user_id': user.pk,
+        'username': user.username,
+        'role': role,
+        'expires': time.monotonic() + cache_settings['ttl']
+    }
+    session_cache[session_key] = entry
+    return entry
+
+
+def _prune(max_entries):
+    """Remove expired entries, then the oldest ones until there is room."""
+    now = time.monotonic()
+    for session_key, entry in list(session_cache.items()):
+        if entry['expires'] < now:
+            session_cache.pop(session_key, None)
+
+    while len(session_cache) >= max_entries:
+        session_cache.pop(next(iter(session_cache)), None)
+
+
+def invalidate_session(session_key):
+    """Remove a session from the cache."""
+    global _generation
+    _generation += 1
+    if session_cache.pop(session_key, None) is not None:
+        cache_stats['invalidations'] += 1
+
+
+def invalidate_user(user_id):
+    """Remove all cached sessions of a user."""
+    global _generation
+    _generation += 1
+    for session_key, entry in list(session_cache.items()):
+        if entry['user_id'] == user_id:
+            session_cache.pop(session_key, None)
+            cache_stats['invalidations'] += 1
+
+
+@database_sync_to_async
+def _load_role(user):
+    """Read a user's role, defaulting to operator like the consumer does."""
+    try:
+        return UserRole.objects.values_list('role', flat=True).get(user_id=user.pk)
+    except UserRole.DoesNotExist:
+        return 'operator'
+
+
+async def _load_session(scope, session_key):
+    """Resolve a session from the database and cache it if still valid."""
+    cache_stats['misses'] += 1
+    generation = _generation
+
+    user = await get_user(scope)
+    if not user.is_authenticated:
+        return None
+    role = await _load_role(user)
+
+    # An invalidation arrived while loading; use the result once, uncached
+    if generation != _generation:
+        return {'user': user, 'user_id': user.pk, 'username': user.username, 'role': role}
+    return cache_session(session_key, user, role)
+
+
+async def resolve_session(scope):
+    """
+    Return the authenticated user entry for a connection's session.
+
+    Concurrent connections with the same uncached session share one lookup.
+
+    Args:
+        scope: The connection scope, with 'session' set by SessionMiddleware
+
+    Returns:
+        dict: The session entry, or None if the session is not authenticated
+    """
+    session_key = scope['session'].session_key
+    if not session_key:
+        return None
+
+    entry = get_cached_session(session_key)
+    if entry is not None:
+        cache_stats['hits'] += 1
+        return entry
+
+    task = _pending.get(session_key)
+    if task is None:
+        task = asyncio.ensure_future(_load_session(scope, session_key))
+        _pending[session_key] = task
+        task.add_done_callback(lambda _: _pending.pop(session_key, None))
+    return await asyncio.shield(task)
+
+
+async def _listen_for_invalidations():
+    """Apply cache invalidations broadcast by other processes."""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    channel = await channel_layer.new_channel()
+    await channel_layer.group_add(INVALIDATION_GROUP, channel)
+    try:
+        while True:
+            message = await channel_layer.receive(channel)
+            if message.get('session_key'):
+                invalidate_session(message['session_key'])
+            else:
+                invalidate_user(message['user_id'])
+    finally:
+        await channel_layer.group_discard(INVALIDATION_GROUP, channel)
+
+
+def _ensure_listener():
+    """Start the invalidation listener on the running loop if needed."""
+    global _listener_task
+    if _listener_task is None or _listener_task.done():
+        from .msr_protocol import spawn_background_task
+        _listener_task = spawn_background_task(_listen_for_invalidations())
+
+
+class CachedAuthMiddleware(BaseMiddleware):
+    """
+    Populate scope['user'] and scope['user_role'] from the session cache.
+
+    Replaces Channels' AuthMiddleware; requires SessionMiddleware above it.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        _ensure_listener()
+
+        entry = await resolve_session(scope)
+        if entry is None:
+            scope['user'] = AnonymousUser()
+        else:
+            scope['user'] = entry['user']
+            scope['user_role'] = entry['role']
+
+        return await super().__call__(scope, receive, send)
+
+
+def CachedAuthMiddlewareStack(inner):
+    """Cookie, session and cached auth middleware, like AuthMiddlewareStack."""
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
+
+
+async def _notify(user_id, session_key=None, role=None, revoked=False):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    await channel_layer.group_send(INVALIDATION_GROUP, {
+        'type': 'auth_invalidate',
+        'user_id': user_id,
+        'session_key': session_key
+    })
+    if role is not None:
+        await channel_layer.group_send(user_group_name(user_id), {
+            'type': 'role_changed',
+            'role': role
+        })
+    if revoked:
+        await channel_layer.group_send(user_group_name(user_id), {
+            'type': 'session_revoked',
+            'session_key': session_key
+        })
+
+
+def notify_auth_change(user_id, session_key=None, role=None, revoked=False):
+    """
+    Invalidate cached sessions here and in the other processes, and notify
+    the user's connected consumers.
+
+    Called from signal handlers, which run in synchronous code.
+
+    Args:
+        user_id: The affected user
+        session_key: Limit the change to one session, e.g. on logout
+        role: The user's new role, pushed to connected consumers
+        revoked: Close the affected connected consumers
+    """
+    if session_key:
+        invalidate_session(session_key)
+    else:
+        invalidate_user(user_id)
+
+    try:
+        async_to_sync(_notify)(user_id, session_key, role, revoked)
+    except Exception:
+        logger.exception(f"Failed to broadcast auth change for user {user_id}")
+
+
+@receiver(post_save, sender=UserRole)
+def user_role_saved(sender, instance, **kwargs):
+    notify_auth_change(instance.user_id, role=instance.role)
+
+
+@receiver(post_delete, sender=UserRole)
+def user_role_deleted(sender, instance, **kwargs):
+    notify_auth_change(instance.user_id, role='operator')
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    # Logging in only updates last_login, which does not affect the cache
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    notify_auth_change(instance.pk, revoked=not instance.is_active)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    notify_auth_change(instance.pk, revoked=True)
+
+
+@receiver(user_logged_out)
+def user_logged_out_handler(sender, request, user, **kwargs):
+    session_key = request.session.session_key if hasattr(request, 'session') else None
+    if user is not None and session_key:
+        notify_auth_change(user.pk, session_key=session_key, revoked=True)
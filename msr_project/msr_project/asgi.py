@@ -10,19 +10,30 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'msr_project.settings')
+
+# Set up Django before importing application code that uses settings or models
+django_asgi_app = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 
+from msr_control.lifespan import IngestLifespanApp
 from msr_control.routing import websocket_urlpatterns
-
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'msr_project.settings')
+from msr_control.static_files import StaticFilesApp
+from msr_control.ws_auth import CachedAuthMiddlewareStack
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    # Static files are served from memory, with long-lived caching for hashed names
+    "http": StaticFilesApp(django_asgi_app),
+    # Sessions are resolved through an in-process cache so reconnect storms
+    # do not query the database
+    "websocket": CachedAuthMiddlewareStack(
         URLRouter(
             # Add URL routing for WebSockets here
             websocket_urlpatterns
         )
-    )
+    ),
+    # Starts and stops the MSR ingest on the server's event loop
+    "lifespan": IngestLifespanApp(),
 })
@@ -78,6 +78,29 @@ TEMPLATES = [
 ASGI_APPLICATION = 'msr_project.asgi.application'
 # WSGI_APPLICATION = 'msr_project.wsgi.application'
 
+# Private directory of the sockets and lock files shared by the processes on
+# this host; created with mode 0700, and startup fails if it belongs to
+# another user or others can access it
+MSR_RUNTIME_DIR = os.environ.get('MSR_RUNTIME_DIR') or (
+    os.path.join(os.environ['XDG_RUNTIME_DIR'], 'msr_control') if os.environ.get('XDG_RUNTIME_DIR')
+    else os.path.join(BASE_DIR, 'run')
+)
+
+# Channel layers
+# The in-memory layer serves a single process. With several ASGI worker
+# processes on one host, set
+# MSR_CHANNEL_LAYER_BACKEND=msr_control.channel_layer.UnixSocketChannelLayer:
+# it needs no external service and delivers group messages between the
+# workers through sockets in MSR_RUNTIME_DIR.
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': os.environ.get('MSR_CHANNEL_LAYER_BACKEND', 'channels.layers.InMemoryChannelLayer'),
+        'CONFIG': {
+            'capacity': 1000,
+        },
+    },
+}
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -125,6 +148,23 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# `manage.py collectstatic` writes content-hashed names (cached for a year by
+# browsers) and gzip/brotli copies, served by msr_control.static_files under ASGI
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'msr_control.static_files.CompressedManifestStaticFilesStorage',
+    },
+}
+
+# Chart.js is served from msr_control/static/msr_control/vendor/chart.umd.min.js
+# (4.4.0); set a URL to load another copy instead, which is then allowed by the
+# Content Security Policy
+MSR_CHART_JS_URL = os.environ.get('MSR_CHART_JS_URL') or None
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -136,6 +176,81 @@ LOGIN_URL = '/msr_control/login/'
 LOGIN_REDIRECT_URL = '/msr_control/dashboard/'
 LOGOUT_REDIRECT_URL = '/msr_control/login/'
 
+# Additional EtherLab servers, one connection session each. Clients watch a
+# server through ws/msr_data/<server id>/; ws/msr_data/ is the 'default'
+# server configured in msr_protocol.DEFAULT_CONNECTION_SETTINGS. Example:
+# MSR_ETHERLAB_SERVERS = {
+#     'line2': {'host': '10.0.2.10', 'port': 2345},
+#     'line3': {'host': '10.0.3.10', 'port': 2345, 'calibration': {'gain': 2.0}},
+# }
+MSR_ETHERLAB_SERVERS = {}
+
+# MSR ingest settings
+# 'embedded' runs the EtherLab connection inside the ASGI server process.
+# 'shared_memory' relays frames published by `manage.py run_msr_ingest`, which
+# lets several ASGI worker processes share one connection to the server.
+MSR_INGEST_MODE = os.environ.get('MSR_INGEST_MODE', 'embedded')
+
+# Shared-memory frame ring used in 'shared_memory' ingest mode
+MSR_SHARED_RING = {
+    # Name of the shared memory block; derived from MSR_RUNTIME_DIR if not set
+    'name': os.environ.get('MSR_SHARED_RING_NAME'),
+    'slots': 1024,
+    'slot_size': 16384,
+    'poll_interval': 0.005,
+}
+
+# Snapshots of the runtime state (settings, filter state, parameter cache and
+# recent history), restored on startup; set 'enabled': False to start cold
+MSR_SNAPSHOT = {
+    'path': os.environ.get('MSR_SNAPSHOT_PATH', os.path.join(BASE_DIR, 'state', 'msr_state.snapshot')),
+    'interval': 5.0,
+    'history_samples': 4096,
+    'max_history_age': 600.0,
+}
+
+# WebSocket auth cache: authenticated sessions are kept in process so that
+# reconnecting clients cost no database queries
+MSR_WS_AUTH_CACHE = {
+    'ttl': 300,
+    'max_entries': 10000,
+}
+
+# WebSocket commands run as background tasks; limits per client
+MSR_WS_COMMANDS = {
+    'max_concurrent': 4,
+    'max_pending': 32,
+}
+
+# Rate limits of inbound WebSocket messages (messages per second, burst),
+# per connection and shared by all connections of a role; see
+# msr_control/ratelimit.py for the defaults
+MSR_WS_RATE_LIMITS = {
+    'connection': {
+        'operator': {'rate': 5, 'burst': 10},
+        'calibrator': {'rate': 10, 'burst': 20},
+        'admin': {'rate': 20, 'burst': 40},
+    },
+}
+
+# Batching of broadcast samples. Clients declare a latency budget with
+# ws/msr_data/?latency_ms=200; samples arriving within it share one message
+MSR_WS_BATCHING = {
+    'default_latency_ms': 0,
+    'max_latency_ms': 1000,
+    'max_batch': 1000,
+}
+
+# Level of the msr_control loggers; DEBUG logs (rate-limited) per-sample details
+MSR_LOG_LEVEL = os.environ.get('MSR_LOG_LEVEL', 'INFO')
+
+# msr_control records are written by a listener thread off the event loop;
+# repeats of a rate-limited message are logged once per interval
+MSR_LOGGING = {
+    'queue': True,
+    'rate_limit_interval': 10.0,
+}
+
 # Logging configuration
 LOGGING = {
     'version': 1,
@@ -183,7 +298,7 @@ LOGGING = {
         },
         'msr_control': {
             'handlers': ['console', 'msr_file'],
-            'level': 'DEBUG',
+            'level': MSR_LOG_LEVEL,
             'propagate': False,
         },
         'msr_control.middleware': {
@@ -17,7 +17,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from msr_control.views import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('msr_control/', include('msr_control.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]